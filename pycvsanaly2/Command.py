@@ -185,27 +185,27 @@ class Command(object):
                             parser_error_func=None, timeout=None):
         out_func = err_func = None
         
-        def out_cb(out_chunk, out_data_l):
-            out_data = out_data_l[0]
-            out_data += out_chunk
-            while len(out_data) > 0:
-                pos = out_data.find('\n')
-                if pos < 0:
-                    pos = len(out_data)
-                parser_out_func(out_data[:pos + 1])
-                out_data = out_data[pos + 1:]
-            out_data_l[0] = out_data
-
-        def err_cb(err_chunk, err_data_l):
-            err_data = err_data_l[0]
-            err_data += err_chunk
-            while len(err_data) > 0:
-                pos = err_data.find('\n')
-                if pos < 0:
-                    pos = len(err_data)
-                parser_error_func(err_data[:pos + 1])
-                err_data = err_data[pos + 1:]
-            err_data_l[0] = err_data
+        def lines_cb(parser_func):
+            # Only whole lines are given to the parser, the rest of the
+            # chunk waits for the next one, or the end of the output
+            def cb(chunk, data_l):
+                data = data_l[0] + chunk
+                start = 0
+                pos = data.find('\n')
+                while pos >= 0:
+                    parser_func(data[start:pos + 1])
+                    start = pos + 1
+                    pos = data.find('\n', start)
+                data = data[start:]
+                if chunk == "" and data:
+                    parser_func(data)
+                    data = ""
+                data_l[0] = data
+
+            return cb
+
+        out_cb = lines_cb(parser_out_func)
+        err_cb = lines_cb(parser_error_func)
 
         if parser_out_func is not None:
             out_data = [""]
@@ -272,6 +272,14 @@ class Command(object):
             return None
 
 if __name__ == '__main__':
+    # Lines crossing the chunks read from the pipe
+    log = "x" * 1020 + "\ncommit " + "a" * 40 + "\n" + "y" * 3000 + \
+          "\nno newline at the end"
+    lines = []
+    Command(['cat']).run(log, parser_out_func=lines.append)
+    assert lines == [l + "\n" for l in log.split("\n")[:-1]] + \
+                    ["no newline at the end"], lines
+
     # Valid command without cwd
     cmd = Command(['ls', '-l'])
     cmd.run()
@@ -33,6 +33,14 @@ class Config(object):
                       'repo_logfile': None,
                       'save_logfile': None,
                       'no_parse': False,
+                      'incremental': False,
+                      # Set at runtime in incremental mode, the id of the
+                      # first commit mined in this run. Extensions only
+                      # process the commits from it on
+                      'first_new_commit': None,
+                      # Set at runtime in incremental mode, the revs of
+                      # the branch heads mined in the previous run
+                      'known_heads': [],
                       'db_driver': 'mysql',
                       'db_user': 'operator',
                       'db_password': None,
@@ -49,8 +57,25 @@ class Config(object):
                       'metrics_noerr': False,
                       # Threading options
                       'max_threads': 10,
+                      # Number of actions buffered before writing them
+                      # to the database while parsing the log
+                      'max_actions': 100,
+                      # Number of rows (hunks, patch lines) written at
+                      # a time, and maximum number of seconds between
+                      # commits (None for no limit)
+                      'insert_batch_size': 1000,
+                      'commit_interval': None,
+                      # Number of repositories mined at the same time
+                      # in batch mode
+                      'batch_processes': 4,
+                      # Get the lines added and removed by every commit
+                      # and file from the Git log (--numstat)
+                      'git_numstat': False,
                       # Content options
                       'no_content': False,
+                      'content_blobs': False,
+                      # Patches options
+                      'compress_patches': False,
                       # File count extension options
                       'count_types': [],
                       # Regex for matching bug fixes in BugFixMessage
@@ -62,6 +87,8 @@ class Config(object):
                                           "revert(ing|ed)?"],
                       'bug_fix_regexes_case_sensitive': ["[A-Z]+(-|#)\d+",
                                                          "CVE-\d+-\d+"],
+                      # Number of processes matching commit messages
+                      'bug_fix_processes': 4,
                       # Should merge commits be analyzed.
                       'analyze_merges': False,
                       # Should comments be ignored, when running hunk_blame?
@@ -112,6 +139,10 @@ class Config(object):
             self.no_parse = config.no_parse
         except:
             pass
+        try:
+            self.incremental = config.incremental
+        except:
+            pass
         try:
         	self.dot_file = config.dot_file
        	except:
@@ -170,6 +201,22 @@ class Config(object):
             self.max_threads = config.max_threads
         except:
             pass
+        try:
+            self.max_actions = config.max_actions
+        except:
+            pass
+        try:
+            self.insert_batch_size = config.insert_batch_size
+        except:
+            pass
+        try:
+            self.commit_interval = config.commit_interval
+        except:
+            pass
+        try:
+            self.batch_processes = config.batch_processes
+        except:
+            pass
         try:
             self.bug_fix_regexes = config.bug_fix_regexes
         except:
@@ -179,10 +226,26 @@ class Config(object):
                 config.bug_fix_regexes_case_sensitive
         except:
             pass
+        try:
+            self.bug_fix_processes = config.bug_fix_processes
+        except:
+            pass
+        try:
+            self.git_numstat = config.git_numstat
+        except:
+            pass
         try:
             self.no_content = config.no_content
         except:
             pass
+        try:
+            self.compress_patches = config.compress_patches
+        except:
+            pass
+        try:
+            self.content_blobs = config.content_blobs
+        except:
+            pass
 
         try:
             self.backout = config.backout
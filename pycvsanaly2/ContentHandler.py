@@ -20,6 +20,8 @@
 
 class ContentHandler(object):
 
+    # ORDER_REVISION: commits come from the newest to the oldest one
+    # ORDER_FILE: commits come grouped by file, they have to be sorted
     (
         ORDER_REVISION,
         ORDER_FILE
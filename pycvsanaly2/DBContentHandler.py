@@ -23,8 +23,11 @@ import re
 from ContentHandler import ContentHandler
 from Database import (DBRepository, DBLog, DBFile, DBFileLink,
                       DBAction, DBFileCopy, DBBranch, DBPerson, DBTag,
-                      DBTagRev, statement, MysqlDatabase)
+                      DBTagRev, DBBranchHead, DBCommitLines, DBPatchLines,
+                      statement, initialize_ids,
+                      MysqlDatabase, TableAlreadyExists)
 from profile import profiler_start, profiler_stop
+from Config import Config
 from utils import printdbg, printout, to_utf8, cvsanaly_cache_dir
 from cPickle import dump, load
 
@@ -47,6 +50,7 @@ class DBContentHandler(ContentHandler):
         self.db = db
         self.cnn = None
         self.cursor = None
+        self.max_actions = Config().max_actions or self.MAX_ACTIONS
 
         self.__init_caches()
 
@@ -86,9 +90,25 @@ class DBContentHandler(ContentHandler):
         self.cnn = self.db.connect()
 
         self.cursor = self.cnn.cursor()
+        # Other processes might have inserted rows since the
+        # counters were initialized
+        initialize_ids(self.db, self.cursor)
 
         self.commits = []
         self.actions = []
+        self.files = []
+        self.file_links = []
+        self.file_copies = []
+        self.people = []
+        self.branches = []
+        self.tags = []
+        self.tag_revs = []
+        # Last commit inserted for every branch
+        self.heads = {}
+        # Lines added and removed, when the parser got them
+        self.commits_lines = []
+        self.patch_lines = []
+        self.lines_tables = False
 
     def repository(self, uri):
         cursor = self.cursor
@@ -155,33 +175,32 @@ class DBContentHandler(ContentHandler):
             raise CacheFileMismatch(msg)
 
     def __insert_many(self):
-        if not self.actions and not self.commits:
+        buffers = [("files", DBFile.__insert__, self.files),
+                   ("file links", DBFileLink.__insert__, self.file_links),
+                   ("file copies", DBFileCopy.__insert__, self.file_copies),
+                   ("people", DBPerson.__insert__, self.people),
+                   ("branches", DBBranch.__insert__, self.branches),
+                   ("tags", DBTag.__insert__, self.tags),
+                   ("tag revisions", DBTagRev.__insert__, self.tag_revs)]
+
+        if not self.actions and not self.commits and \
+           not self.commits_lines and not self.patch_lines and \
+           not [rows for name, query, rows in buffers if rows]:
             return
 
         cursor = self.cursor
 
-        if self.actions:
-            profiler_start("Inserting actions for repository %d",
-                           (self.repo_id,))
-            for a in self.actions:
-                action_tuple = (a.id, a.type, a.file_id, a.commit_id, a.branch_id, a.current_file_path)
-                if isinstance(self.db, MysqlDatabase):
-                    import MySQLdb
-                    try:
-                        cursor.execute(statement(DBAction.__insert__,
-                                             self.db.place_holder), 
-                                             action_tuple)
-                    except MySQLdb.IntegrityError, e:
-                        if e.args[0] == 1062:
-                            # Duplicate entry
-                            pass
-                else:
-                    cursor.execute(statement(DBAction.__insert__,
-                                             self.db.place_holder), 
-                                             action_tuple)
-            self.actions = []
-            profiler_stop("Inserting actions for repository %d",
-                          (self.repo_id,))
+        for name, query, rows in buffers:
+            if not rows:
+                continue
+
+            profiler_start("Inserting %s for repository %d",
+                           (name, self.repo_id))
+            cursor.executemany(statement(query, self.db.place_holder), rows)
+            del rows[:]
+            profiler_stop("Inserting %s for repository %d",
+                          (name, self.repo_id))
+
         if self.commits:
             commits = [(c.id, c.rev, c.committer, c.author, c.commit_date, \
                         c.author_date, to_utf8(c.message).decode("utf-8"), \
@@ -194,38 +213,102 @@ class DBContentHandler(ContentHandler):
             profiler_stop("Inserting commits for repository %d",
                           (self.repo_id,))
 
+        if self.actions:
+            actions = [(a.id, a.type, a.file_id, a.commit_id, a.branch_id,
+                        a.current_file_path) for a in self.actions]
+            if isinstance(self.db, MysqlDatabase):
+                # Skip duplicate entries instead of failing the whole batch
+                query = DBAction.__insert__.replace("INSERT INTO",
+                                                    "INSERT IGNORE INTO", 1)
+            else:
+                query = DBAction.__insert__
+            profiler_start("Inserting actions for repository %d",
+                           (self.repo_id,))
+            cursor.executemany(statement(query, self.db.place_holder),
+                               actions)
+            self.actions = []
+            profiler_stop("Inserting actions for repository %d",
+                          (self.repo_id,))
+
+        if self.commits_lines or self.patch_lines:
+            profiler_start("Inserting lines for repository %d",
+                           (self.repo_id,))
+            self.__insert_lines()
+            profiler_stop("Inserting lines for repository %d",
+                          (self.repo_id,))
+
         profiler_start("Committing inserts for repository %d",
                        (self.repo_id,))
         self.cnn.commit()
         profiler_stop("Committing inserts for repository %d",
                       (self.repo_id,))
 
+    def __insert_lines(self):
+        cursor = self.cursor
+
+        if not self.lines_tables:
+            # Same tables used by CommitsLOC and PatchLOC, which
+            # skip the commits and files already counted here
+            for create_table in (self.db.create_commits_lines_table,
+                                 self.db.create_patch_lines_table):
+                try:
+                    create_table(cursor)
+                except TableAlreadyExists:
+                    pass
+            self.lines_tables = True
+
+        if self.commits_lines:
+            cursor.executemany(statement(DBCommitLines.__insert__,
+                                         self.db.place_holder),
+                               self.commits_lines)
+            self.commits_lines = []
+
+        if self.patch_lines:
+            cursor.executemany(statement(DBPatchLines.__insert__,
+                                         self.db.place_holder),
+                               self.patch_lines)
+            self.patch_lines = []
+
+    def __update_branch_heads(self):
+        if not self.heads:
+            return
+
+        cursor = self.cursor
+        try:
+            # Databases created by older versions don't have the table
+            self.db.create_branch_heads_table(cursor)
+        except TableAlreadyExists:
+            pass
+
+        keys = [(self.repo_id, branch_id) for branch_id in self.heads]
+        heads = [(self.repo_id, branch_id, rev, commit_id)
+                 for branch_id, (rev, commit_id) in self.heads.items()]
+        cursor.executemany(statement(DBBranchHead.__delete__,
+                                     self.db.place_holder), keys)
+        cursor.executemany(statement(DBBranchHead.__insert__,
+                                     self.db.place_holder), heads)
+        self.cnn.commit()
+        self.heads = {}
+
     def __add_new_file_and_link(self, file_name, parent_id, commit_id):
         dbfile = DBFile(None, file_name)
         dbfile.repository_id = self.repo_id
-        self.cursor.execute(statement(DBFile.__insert__,
-                                      self.db.place_holder),
-                                      (dbfile.id, dbfile.file_name,
-                                       dbfile.repository_id))
+        self.files.append((dbfile.id, dbfile.file_name, dbfile.repository_id))
 
         dblink = DBFileLink(None, parent_id, dbfile.id)
         dblink.commit_id = commit_id
-        self.cursor.execute(statement(DBFileLink.__insert__,
-                                      self.db.place_holder),
-                                      (dblink.id, dblink.parent,
-                                       dblink.child, dblink.commit_id))
+        self.file_links.append((dblink.id, dblink.parent, dblink.child,
+                                dblink.commit_id))
 
         return dbfile.id
 
     def __add_new_copy(self, dbfilecopy):
-        self.cursor.execute(statement(DBFileCopy.__insert__,
-                                      self.db.place_holder),
-                             (dbfilecopy.id,
-                              dbfilecopy.to_id,
-                              dbfilecopy.from_id,
-                              dbfilecopy.from_commit,
-                              dbfilecopy.new_file_name,
-                              dbfilecopy.action_id))
+        self.file_copies.append((dbfilecopy.id,
+                                 dbfilecopy.to_id,
+                                 dbfilecopy.from_id,
+                                 dbfilecopy.from_commit,
+                                 dbfilecopy.new_file_name,
+                                 dbfilecopy.action_id))
 
     def __get_person(self, person):
         """Get the person_id given a person struct
@@ -252,11 +335,8 @@ class DBContentHandler(ContentHandler):
             rs = cursor.fetchone()
             if not rs:
                 p = DBPerson(None, person)
-
-                cursor.execute(statement(DBPerson.__insert__,
-                                self.db.place_holder),
-                                (p.id, to_utf8(p.name).decode("utf-8"),
-                                 email))
+                self.people.append((p.id, to_utf8(p.name).decode("utf-8"),
+                                    email))
                 person_id = p.id
             else:
                 person_id = rs[0]
@@ -296,8 +376,7 @@ class DBContentHandler(ContentHandler):
             rs = cursor.fetchone()
             if not rs:
                 b = DBBranch(None, branch)
-                cursor.execute(statement(DBBranch.__insert__,
-                                self.db.place_holder), (b.id, b.name))
+                self.branches.append((b.id, b.name))
                 branch_id = b.id
             else:
                 branch_id = rs[0]
@@ -332,8 +411,7 @@ class DBContentHandler(ContentHandler):
             rs = cursor.fetchone()
             if not rs:
                 t = DBTag(None, tag)
-                cursor.execute(statement(DBTag.__insert__,
-                                self.db.place_holder), (t.id, t.name))
+                self.tags.append((t.id, t.name))
                 tag_id = t.id
             else:
                 tag_id = rs[0]
@@ -520,10 +598,8 @@ class DBContentHandler(ContentHandler):
             parent_id = new_parent_id
             dblink = DBFileLink(None, parent_id, file_id)
             dblink.commit_id = log.id
-            self.cursor.execute(statement(DBFileLink.__insert__,
-                                 self.db.place_holder),
-                                (dblink.id, dblink.parent, dblink.child,
-                                 dblink.commit_id))
+            self.file_links.append((dblink.id, dblink.parent, dblink.child,
+                                    dblink.commit_id))
             self.moves_cache[path] = old_path
 
         self.file_cache[path] = (file_id, parent_id)
@@ -660,8 +736,16 @@ class DBContentHandler(ContentHandler):
 
         self.commits.append(log)
 
+        if commit.branch is not None:
+            # Commits are inserted from the oldest to the newest one
+            self.heads[self.__get_branch(commit.branch)] = (commit.revision,
+                                                            log.id)
+
         printdbg("DBContentHandler: commit: %d rev: %s", (log.id, log.rev))
 
+        # Lines added and removed by file
+        file_lines = {}
+
         # TODO: sort actions? R, A, D, M, V, C
         for action in commit.actions:
             printdbg("DBContentHandler: Action: %s", (action.type,))
@@ -708,18 +792,25 @@ class DBContentHandler(ContentHandler):
             dbaction.file_id = file_id
             self.actions.append(dbaction)
 
+            if action.added is not None:
+                added, removed = file_lines.get(file_id, (0, 0))
+                file_lines[file_id] = (added + action.added,
+                                       removed + action.removed)
+
+        if commit.added is not None:
+            self.commits_lines.append((log.id, commit.added, commit.removed))
+            self.patch_lines.extend([(file_id, log.id, added, removed)
+                                     for file_id, (added, removed) in \
+                                     file_lines.items()])
+
         # Tags
         if commit.tags is not None:
-            tag_revs = []
             for tag in commit.tags:
                 tag_id = self.__get_tag(tag)
                 db_tagrev = DBTagRev(None)
-                tag_revs.append((db_tagrev.id, tag_id, log.id))
-
-            self.cursor.executemany(statement(DBTagRev.__insert__,
-                                              self.db.place_holder), tag_revs)
+                self.tag_revs.append((db_tagrev.id, tag_id, log.id))
 
-        if len(self.actions) >= self.MAX_ACTIONS:
+        if len(self.actions) >= self.max_actions:
             printdbg("DBContentHandler: %d actions inserting",
                      (len(self.actions),))
             self.__insert_many()
@@ -731,6 +822,7 @@ class DBContentHandler(ContentHandler):
         # flush pending inserts
         printdbg("DBContentHandler: flushing pending inserts")
         self.__insert_many()
+        self.__update_branch_heads()
 
         # Save the caches to disk
         profiler_start("Saving caches to disk")
@@ -743,8 +835,10 @@ class DBContentHandler(ContentHandler):
 
 if __name__ == '__main__':
     import sys
-    from io import BytesIO
-    from Database import create_database, ICursor
+    from Database import create_database
+    from ParserFactory import create_parser_from_logfile
+    from Log import LogReader
+    from DBProxyContentHandler import DBProxyContentHandler
 
     uri = "http://svn.test-cvsanaly.org/svn/test"
 
@@ -770,25 +864,14 @@ if __name__ == '__main__':
     cursor.close()
     cnn.commit()
 
-    ch = DBContentHandler(db)
-    ch.begin()
-    ch.repository(uri)
-
-    # We need to split the query to save memory
-    icursor = ICursor(cnn.cursor(), 100)
-    icursor.execute(statement("SELECT object from _temp_log order by id desc",
-                                self.db.place_holder))
-    rs = icursor.fetchmany()
-    while rs:
-        for t in rs:
-            obj = t[0]
-            io = BytesIO(obj)
-            commit = load(io)
-            io.close()
-            ch.commit(commit)
-
-        rs = icursor.fetchmany()
-
-    ch.end()
-    icursor.close()
+    parser = create_parser_from_logfile(sys.argv[2])
+    # No repository object is needed to parse a log file
+    parser.repo_uri = uri
+    parser.set_content_handler(DBProxyContentHandler(db))
+
+    reader = LogReader()
+    reader.set_logfile(sys.argv[2])
+    reader.start(lambda line, p: p.feed(line), parser)
+    parser.end()
+
     cnn.close()
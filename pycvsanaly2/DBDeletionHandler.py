@@ -99,6 +99,8 @@ class DBDeletionHandler(object):
                                                  FROM scmlog s
                                                  WHERE s.repository_id = ?)
                           """),
+            ("branch heads", """DELETE FROM branch_heads
+                               WHERE repository_id = ?"""),
             ("files", """DELETE FROM files WHERE repository_id = ?"""),
             ("commit log", """DELETE FROM scmlog WHERE repository_id = ?"""),
             ("repository", """DELETE FROM repositories WHERE id = ?""")
@@ -19,78 +19,58 @@
 
 from ContentHandler import ContentHandler
 from DBContentHandler import DBContentHandler
-from DBTempLog import DBTempLog
-from AsyncQueue import AsyncQueue, TimeOut
+from TempLog import TempLog
 from utils import printdbg
-import threading
 
 
 class DBProxyContentHandler(ContentHandler):
 
-    def __init__(self, db):
+    def __init__(self, db, lock=None):
         ContentHandler.__init__(self)
 
         self.db = db
+        # Held while commits are inserted, when several processes
+        # are writing to the same database
+        self.lock = lock
         self.templog = None
         self.order = ContentHandler.ORDER_REVISION
         self.repo_uri = None
 
         self.db_handler = DBContentHandler(db)
 
+    def __acquire(self):
+        if self.lock is not None:
+            self.lock.acquire()
+
+    def __release(self):
+        if self.lock is not None:
+            self.lock.release()
+
     def begin(self, order=None):
-        self.templog = DBTempLog(self.db)
         if order is not None:
             self.order = order
 
+        self.templog = TempLog()
+
     def repository(self, uri):
         self.repo_uri = uri
 
     def commit(self, commit):
         self.templog.insert(commit)
 
-    def __reader(self, templog, queue):
-        def commit_cb(item):
-            queue.put(item)
-
-        printdbg("DBProxyContentHandler: thread __reader started")
-        templog.foreach(commit_cb, self.order)
-        printdbg("DBProxyContentHandler: thread __reader finished")
-
     def end(self):
-        # The log is now in the temp table
+        # The log is now in the temp log
         # Retrieve the data now and pass it to
         # the real content handler
-
-        self.templog.flush()
-        printdbg("DBProxyContentHandler: parsing finished, creating thread")
-
-        self.db_handler.begin()
-        self.db_handler.repository(self.repo_uri)
-
-        queue = AsyncQueue(50)
-        reader_thread = threading.Thread(target=self.__reader,
-                                          args=(self.templog, queue))
-        reader_thread.setDaemon(True)
-        reader_thread.start()
-
-        # Use the queue with mutexes while the
-        # thread is alive
-        while reader_thread.isAlive():
-            try:
-                item = queue.get(1)
-            except TimeOut:
-                continue
-            printdbg("DBProxyContentHandler: commit: %s", (item.revision,))
-            self.db_handler.commit(item)
-            del item
-
-        # No threads now, we don't need locks
-        printdbg("DBProxyContentHandler: thread __reader is finished, " + \
-                 "continue without locks")
-        while not queue.empty_unlocked():
-            item = queue.get_unlocked()
-            self.db_handler.commit(item)
-            del item
-
-        self.db_handler.end()
+        printdbg("DBProxyContentHandler: parsing finished, " + \
+                 "reading the temp log")
+
+        self.__acquire()
+        try:
+            self.db_handler.begin()
+            self.db_handler.repository(self.repo_uri)
+            self.templog.foreach(self.db_handler.commit, self.order)
+            self.db_handler.end()
+        finally:
+            self.__release()
         self.templog.clear()
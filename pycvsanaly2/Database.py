@@ -18,6 +18,9 @@
 #       Carlos Garcia Campos <carlosgc@gsyc.escet.urjc.es>
 
 from utils import to_utf8, printdbg, printerr
+from time import time
+import os
+import threading
 
 
 class DBRepository(object):
@@ -233,6 +236,31 @@ class DBTagRev(object):
         self.commit_id = None
 
 
+class DBBranchHead(object):
+
+    # Last commit mined in every branch of a repository,
+    # used to read only the new commits in incremental mode
+    __insert__ = """INSERT INTO branch_heads (repository_id, branch_id, rev,
+                    commit_id) values (?, ?, ?, ?)"""
+
+    __delete__ = """DELETE FROM branch_heads
+                    where repository_id = ? and branch_id = ?"""
+
+
+class DBCommitLines(object):
+
+    # The id is given by the database, the rows are written both
+    # while parsing the log and by CommitsLOC
+    __insert__ = """INSERT INTO commits_lines (commit_id, added, removed)
+                    values (?, ?, ?)"""
+
+
+class DBPatchLines(object):
+
+    __insert__ = """INSERT INTO patch_lines (file_id, commit_id, added,
+                    removed) values (?, ?, ?, ?)"""
+
+
 def initialize_ids(db, cursor):
     # Repositories
     cursor.execute(statement("SELECT max(id) from repositories",
@@ -387,6 +415,133 @@ class ICursor(object):
         self.cursor.close()
 
 
+class KeysetCursor(ICursor):
+    """Iterates a query in chunks using keyset pagination.
+
+       Instead of re-running the query with an increasing OFFSET, every
+       chunk is requested with a condition that starts right after the last
+       row already fetched, so the cost of each chunk doesn't depend on its
+       position in the result set.
+
+       keys is a list of the columns the rows are ordered by, optionally
+       followed by ' desc'. They must identify a row uniquely and have to
+       be the first columns of the select list, in the same order. The
+       query must end with its where clause (no order by nor limit).
+    """
+
+    def __init__(self, cursor, keys, size=100, place_holder="?"):
+        ICursor.__init__(self, cursor, size)
+        self.place_holder = place_holder
+        self.keys = []
+        for key in keys:
+            tokens = key.split()
+            self.keys.append((tokens[0],
+                              len(tokens) > 1 and tokens[1].lower() == 'desc'))
+        self.last = None
+
+    def __condition(self):
+        # (k1 > ?) or (k1 = ? and k2 > ?) or ...
+        conditions = []
+        args = []
+        for i, (column, desc) in enumerate(self.keys):
+            terms = ["%s = ?" % (c,) for c, d in self.keys[:i]]
+            terms.append("%s %s ?" % (column, desc and "<" or ">"))
+            conditions.append("(" + " and ".join(terms) + ")")
+            args.extend(self.last[:i + 1])
+
+        condition = "(" + " or ".join(conditions) + ")"
+        return statement(condition, self.place_holder), args
+
+    def __execute(self):
+        q = self.query
+        args = list(self.args or [])
+        if self.last is not None:
+            condition, cargs = self.__condition()
+            q += " and " + condition
+            args.extend(cargs)
+
+        order = ", ".join(["%s%s" % (c, d and " desc" or "")
+                           for c, d in self.keys])
+        q = "%s order by %s LIMIT %d" % (q, order, self.interval_size)
+
+        printdbg(q)
+
+        if args:
+            self.cursor.execute(q, args)
+        else:
+            self.cursor.execute(q)
+
+    def execute(self, query, args=None):
+        self.query = query
+        self.args = args
+        self.last = None
+        self.need_exec = True
+
+    def fetchmany(self):
+        if not self.need_exec:
+            return []
+
+        self.__execute()
+        rs = self.cursor.fetchall()
+        if len(rs) < self.interval_size:
+            self.need_exec = False
+        else:
+            self.last = tuple(rs[-1][:len(self.keys)])
+
+        return rs
+
+
+class BatchInsert(object):
+    """Buffers the rows of an insert statement and writes them with
+       executemany, committing after every write. Rows are added in
+       groups (the rows of a patch, for instance) that are committed
+       together: at the end of every group, the rows are written when
+       there are size of them or, with interval, when the last commit
+       is older than interval seconds. Errors writing the rows are
+       raised as exception.
+    """
+
+    def __init__(self, cnn, cursor, query, size=1000, interval=None,
+                 exception=Exception):
+        self.cnn = cnn
+        self.cursor = cursor
+        self.query = query
+        self.size = size
+        self.interval = interval
+        self.exception = exception
+        self.rows = []
+        self.last_commit = time()
+
+    def add(self, row):
+        self.rows.append(row)
+
+    def end_group(self):
+        if len(self.rows) >= self.size or \
+           (self.interval is not None and \
+            time() - self.last_commit >= self.interval):
+            self.flush()
+
+    def flush(self):
+        try:
+            if self.rows:
+                self.cursor.executemany(self.query, self.rows)
+                self.rows = []
+            self.cnn.commit()
+        except Exception, e:
+            raise self.exception(e)
+        self.last_commit = time()
+
+
+def insert_ignore(db, query):
+    """Returns the insert query skipping the rows that are already
+       there (duplicate keys) on MySQL, like execute_statement does
+       for single rows"""
+    if isinstance(db, MysqlDatabase):
+        return query.replace("INSERT INTO", "INSERT IGNORE INTO", 1) \
+                    .replace("insert into", "insert ignore into", 1)
+    return query
+
+
 class Database(object):
     '''CVSAnaly Database'''
 
@@ -395,9 +550,65 @@ class Database(object):
     def __init__(self, database):
         self.database = database
 
+        # Connections reused by every thread
+        self.__pool = threading.local()
+        # (pid, connection) of every connection in the pool, so they can
+        # be closed from any thread. close_connections bumps the
+        # generation, so the threads connect again
+        self.__connections = []
+        self.__generation = 0
+        self.__lock = threading.Lock()
+
     def connect(self):
         raise NotImplementedError
 
+    def _connect_pooled(self):
+        """Connects for get_connection, the connection may be
+           closed by a thread other than the one using it"""
+        return self.connect()
+
+    def get_connection(self):
+        """Returns a connection for the calling thread, created the
+           first time and reused by the next calls, for the short
+           queries that would otherwise connect every time. SQLite
+           keeps the statements compiled in the connection, so they
+           are prepared only once too.
+
+           It must not be closed, use close_connections instead.
+        """
+        # Connections inherited from the parent process can't be used
+        key = (os.getpid(), self.__generation)
+        if getattr(self.__pool, 'key', None) != key:
+            cnn = self._connect_pooled()
+            self.__lock.acquire()
+            try:
+                self.__connections.append((key[0], cnn))
+            finally:
+                self.__lock.release()
+            self.__pool.key = key
+            self.__pool.cnn = cnn
+
+        return self.__pool.cnn
+
+    def close_connections(self):
+        """Closes the connections returned by get_connection in every
+           thread of this process. The threads must not be using them
+           anymore, they get a new one the next time"""
+        pid = os.getpid()
+        self.__lock.acquire()
+        try:
+            connections = self.__connections
+            # The ones inherited from the parent process are left alone
+            self.__connections = [(p, cnn) for p, cnn in connections
+                                  if p != pid]
+            self.__generation += 1
+        finally:
+            self.__lock.release()
+
+        for p, cnn in connections:
+            if p == pid:
+                cnn.close()
+
     def _create_views(self, cursor):
         view = """CREATE VIEW action_files AS
                   SELECT a.file_id as file_id, a.id as action_id,
@@ -426,6 +637,11 @@ class SqliteDatabase(Database):
 
         return db.connect(self.database, 30)
 
+    def _connect_pooled(self):
+        import sqlite3.dbapi2 as db
+
+        return db.connect(self.database, 30, check_same_thread=False)
+
     def _create_views(self, cursor):
         Database._create_views(self, cursor)
         view = """create view actions_file_names as
@@ -518,6 +734,53 @@ class SqliteDatabase(Database):
         except:
             raise
 
+        self.create_branch_heads_table(cursor)
+
+    def create_branch_heads_table(self, cursor):
+        import sqlite3.dbapi2
+
+        try:
+            cursor.execute("""CREATE TABLE branch_heads (
+                            repository_id integer,
+                            branch_id integer,
+                            rev varchar,
+                            commit_id integer,
+                            primary key (repository_id, branch_id)
+                            )""")
+        except sqlite3.dbapi2.OperationalError as e:
+            printdbg("Exception creating SQLite tables: " + str(e))
+            raise TableAlreadyExists
+
+    def create_commits_lines_table(self, cursor):
+        import sqlite3.dbapi2
+
+        try:
+            cursor.execute("""CREATE TABLE commits_lines (
+                            id integer primary key,
+                            commit_id integer unique,
+                            added integer,
+                            removed integer
+                            )""")
+        except sqlite3.dbapi2.OperationalError as e:
+            printdbg("Exception creating SQLite tables: " + str(e))
+            raise TableAlreadyExists
+
+    def create_patch_lines_table(self, cursor):
+        import sqlite3.dbapi2
+
+        try:
+            cursor.execute("""CREATE TABLE patch_lines (
+                            id integer primary key AUTOINCREMENT,
+                            commit_id integer NOT NULL,
+                            file_id integer NOT NULL,
+                            added integer,
+                            removed integer,
+                            UNIQUE(commit_id, file_id)
+                            )""")
+        except sqlite3.dbapi2.OperationalError as e:
+            printdbg("Exception creating SQLite tables: " + str(e))
+            raise TableAlreadyExists
+
     def to_binary(self, data):
         import sqlite3.dbapi2
 
@@ -671,6 +934,78 @@ class MysqlDatabase(Database):
         except:
             raise
 
+        self.create_branch_heads_table(cursor)
+
+    def create_branch_heads_table(self, cursor):
+        import MySQLdb
+
+        try:
+            cursor.execute("""CREATE TABLE branch_heads (
+                            repository_id INT,
+                            branch_id INT,
+                            rev mediumtext,
+                            commit_id INT,
+                            PRIMARY KEY (repository_id, branch_id)
+                            -- FOREIGN KEY (repository_id)
+                            --    REFERENCES repositories(id),
+                            -- FOREIGN KEY (branch_id) REFERENCES branches(id),
+                            -- FOREIGN KEY (commit_id) REFERENCES scmlog(id)
+                            ) CHARACTER SET=utf8 ENGINE=MyISAM""")
+        except MySQLdb.OperationalError, e:
+            if e.args[0] == 1050:
+                raise TableAlreadyExists
+            else:
+                raise DatabaseException(str(e))
+
+    def create_commits_lines_table(self, cursor):
+        import MySQLdb
+
+        try:
+            cursor.execute("""CREATE TABLE commits_lines (
+                            id INT NOT NULL auto_increment primary key,
+                            commit_id integer unique,
+                            added int,
+                            removed int
+                            -- FOREIGN KEY (commit_id)
+                            --    REFERENCES scmlog(id)
+                            ) CHARACTER SET=utf8""")
+        except MySQLdb.OperationalError, e:
+            if e.args[0] == 1050:
+                self.__upgrade_commits_lines_table(cursor)
+                raise TableAlreadyExists
+            else:
+                raise DatabaseException(str(e))
+
+    def __upgrade_commits_lines_table(self, cursor):
+        # Tables created by older versions get the ids from the
+        # application instead of auto_increment
+        cursor.execute("""SELECT extra from information_schema.columns
+                          where table_schema = database() and
+                          table_name = 'commits_lines' and
+                          column_name = 'id'""")
+        row = cursor.fetchone()
+        if row is not None and 'auto_increment' not in row[0].lower():
+            cursor.execute("""ALTER TABLE commits_lines
+                              MODIFY id INT NOT NULL auto_increment""")
+
+    def create_patch_lines_table(self, cursor):
+        import MySQLdb
+
+        try:
+            cursor.execute("""CREATE TABLE patch_lines (
+                            id integer primary key auto_increment,
+                            commit_id integer NOT NULL,
+                            file_id integer NOT NULL,
+                            added int,
+                            removed int,
+                            UNIQUE(commit_id, file_id)
+                            ) CHARACTER SET=utf8""")
+        except MySQLdb.OperationalError, e:
+            if e.args[0] == 1050:
+                raise TableAlreadyExists
+            else:
+                raise DatabaseException(str(e))
+
 
 # TODO
 # class CAPostgresDatabase (CADatabase):
@@ -753,6 +1088,21 @@ def get_repo_id(uri, cursor, db):
 
     return cursor.fetchone()[0]
 
+
+def get_branch_heads(cursor, db, repo_id):
+    """Return the revisions of the branch heads mined in the previous run
+       for a repository, an empty list if they are unknown"""
+    try:
+        cursor.execute(statement("""SELECT rev from branch_heads
+                                    where repository_id = ?""",
+                                 db.place_holder), (repo_id,))
+    except Exception, e:
+        # Databases created by older versions don't have the table
+        printdbg("Couldn't get the branch heads: %s", (str(e),))
+        return []
+
+    return [rev for rev, in cursor.fetchall()]
+
 if __name__ == '__main__':
     db = create_database('sqlite', '/tmp/foo.db')
 
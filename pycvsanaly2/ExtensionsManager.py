@@ -39,9 +39,13 @@ class InvalidDependency(ExtensionException):
        
 class ExtensionsManager(object):
 
-    def __init__(self, exts, hard_order=False):
+    def __init__(self, exts, hard_order=False, locks=None):
         self.exts = {}
         self.hard_order = hard_order
+        # Optional dict of locks by extension name, used to make sure
+        # that an extension doesn't run at the same time in several
+        # processes writing to the same database
+        self.locks = locks or {}
         order = 0
 
         for ext in exts:
@@ -67,17 +71,24 @@ class ExtensionsManager(object):
                             raise InvalidDependency(ext, dep)
                         
     def run_extension(self, name, extension, repo, uri, db):
+        lock = self.locks.get(name)
+
         # Trim off the ordering numeral before printing
         if self.hard_order:
             name = name[1:]
             
         printout("Executing extension %s", (name,))
         
+        if lock is not None:
+            lock.acquire()
         try:
             extension.run(repo, uri, db)
         except ExtensionRunError, e:
             printerr("Error running extension %s: %s", (name, str(e)))
             return False
+        finally:
+            if lock is not None:
+                lock.release()
 
         return True
     
@@ -23,7 +23,7 @@ import datetime
 
 from Parser import Parser
 from Repository import Commit, Action, Person
-from utils import printout, printdbg
+from utils import printout, printdbg, printerr
 from Config import Config
 
 
@@ -95,6 +95,9 @@ class GitParser(Parser):
                                   " \d{4}) ([+-]\d{4})$")
     patterns['file'] = re.compile("^[ACDMRTUXB]{0,1}([MADT])[ \t]+(.*)$")
     patterns['file-moved'] = re.compile("^[ACDMRTUXB]{0,1}([RC])[0-9]+[ \t]+(.*)[ \t]+(.*)$")
+    patterns['raw'] = re.compile("^:+(?:[0-7]{6} )+(?:[0-9a-f]+\.* )+" + \
+                                 "([ACDMRTUXB]+[0-9]*\t.*)$")
+    patterns['numstat'] = re.compile("^(\d+|-)\t(\d+|-)\t(.*)$")
     patterns['branch'] = re.compile("refs/remotes/([^,]*)/([^,]*)")
     patterns['local-branch'] = re.compile("refs/heads/([^,]*)")
     patterns['replace-commit'] = re.compile("refs/replace/([a-f|0-9]{40})")
@@ -108,12 +111,22 @@ class GitParser(Parser):
         Parser.__init__(self)
 
         self.is_gnome = None
+        # git log --raw --numstat -w, lines added and removed
+        self.numstat = False
 
         # Parser context
         self.commit = None
+        self.is_merge = False
+        # Actions of the commit by path, for the numstat lines
+        self.numstat_actions = None
         self.branch = None
         self.branches = []
 
+    def set_numstat(self, numstat):
+        """The log is read with --raw --numstat -w, every commit gets
+           the lines added and removed, even if there are none"""
+        self.numstat = numstat
+
     def set_repository(self, repo, uri):
         Parser.set_repository(self, repo, uri)
         self.is_gnome = re.search("^[a-z]+://(.*@)?git\.gnome\.org/.*$",
@@ -125,6 +138,60 @@ class GitParser(Parser):
             self.branch = None
             self.branches = None
 
+    def __numstat(self, match):
+        # Merges (-c) get a numstat against the first parent only, which
+        # doesn't match the combined file list. Like git log --shortstat
+        # does, no lines are counted for them
+        if self.is_merge:
+            return
+
+        # Binary files are - -
+        added = removed = 0
+        if match.group(1) != '-':
+            added = int(match.group(1))
+            removed = int(match.group(2))
+
+        if self.commit.added is None:
+            self.commit.added = self.commit.removed = 0
+        self.commit.added += added
+        self.commit.removed += removed
+
+        # Numstat lines come after the raw ones of the commit
+        if self.numstat_actions is None:
+            self.numstat_actions = {}
+            for action in self.commit.actions:
+                self.numstat_actions.setdefault(action.f1, action)
+
+        path = match.group(3)
+        action = self.numstat_actions.get(path)
+        if action is None:
+            action = self.numstat_actions.get(self.__numstat_path(path))
+        if action is None:
+            printerr("Numstat line for an unknown file in commit %s: %s",
+                     (self.commit.revision, path))
+            return
+
+        if action.added is None:
+            action.added = action.removed = 0
+        action.added += added
+        action.removed += removed
+
+    def __numstat_path(self, path):
+        # Renamed and copied files are "old => new", or with the
+        # common parts out of braces "dir/{old => new}/file"
+        start = path.find('{')
+        arrow = path.find(' => ', start + 1)
+        end = path.find('}', arrow + 1)
+        if start >= 0 and arrow >= 0 and end >= 0:
+            path = path[:start] + path[arrow + 4:end] + path[end + 1:]
+            return path.replace('//', '/')
+
+        arrow = path.find(' => ')
+        if arrow >= 0:
+            return path[arrow + 4:]
+
+        return path
+
     def _parse_line(self, line):
         if line is None or line == '':
             return
@@ -150,10 +217,14 @@ class GitParser(Parser):
 
             self.commit = Commit()
             self.commit.revision = match.group(1)
+            if self.numstat:
+                self.commit.added = self.commit.removed = 0
 
             parents = match.group(3)
             if parents:
                 parents = parents.split()
+            self.is_merge = parents is not None and len(parents) > 1
+            self.numstat_actions = None
             git_commit = self.GitCommit(self.commit, parents)
 
             # If a specific branch has been configured, there
@@ -299,6 +370,18 @@ class GitParser(Parser):
 
             return
 
+        # Raw file (--raw), same status and paths as --name-status
+        match = self.patterns['raw'].match(line)
+        if match:
+            line = match.group(1)
+
+        # Lines added and removed (--numstat)
+        match = self.patterns['numstat'].match(line)
+        if match:
+            self.__numstat(match)
+
+            return
+
         # File
         match = self.patterns['file'].match(line)
         if match:
@@ -17,10 +17,13 @@
 # Authors :
 #       Carlos Garcia Campos <carlosgc@gsyc.escet.urjc.es>
 
+import os
 import threading
 from repositoryhandler.backends.watchers import LOG
 from AsyncQueue import AsyncQueue, TimeOut
-from utils import printerr
+from Command import Command, CommandError
+from FindProgram import find_program
+from utils import printerr, printout
 
 
 class RepoOrLogfileRequired(Exception):
@@ -34,6 +37,8 @@ class LogReader(object):
         self.repo = None
         self.uri = None
         self.branch = None
+        self.heads = []
+        self.numstat = False
 
     def set_repo(self, repo, uri=None):
         self.repo = repo
@@ -46,6 +51,16 @@ class LogReader(object):
     def set_branch(self, branch):
         self.branch = branch
 
+    def set_numstat(self, numstat):
+        """Also read the lines added and removed by every commit and
+           file (git log --numstat), only for local Git repositories"""
+        self.numstat = numstat
+
+    def set_known_heads(self, heads):
+        """Only read the commits that are not reachable from the given
+           revisions, the branch heads mined in a previous run"""
+        self.heads = heads
+
     def _read_from_logfile(self, new_line_cb, user_data):
         try:
             f = open(self.logfile, 'r')
@@ -88,18 +103,91 @@ class LogReader(object):
             line = queue.get_unlocked()
             new_line_cb(line, user_data)
         
+    def _is_git_checkout(self):
+        return self.repo.get_type() == 'git' and self.uri is not None and \
+               os.path.isdir(self.uri)
+
+    def _can_read_new_commits(self):
+        if not self.heads:
+            return False
+
+        if not self._is_git_checkout():
+            printout("Reading only the new commits is not supported " + \
+                     "for this repository, reading the whole log")
+            return False
+
+        return True
+
+    def reads_numstat(self):
+        """Whether the log is read with the lines added and removed,
+           set_numstat was given and the repository is a local Git
+           repository, with no logfile"""
+        return self.numstat and self.logfile is None and \
+               self.repo is not None and self._is_git_checkout()
+
+    def _can_read_numstat(self):
+        if not self.numstat:
+            return False
+
+        if not self.reads_numstat():
+            printout("Getting the lines added and removed from the log " + \
+                     "is only supported for local Git repositories")
+            return False
+
+        return True
+
+    def _read_from_git(self, new_line_cb, user_data, heads=None):
+        def new_line(line):
+            new_line_cb(line, user_data)
+
+        # Same options used by the git backend. With numstat, --raw
+        # gives the same status and paths as --name-status, which
+        # can't be combined with --numstat, and -w ignores whitespace
+        # changes like CommitsLOC and PatchLOC do. With heads, instead
+        # of --all the range last..HEAD for every branch
+        cmd = [find_program('git') or 'git', 'log', '--topo-order',
+               '--pretty=fuller', '--parents']
+        if self.numstat:
+            cmd.extend(['--raw', '--numstat', '-w'])
+        else:
+            cmd.append('--name-status')
+        cmd.extend(['-M', '-C', '-c', '--decorate=full'])
+        if self.branch is not None:
+            cmd.append(self.branch)
+        else:
+            cmd.append('--all')
+        if heads:
+            cmd.extend(['^' + rev for rev in heads])
+
+        Command(cmd, self.uri).run(parser_out_func=new_line)
+
     def start(self, new_line_cb, user_data=None):
         if self.logfile is not None:
             try:
                 self._read_from_logfile(new_line_cb, user_data)
             except IOError, e:
                 printerr(str(e))
-        elif self.repo is not None:
-            self._read_from_repository(new_line_cb, user_data)
-        else:
+            return
+
+        if self.repo is None:
             raise RepoOrLogfileRequired("In order to start the log reader " + \
                     "a repository or a logfile has to be provided")
 
+        if self._can_read_new_commits():
+            try:
+                self._read_from_git(new_line_cb, user_data, self.heads)
+                return
+            except CommandError, e:
+                # Most likely a head that doesn't exist anymore
+                # (rewritten history), git fails before any output
+                printerr("Error reading the new commits: %s", (e.error,))
+                printout("Reading the whole log")
+
+        if self._can_read_numstat():
+            self._read_from_git(new_line_cb, user_data)
+        else:
+            self._read_from_repository(new_line_cb, user_data)
+
 
 class LogWriter(object):
 
@@ -20,7 +20,7 @@
 # newer version from Bazaar without careful inspection.
 
 import re
-from pycvsanaly2.utils import printerr
+from pycvsanaly2.utils import printerr, printdbg
 
 
 binary_files_re = 'Binary files (.*) and (.*) differ\n'
@@ -114,9 +114,12 @@ def parse_range(textrange):
     return (pos, range)
 
 
-def hunk_from_header(line):
-    import re
+def parse_hunk_header(line):
+    """Parse a hunk header line without building the Hunk
 
+    :return: orig_pos, orig_range, mod_pos, mod_range and tail
+    :rtype: (int, int, int, int, str)
+    """
     matches = re.match(r'\@\@\@? ([^@]*) \@\@\@?( (.*))?\n', line)
     if matches is None:
         raise MalformedHunkHeader("Does not match format.", line)
@@ -134,7 +137,11 @@ def hunk_from_header(line):
     if mod_range < 0 or orig_range < 0:
         raise MalformedHunkHeader("Hunk range is negative", line)
     tail = matches.group(3)
-    return Hunk(orig_pos, orig_range, mod_pos, mod_range, tail)
+    return (orig_pos, orig_range, mod_pos, mod_range, tail)
+
+
+def hunk_from_header(line):
+    return Hunk(*parse_hunk_header(line))
 
 
 class HunkLine(object):
@@ -542,3 +549,218 @@ def iter_patched_from_hunks(orig_lines, hunks):
     if orig_lines is not None:
         for line in orig_lines:
             yield line
+
+
+# The scanner below reads the text of a patch in place, by offsets,
+# without building the lines, hunks and patches of parse_patches. It
+# gives the same results as parsing the lines of the text that aren't
+# empty with parse_patches(lines, allow_dirty=True, allow_continue=True)
+
+_binary_files = re.compile(binary_files_re)
+_no_nl = NO_NL[:-1]
+
+
+def _get_line(text, start, end, nl=True):
+    if nl:
+        return text[start:end] + "\n"
+    return text[start:end]
+
+
+def _iter_file_spans(text):
+    """Like iter_file_patch, yields the lines of every file patch
+       in text, as a flat list of start and end offsets"""
+    spans = []
+    size = len(text)
+    orig_range = 0
+    beginning = True
+    start = 0
+    while start < size:
+        end = text.find("\n", start)
+        if end < 0:
+            end = size
+        if end == start:
+            start += 1
+            continue
+
+        first = text[start]
+        if first == '#' or text.startswith('=== ', start, end) or \
+           text.startswith('*** ', start, end):
+            start = end + 1
+            continue
+        elif orig_range > 0:
+            if first == '-' or first == ' ':
+                orig_range -= 1
+        elif text.startswith('--- ', start, end) or \
+             (text.startswith('Binary files ', start, end) and
+              _binary_files.match(_get_line(text, start, end))):
+            if beginning:
+                beginning = False
+            elif spans:
+                yield spans
+            spans = []
+        elif first == '@' and text.startswith('@@', start, end):
+            try:
+                orig_range = parse_hunk_header(_get_line(text, start, end))[1]
+            except MalformedHunkHeader:
+                printerr("\nError: MalformedHunkHeader; Probably merge commit. Skipping.")
+                start = end + 1
+                continue
+        spans.append(start)
+        spans.append(end)
+        start = end + 1
+
+    if spans:
+        yield spans
+
+
+def _iter_spans_handle_nl(text, spans):
+    """Like iter_lines_handle_nl, yields (start, end, nl) for the
+       lines of a file patch, nl being False for the lines followed
+       by NO_NL"""
+    last = None
+    for i in xrange(0, len(spans), 2):
+        start = spans[i]
+        end = spans[i + 1]
+        if end - start == len(_no_nl) and text.startswith(_no_nl, start, end):
+            if last is None:
+                raise AssertionError()
+            yield (spans[last], spans[last + 1], False)
+            last = None
+        else:
+            if last is not None:
+                yield (spans[last], spans[last + 1], True)
+            last = i
+    if last is not None:
+        yield (spans[last], spans[last + 1], True)
+
+
+def _scan_file_patch(text, spans):
+    """Returns the changed ranges of a file patch, see iter_hunk_ranges.
+       It's empty for binary and malformed patches"""
+    ranges = []
+    lines = _iter_spans_handle_nl(text, spans)
+    try:
+        start, end, nl = lines.next()
+        line = _get_line(text, start, end, nl)
+        if _binary_files.match(line) or not line.startswith("--- "):
+            return []
+        oldname = line[4:].rstrip("\n")
+
+        start, end, nl = lines.next()
+        if not text.startswith("+++ ", start, end):
+            return []
+        newname = _get_line(text, start, end, nl)[4:].rstrip("\n")
+
+        file_name = newname.strip()
+        if file_name == "/dev/null":
+            file_name = oldname.strip()
+
+        for start, end, nl in lines:
+            try:
+                (orig_pos, orig_range, mod_pos, mod_range, tail) = \
+                    parse_hunk_header(_get_line(text, start, end, nl))
+            except MalformedHunkHeader:
+                # Junk at the end of the patch
+                break
+
+            # Each run of removed and/or inserted lines is a change on
+            # its own, as in parseLine of UnifiedDiffParser.java
+            old_start_line = orig_pos - 1
+            new_start_line = mod_pos - 1
+            old_end_line = 0
+            new_end_line = 0
+            added = deleted = in_change = False
+
+            orig_size = 0
+            mod_size = 0
+            while orig_size < orig_range or mod_size < mod_range:
+                try:
+                    start, end, nl = lines.next()
+                except StopIteration:
+                    break
+
+                first = text[start]
+                if first == '-':
+                    orig_size += 1
+                    if not in_change or not deleted:
+                        in_change = True
+                        old_start_line += 1
+                        old_end_line = old_start_line
+                    else:
+                        old_end_line += 1
+                    deleted = True
+                elif first == '+':
+                    mod_size += 1
+                    if not in_change or not added:
+                        in_change = True
+                        new_start_line += 1
+                        new_end_line = new_start_line
+                    else:
+                        new_end_line += 1
+                    added = True
+                elif first == ' ':
+                    orig_size += 1
+                    mod_size += 1
+                    if in_change:
+                        in_change = False
+                        printdbg("Patch new name: " + newname)
+                        change = [file_name, None, None, None, None]
+                        if deleted:
+                            change[1] = old_start_line
+                            change[2] = old_end_line
+                            old_start_line = old_end_line
+                        if added:
+                            change[3] = new_start_line
+                            change[4] = new_end_line
+                            new_start_line = new_end_line
+                        ranges.append(tuple(change))
+                        added = deleted = False
+
+                    old_start_line += 1
+                    new_start_line += 1
+                else:
+                    printerr("\nError: MalformedLine; Probably binary file. Skipping line.")
+
+            # The hunk ended without a new context line
+            if in_change:
+                change = [file_name, None, None, None, None]
+                if deleted:
+                    change[1] = old_start_line
+                    change[2] = old_end_line
+                if added:
+                    change[3] = new_start_line
+                    change[4] = new_end_line
+                ranges.append(tuple(change))
+    except (StopIteration, AssertionError):
+        # Malformed patch, parse_patches would skip it
+        return []
+
+    return ranges
+
+
+def iter_hunk_ranges(text):
+    """Iterates through the changes of the file patches in text.
+
+    :return: file name, old start and end lines and new start and end
+        lines of every run of removed and/or inserted lines. The old or
+        new lines are None when there are none.
+    :rtype: iterator of (str, int, int, int, int)
+    """
+    for spans in _iter_file_spans(text):
+        for change in _scan_file_patch(text, spans):
+            yield change
+
+
+def count_patch_lines(text):
+    """Counts the inserted and removed lines of a patch text, leaving
+    out the ---/+++ headers of the files.
+
+    :return: inserts and removes
+    :rtype: (int, int)
+    """
+    def n_lines(prefix):
+        return text.count("\n" + prefix) + int(text.startswith(prefix))
+
+    inserts = n_lines("+") - n_lines("+++ b/") - n_lines("+++ /dev/null")
+    removes = n_lines("-") - n_lines("--- a/") - n_lines("--- /dev/null")
+    return (inserts, removes)
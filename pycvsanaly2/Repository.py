@@ -27,7 +27,11 @@ class Commit(object):
                          'branch': None,
                          'tags': None,
                          'message': "",
-                         'composed_rev': False}
+                         'composed_rev': False,
+                         # Lines added and removed, when the
+                         # parser can get them from the log
+                         'added': None,
+                         'removed': None}
 
     def __getinitargs__(self):
         return()
@@ -71,7 +75,9 @@ class Action(object):
                          'branch_f2': None,
                          'f1': None,
                          'f2': None,
-                         'rev': None}
+                         'rev': None,
+                         'added': None,
+                         'removed': None}
 
     def __getinitargs__(self):
         return()
@@ -0,0 +1,191 @@
+# Copyright (C) 2008 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Authors :
+#       Carlos Garcia Campos <carlosgc@gsyc.escet.urjc.es>
+
+from ContentHandler import ContentHandler
+from Repository import Commit, Action, Person
+from utils import printdbg, cvsanaly_cache_dir
+
+import os
+import mmap
+import struct
+import marshal
+import calendar
+import datetime
+import tempfile
+from array import array
+
+
+def _person_to_record(person):
+    if person is None:
+        return None
+
+    return (person.name, person.email)
+
+
+def _record_to_person(record):
+    if record is None:
+        return None
+
+    person = Person()
+    person.name, person.email = record
+
+    return person
+
+
+def _date_to_record(date):
+    if date is None:
+        return None
+
+    return (date.year, date.month, date.day, date.hour, date.minute,
+            date.second, date.microsecond)
+
+
+def _record_to_date(record):
+    if record is None:
+        return None
+
+    return datetime.datetime(*record)
+
+
+def commit_to_record(commit):
+    """Serializes a commit into a compact binary string"""
+    actions = [(a.type, a.branch_f1, a.branch_f2, a.f1, a.f2, a.rev,
+                a.added, a.removed) for a in commit.actions]
+
+    return marshal.dumps((commit.revision,
+                          _person_to_record(commit.committer),
+                          _person_to_record(commit.author),
+                          _date_to_record(commit.commit_date),
+                          _date_to_record(commit.author_date),
+                          actions,
+                          commit.branch,
+                          commit.tags,
+                          commit.message,
+                          commit.composed_rev,
+                          commit.added,
+                          commit.removed))
+
+
+def record_to_commit(record):
+    """Builds a commit back from a string created by commit_to_record"""
+    (revision, committer, author, commit_date, author_date, actions,
+     branch, tags, message, composed_rev, added,
+     removed) = marshal.loads(record)
+
+    commit = Commit()
+    commit.revision = revision
+    commit.committer = _record_to_person(committer)
+    commit.author = _record_to_person(author)
+    commit.commit_date = _record_to_date(commit_date)
+    commit.author_date = _record_to_date(author_date)
+    commit.actions = []
+    for (type, branch_f1, branch_f2, f1, f2, rev, action_added,
+         action_removed) in actions:
+        action = Action()
+        action.type = type
+        action.branch_f1 = branch_f1
+        action.branch_f2 = branch_f2
+        action.f1 = f1
+        action.f2 = f2
+        action.rev = rev
+        action.added = action_added
+        action.removed = action_removed
+        commit.actions.append(action)
+    commit.branch = branch
+    commit.tags = tags
+    commit.message = message
+    commit.composed_rev = composed_rev
+    commit.added = added
+    commit.removed = removed
+
+    return commit
+
+
+class TempLog(object):
+    """Append-only file where the commits are stored while the log is
+       being parsed, so that they can be read back in the order the
+       content has to be inserted in the database.
+
+       Every record is the length of the serialized commit followed by
+       the commit itself. Only the offsets (and dates) of the records are
+       kept in memory; the file is mmap'd when it's read back.
+    """
+
+    HEADER = struct.Struct("<I")
+
+    def __init__(self):
+        fd, self.filename = tempfile.mkstemp(prefix="templog-",
+                                             dir=cvsanaly_cache_dir())
+        self.fd = os.fdopen(fd, "w+b")
+        self.offsets = array('L')
+        self.dates = array('d')
+        self.size = 0
+
+        printdbg("TempLog: spilling log to %s", (self.filename,))
+
+    def insert(self, commit):
+        record = commit_to_record(commit)
+
+        self.fd.write(self.HEADER.pack(len(record)))
+        self.fd.write(record)
+
+        self.offsets.append(self.size)
+        if commit.commit_date is None:
+            self.dates.append(float('-inf'))
+        else:
+            self.dates.append(calendar.timegm(commit.commit_date.timetuple()))
+        self.size += self.HEADER.size + len(record)
+
+    def foreach(self, cb, order=None):
+        self.flush()
+
+        if not self.offsets:
+            return
+
+        if order is None or order == ContentHandler.ORDER_REVISION:
+            # The log is parsed from the newest commit to the oldest one
+            indexes = xrange(len(self.offsets) - 1, -1, -1)
+        else:
+            indexes = sorted(xrange(len(self.offsets)),
+                             key=self.dates.__getitem__)
+
+        buf = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for i in indexes:
+                offset = self.offsets[i]
+                length = self.HEADER.unpack_from(buf, offset)[0]
+                offset += self.HEADER.size
+                cb(record_to_commit(buf[offset:offset + length]))
+        finally:
+            buf.close()
+
+    def flush(self):
+        if self.fd is not None:
+            self.fd.flush()
+
+    def clear(self):
+        if self.fd is None:
+            return
+
+        self.fd.close()
+        self.fd = None
+        os.remove(self.filename)
+
+    def __del__(self):
+        self.clear()
@@ -18,12 +18,12 @@
 #       Carlos Garcia Campos  <carlosgc@gsyc.escet.urjc.es>
 
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase, 
-    TableAlreadyExists, statement, ICursor)
+    TableAlreadyExists, statement)
 from pycvsanaly2.extensions import (Extension, register_extension, 
     ExtensionRunError)
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.utils import printdbg, printerr, uri_to_filename, to_utf8
-from FileRevs import FileRevs
+from FileRevs import FileRevs, PendingFileRevs
 from Jobs import JobPool, Job
 from repositoryhandler.backends import RepositoryCommandError
 from repositoryhandler.backends.watchers import BLAME
@@ -126,6 +126,7 @@ class Blame(Extension):
 
     def __init__(self):
         self.db = None
+        self.repoid = None
         self.blames = []
         self.authors = None
         self.id_counter = 1
@@ -174,11 +175,10 @@ class Blame(Extension):
         cnn.commit()
         cursor.close()
 
-    def get_blames(self, cursor, repoid):
+    def get_blames(self, pending):
         query = "select b.file_id, b.commit_id from blame b, files f " + \
                 "where b.file_id = f.id and repository_id = ?"
-        cursor.execute(statement(query, self.db.place_holder), (repoid,))
-        return [(res[0], res[1]) for res in cursor.fetchall()]
+        return pending.fetch_revisions(query)
 
     def __get_authors(self, cursor):
         query = "select id, name from people"
@@ -244,8 +244,6 @@ class Blame(Extension):
         read_cursor = cnn.cursor()
         write_cursor = cnn.cursor()
 
-        blames = []
-
         try:
             path = uri_to_filename(uri)
             if path is not None:
@@ -257,6 +255,7 @@ class Blame(Extension):
                                           "where uri = ?", db.place_holder), 
                                           (repo_uri,))
             repoid = read_cursor.fetchone()[0]
+            self.repoid = repoid
         except NotImplementedError:
             raise ExtensionRunError("Blame extension is not supported for " + \
                                     "%s repositories" % (repo.get_type()))
@@ -278,26 +277,21 @@ class Blame(Extension):
 
         self.__get_authors(read_cursor)
 
-        if self.id_counter > 1:
-            blames = self.get_blames(read_cursor, repoid)
-
         job_pool = JobPool(repo, path or repo.get_uri(), queuesize=100)
 
         # Get code files
-        query = "select f.id from file_types ft, files f " + \
-                "where f.id = ft.file_id and " + \
-                "ft.type in ('code', 'unknown') and " + \
-                "f.repository_id = ?"
-        read_cursor.execute(statement(query, db.place_holder), (repoid,))
-        code_files = [item[0] for item in read_cursor.fetchall()]
+        pending = PendingFileRevs(db, read_cursor, repoid)
+        pending.set_file_types(['code', 'unknown'])
+        if self.id_counter > 1:
+            pending.add_done(self.get_blames(pending))
 
         n_blames = 0
         fr = FileRevs(db, cnn, read_cursor, repoid)
         for revision, commit_id, file_id, action_type, composed in fr:
-            if file_id not in code_files:
+            if not pending.is_wanted(file_id):
                 continue
 
-            if(file_id, commit_id) in blames:
+            if pending.is_done(file_id, commit_id):
                 printdbg("%d@%d is already in the database, skip it", 
                          (file_id, commit_id))
                 continue
@@ -18,7 +18,7 @@
 #       Chris Lewis <cflewis@soe.ucsc.edu>
 
 from pycvsanaly2.extensions import Extension, register_extension, \
-        ExtensionRunError, ExtensionBackoutError
+        ExtensionRunError, ExtensionBackoutError, restrict_to_new_commits
 from pycvsanaly2.Database import SqliteDatabase, MysqlDatabase, \
         TableAlreadyExists, statement, execute_statement, get_repo_id
 from pycvsanaly2.utils import printdbg, printerr, printout, \
@@ -26,10 +26,87 @@ from pycvsanaly2.utils import printdbg, printerr, printout, \
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.Config import Config
 from Progress import Progress
+from collections import deque
+from time import time
+import multiprocessing
 import re
 
+# The bit at the beginning and end matches whitespace, punctuation
+# or the start or end of a line.
+_DELIMITERS = "[\s\.,;\!\?\'\"\/\\\]"
+
+# Compiled patterns, keyed by the regexes and flags they were built from
+_patterns = {}
+
+
+def get_bug_fix_pattern(regexes, flags):
+    """Returns a single compiled pattern matching a string when any
+       of the regexes, surrounded by delimiters, does, or None if
+       there are no regexes"""
+    key = (tuple(regexes), flags)
+    try:
+        return _patterns[key]
+    except KeyError:
+        pass
+
+    if regexes:
+        alternatives = "|".join(["(?:" + r + ")" for r in regexes])
+        pattern = re.compile("(" + _DELIMITERS + "+|^)(?:" + alternatives + \
+                             ")(" + _DELIMITERS + "+|$)", flags)
+    else:
+        pattern = None
+    _patterns[key] = pattern
+
+    return pattern
+
+
+def fixes_bug(commit_message, regexes, regexes_case_sensitive):
+    """Check whether a commit message matches any of the regexes"""
+    for pattern in (get_bug_fix_pattern(regexes, re.DOTALL | re.IGNORECASE),
+                    get_bug_fix_pattern(regexes_case_sensitive, re.DOTALL)):
+        if pattern is None:
+            continue
+
+        match = pattern.search(commit_message)
+        if match is not None:
+            printdbg("[STRING] matched on " + match.group(0) + " " + \
+                     commit_message)
+            return True
+
+    return False
+
+
+def classify_messages(rows, regexes, regexes_case_sensitive):
+    """Returns the (is_bug_fix, id) update arguments for the given
+       (id, message) rows"""
+    updates = []
+    for row_id, commit_message in rows:
+        if fixes_bug(commit_message, regexes, regexes_case_sensitive):
+            updates.append((1, row_id))
+        else:
+            updates.append((0, row_id))
+
+    return updates
+
+
+# Regexes of the worker processes
+_worker_regexes = None
+
+
+def _init_worker(regexes, regexes_case_sensitive):
+    global _worker_regexes
+    _worker_regexes = (regexes, regexes_case_sensitive)
+
+
+def _classify_chunk(rows):
+    return classify_messages(rows, *_worker_regexes)
+
 
 class BugFixMessage(Extension):
+
+    # Number of commit messages classified at a time
+    CHUNK_SIZE = 1000
+
     def __prepare_table(self, connection):
         cursor = connection.cursor()
 
@@ -77,19 +154,6 @@ class BugFixMessage(Extension):
         connection.commit()
         cursor.close()
 
-    def __match_string(self, regexes, flags, string):
-        """Checks whether a string matches a series of regexes"""
-        for r in regexes:
-            # The bit at the beginning and end matches whitespace, punctuation
-            # or the start or end of a line.
-            delimiters = "[\s\.,;\!\?\'\"\/\\\]"
-            if re.search("(" + delimiters + "+|^)" + r + \
-                         "(" + delimiters + "+|$)", string, flags):
-                printdbg("[STRING] matched on " + str(r) + " " + string)
-                return True
-
-        return False
-
     def fixes_bug(self, commit_message):
         """Check whether a commit message indicated a bug was present.
 
@@ -193,15 +257,8 @@ class BugFixMessage(Extension):
         >>> b.fixes_bug("This is for March-28")
         False
         """
-        if self.__match_string(Config().bug_fix_regexes, \
-        re.DOTALL | re.IGNORECASE, commit_message):
-            return True
-
-        if self.__match_string(Config().bug_fix_regexes_case_sensitive, \
-        re.DOTALL, commit_message):
-            return True
-
-        return False
+        return fixes_bug(commit_message, Config().bug_fix_regexes,
+                         Config().bug_fix_regexes_case_sensitive)
 
     def run(self, repo, uri, db):
         # Start the profiler, per every other extension
@@ -228,33 +285,67 @@ class BugFixMessage(Extension):
                     (repo.get_uri(), str(e)))
 
         # Get the commit notes from this repository
-        query = """select s.id, s.message from scmlog s
-            where s.repository_id = ?"""
-        read_cursor.execute(statement(query, db.place_holder), (repo_id,))
+        query, args = restrict_to_new_commits("""select s.id, s.message
+            from scmlog s where s.repository_id = ?""", (repo_id,))
+        read_cursor.execute(statement(query, db.place_holder), args)
         progress = Progress("[Extension BugFixMessage]", read_cursor.rowcount)
 
         self.__prepare_table(connection)
 
-        for row in read_cursor:
-            row_id = row[0]
-            commit_message = row[1]
-
-            update = """update scmlog
-                        set is_bug_fix = ?
-                        where id = ?"""
-
-            if self.fixes_bug(commit_message):
-                is_bug_fix = 1
-            else:
-                is_bug_fix = 0
-
-            execute_statement(statement(update, db.place_holder),
-                              (is_bug_fix, row_id),
-                              write_cursor,
-                              db,
-                              "Couldn't update scmlog",
-                              exception=ExtensionRunError)
-            progress.finished_one()
+        update = statement("""update scmlog
+                              set is_bug_fix = ?
+                              where id = ?""", db.place_holder)
+        regexes = (Config().bug_fix_regexes,
+                   Config().bug_fix_regexes_case_sensitive)
+
+        # Daemonic processes (batch mode workers) can't have children
+        n_processes = min(Config().bug_fix_processes,
+                          multiprocessing.cpu_count())
+        if multiprocessing.current_process().daemon:
+            n_processes = 1
+
+        if n_processes > 1:
+            pool = multiprocessing.Pool(n_processes, _init_worker, regexes)
+        else:
+            pool = None
+
+        # Chunks are read and written here, since the connection can't
+        # be shared, and are classified in the pool. At most
+        # 2 * n_processes chunks are waiting to be written.
+        pending = deque()
+        n_messages = 0
+        start = time()
+        try:
+            rs = read_cursor.fetchmany(self.CHUNK_SIZE)
+            while rs or pending:
+                if rs:
+                    if pool is not None:
+                        pending.append(pool.apply_async(_classify_chunk,
+                                                        (rs,)))
+                    else:
+                        pending.append(classify_messages(rs, *regexes))
+                    rs = read_cursor.fetchmany(self.CHUNK_SIZE)
+
+                if pending and (not rs or len(pending) >= 2 * n_processes):
+                    updates = pending.popleft()
+                    if pool is not None:
+                        updates = updates.get()
+                    try:
+                        write_cursor.executemany(update, updates)
+                    except Exception, e:
+                        raise ExtensionRunError("Couldn't update scmlog: %s" % \
+                                                (str(e),))
+                    n_messages += len(updates)
+                    progress.finished(len(updates))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        elapsed = time() - start
+        printout("[Extension BugFixMessage] %d messages classified " + \
+                 "in %.2f s (%.0f messages/s)",
+                 (n_messages, elapsed, n_messages / max(elapsed, 0.001)))
 
         read_cursor.close()
         connection.commit()
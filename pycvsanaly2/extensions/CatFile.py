@@ -0,0 +1,220 @@
+# Copyright (C) 2008 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, "../../")
+
+from repositoryhandler.backends.watchers import CAT
+from pycvsanaly2.FindProgram import find_program
+from pycvsanaly2.utils import printdbg
+from subprocess import Popen, PIPE
+from io import BytesIO
+from hashlib import sha1
+import threading
+import os
+
+
+class CatFileError(Exception):
+    '''Error getting the contents of a file revision'''
+
+
+class GitCatFile(object):
+    """A git cat-file --batch process, kept alive to get the
+       contents of many file revisions without spawning a
+       process for every one of them. With check, it's a
+       --batch-check process that only gives the blob ids.
+
+       Objects are requested as rev:./path, so paths are relative
+       to the uri the process was created for, like in repo.cat.
+       It must not be shared between threads.
+    """
+
+    def __init__(self, uri, check=False):
+        self.uri = uri
+        self.check = check
+        self.process = None
+
+    def __start(self):
+        git = find_program('git')
+        if git is None:
+            raise CatFileError("Required git command cannot be found in path")
+
+        if self.check:
+            option = '--batch-check'
+        else:
+            option = '--batch'
+
+        printdbg("GitCatFile: starting git cat-file %s for %s",
+                 (option, self.uri))
+        self.process = Popen([git, 'cat-file', option], cwd=self.uri,
+                             stdin=PIPE, stdout=PIPE, bufsize=-1,
+                             close_fds=True)
+
+    def __request(self, path, rev):
+        if '\n' in path:
+            raise CatFileError("Invalid path %s" % (path,))
+
+        if self.process is None or self.process.poll() is not None:
+            self.__start()
+
+        try:
+            self.process.stdin.write("%s:./%s\n" % (rev, path))
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+        except IOError, e:
+            self.close()
+            raise CatFileError("git cat-file died: %s" % (str(e),))
+
+        fields = header.split()
+        if len(fields) != 3:
+            # <object> missing, or the process died
+            if not header:
+                self.close()
+            raise CatFileError("%s@%s not found" % (path, rev))
+
+        data = None
+        if not self.check:
+            data = self.process.stdout.read(int(fields[2]))
+            # Every object is followed by a LF
+            self.process.stdout.read(1)
+
+        if fields[1] != 'blob':
+            raise CatFileError("%s@%s is a %s, not a file" % \
+                               (path, rev, fields[1]))
+
+        return fields[0], data
+
+    def cat(self, path, rev):
+        """Return the contents of path at revision rev"""
+        return self.__request(path, rev)[1]
+
+    def get_blob_id(self, path, rev):
+        """Return the id of the blob of path at revision rev"""
+        return self.__request(path, rev)[0]
+
+    def close(self):
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+        self.process = None
+
+
+# One git cat-file process per thread and uri
+_local = threading.local()
+# (pid, GitCatFile) of every thread, so close_git_cat_files can stop
+# them from any thread. It bumps the generation, so the threads start
+# new ones the next time
+_all = []
+_generation = 0
+_lock = threading.Lock()
+
+
+def _get_git_cat_file(uri, check=False):
+    # Processes inherited from the parent process can't be used
+    key = (os.getpid(), _generation)
+    if getattr(_local, 'key', None) != key:
+        _local.key = key
+        _local.processes = {}
+
+    try:
+        return _local.processes[(uri, check)]
+    except KeyError:
+        git_cat_file = GitCatFile(uri, check)
+        _lock.acquire()
+        try:
+            _all.append((key[0], git_cat_file))
+        finally:
+            _lock.release()
+        _local.processes[(uri, check)] = git_cat_file
+        return git_cat_file
+
+
+def close_git_cat_files():
+    """Stops the git cat-file processes started by this process in
+       every thread. The threads must not be using them anymore,
+       extensions call it when their jobs are done"""
+    global _all, _generation
+
+    pid = os.getpid()
+    _lock.acquire()
+    try:
+        git_cat_files = _all
+        # The ones inherited from the parent process are left alone
+        _all = [(p, git_cat_file) for p, git_cat_file in git_cat_files
+                if p != pid]
+        _generation += 1
+    finally:
+        _lock.release()
+
+    for p, git_cat_file in git_cat_files:
+        if p == pid:
+            git_cat_file.close()
+
+
+def _repo_cat(repo, uri, rev):
+    def write_data(data, io):
+        io.write(data)
+
+    io = BytesIO()
+    wid = repo.add_watch(CAT, write_data, io)
+    try:
+        repo.cat(uri, rev)
+        return io.getvalue()
+    finally:
+        repo.remove_watch(CAT, wid)
+        io.close()
+
+
+def cat_file(repo, repo_uri, path, rev):
+    """Return the contents of path (relative to repo_uri) at revision
+       rev. Git repositories use a git cat-file --batch process per
+       thread, other repositories fall back to repo.cat, raising the
+       same exceptions it does.
+    """
+    if repo.get_type() == 'git' and os.path.isdir(repo_uri):
+        return _get_git_cat_file(repo_uri).cat(path, rev)
+
+    return _repo_cat(repo, os.path.join(repo_uri, path), rev)
+
+
+def get_blob_id(repo, repo_uri, path, rev):
+    """Return the id of the contents of path (relative to repo_uri) at
+       revision rev without getting them, or None if the repository
+       can't tell it. For Git it's the blob id, the same blob_hash()
+       gives for the contents.
+    """
+    if repo.get_type() == 'git' and os.path.isdir(repo_uri):
+        return _get_git_cat_file(repo_uri, True).get_blob_id(path, rev)
+
+    return None
+
+
+def blob_hash(data):
+    """Return the id Git would give to a blob with the given contents"""
+    return sha1("blob %d\0%s" % (len(data), data)).hexdigest()
+
+
+if __name__ == '__main__':
+    from repositoryhandler.backends import create_repository_from_path
+
+    repo = create_repository_from_path(sys.argv[1])
+    print cat_file(repo, sys.argv[1], sys.argv[3], sys.argv[2])
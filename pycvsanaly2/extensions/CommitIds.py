@@ -0,0 +1,119 @@
+# Copyright (C) 2008 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, "../../")
+
+from pycvsanaly2.Database import statement
+from pycvsanaly2.Config import Config
+from pycvsanaly2.profile import profiler_start, profiler_stop
+from collections import OrderedDict
+import threading
+
+
+class CommitIds(object):
+    """Map of the revisions of a repository to their commit ids, shared
+       by the extensions that have to resolve revisions given by the
+       repository (blame output, for instance).
+
+       The whole map is loaded the first time it's used for a
+       repository. With low_memory, only the MAX_SIZE most recently
+       used revisions are kept, and the rest are queried.
+    """
+
+    MAX_SIZE = 10000
+
+    __shared_state = {'repo_id': None,
+                      'revs': None,
+                      'lock': threading.Lock(),
+                      'db': None}
+
+    def __init__(self, db):
+        self.__dict__ = self.__shared_state
+        self.__dict__['db'] = db
+
+    def __load(self, repo_id):
+        db = self.__dict__['db']
+        self.__dict__['repo_id'] = repo_id
+
+        if Config().low_memory:
+            self.__dict__['revs'] = OrderedDict()
+            return
+
+        profiler_start("Loading commit ids for repository %d", (repo_id,))
+        revs = {}
+        cursor = db.get_connection().cursor()
+        cursor.execute(statement("SELECT rev, id from scmlog " + \
+                                 "where repository_id = ?", db.place_holder),
+                       (repo_id,))
+        rs = cursor.fetchmany()
+        while rs:
+            revs.update(rs)
+            rs = cursor.fetchmany()
+        cursor.close()
+        self.__dict__['revs'] = revs
+        profiler_stop("Loading commit ids for repository %d", (repo_id,),
+                      True)
+
+    def __query(self, rev, repo_id):
+        db = self.__dict__['db']
+        cursor = db.get_connection().cursor()
+        cursor.execute(statement("SELECT id from scmlog " + \
+                                 "where rev = ? and repository_id = ?",
+                                 db.place_holder), (rev, repo_id))
+        row = cursor.fetchone()
+        cursor.close()
+
+        if row is None:
+            return None
+
+        return row[0]
+
+    def get_commit_id(self, rev, repo_id):
+        """Returns the id of the commit rev of the repository,
+           or None if it's not in the database"""
+        self.__dict__['lock'].acquire()
+        try:
+            if self.__dict__['repo_id'] != repo_id:
+                self.__load(repo_id)
+
+            revs = self.__dict__['revs']
+            if not isinstance(revs, OrderedDict):
+                return revs.get(rev)
+
+            try:
+                commit_id = revs.pop(rev)
+            except KeyError:
+                commit_id = self.__query(rev, repo_id)
+                if len(revs) >= self.MAX_SIZE:
+                    revs.popitem(last=False)
+            revs[rev] = commit_id
+
+            return commit_id
+        finally:
+            self.__dict__['lock'].release()
+
+    def clear(self):
+        self.__dict__['repo_id'] = None
+        self.__dict__['revs'] = None
+
+
+if __name__ == '__main__':
+    from pycvsanaly2.Database import create_database
+
+    db = create_database('sqlite', sys.argv[1])
+    print CommitIds(db).get_commit_id(sys.argv[2], 1)
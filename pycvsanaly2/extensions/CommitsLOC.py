@@ -22,36 +22,18 @@ import re
 from subprocess import Popen, PIPE
 from repositoryhandler.backends.watchers import DIFF
 
-from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase, 
-                                  TableAlreadyExists, statement)
+from pycvsanaly2.Database import (DBCommitLines, TableAlreadyExists,
+                                  statement)
 from pycvsanaly2.Log import LogReader
 from pycvsanaly2.extensions import (Extension, register_extension, 
-                                    ExtensionRunError)
+                                    ExtensionRunError,
+                                    restrict_to_new_commits)
 from pycvsanaly2.utils import to_utf8, printerr, uri_to_filename
 from pycvsanaly2.FindProgram import find_program
 from pycvsanaly2.Command import Command, CommandError
 from Progress import Progress
 
 
-class DBCommitLines(object):
-
-    id_counter = 1
-
-    __insert__ = """INSERT INTO commits_lines (id, commit_id, added, removed) 
-                    values (?, ?, ?, ?)"""
-
-    def __init__(self, id, commit_id, added, removed):
-        if id is None:
-            self.id = DBCommitLines.id_counter
-            DBCommitLines.id_counter += 1
-        else:
-            self.id = id
-
-        self.commit_id = commit_id
-        self.added = added
-        self.removed = removed
-
-
 class LineCounter(object):
 
     def __init__(self, repo, uri):
@@ -219,49 +201,18 @@ class CommitsLOC(Extension):
     def __create_table(self, cnn):
         cursor = cnn.cursor()
 
-        if isinstance(self.db, SqliteDatabase):
-            import sqlite3.dbapi2
-            
-            try:
-                cursor.execute("""CREATE TABLE commits_lines (
-                                id integer primary key,
-                                commit_id integer unique,
-                                added integer,
-                                removed integer
-                                )""")
-            except sqlite3.dbapi2.OperationalError:
-                cursor.close()
-                raise TableAlreadyExists
-            except:
-                raise
-        elif isinstance(self.db, MysqlDatabase):
-            import MySQLdb
-
-            try:
-                cursor.execute("""CREATE TABLE commits_lines (
-                                id INT primary key,
-                                commit_id integer unique,
-                                added int,
-                                removed int
-                                -- FOREIGN KEY (commit_id) 
-                                --    REFERENCES scmlog(id)
-                                ) CHARACTER SET=utf8""")
-            except MySQLdb.OperationalError, e:
-                if e.args[0] == 1050:
-                    cursor.close()
-                    raise TableAlreadyExists
-                raise
-            except:
-                raise
-            
+        try:
+            self.db.create_commits_lines_table(cursor)
+        finally:
+            cursor.close()
+
         cnn.commit()
-        cursor.close()
 
     def __get_commits_lines_for_repository(self, repo_id, cursor):
         query = "SELECT cm.commit_id from commits_lines cm, scmlog s " + \
                 "WHERE cm.commit_id = s.id and repository_id = ?"
         cursor.execute(statement(query, self.db.place_holder), (repo_id,))
-        commits = [res[0] for res in cursor.fetchall()]
+        commits = set([res[0] for res in cursor.fetchall()])
 
         return commits
     
@@ -282,26 +233,24 @@ class CommitsLOC(Extension):
         repo_id = cursor.fetchone()[0]
 
         # If table does not exist, the list of commits is empty,
-        # otherwise it will be filled within the except block below
-        commits = []
+        # otherwise it will be filled within the except block below.
+        # Commits parsed from a log with numstat are already there
+        commits = set()
         
         try:
             self.__create_table(cnn)
         except TableAlreadyExists:
-            cursor.execute(statement("SELECT max(id) from commits_lines", 
-                                     db.place_holder))
-            id = cursor.fetchone()[0]
-            if id is not None:
-                DBCommitLines.id_counter = id + 1
-
             commits = self.__get_commits_lines_for_repository(repo_id, cursor)
         except Exception, e:
             raise ExtensionRunError(str(e))
 
-        counter = create_line_counter_for_repository(repo, uri)
-        
-        cursor.execute(statement("""SELECT id, rev, composed_rev from scmlog 
-            where repository_id = ?""", db.place_holder), (repo_id,))
+        # Created only if there are commits to count, it might
+        # have to read the whole log
+        counter = None
+
+        query, args = restrict_to_new_commits("""SELECT id, rev, composed_rev
+            from scmlog where repository_id = ?""", (repo_id,), "id")
+        cursor.execute(statement(query, db.place_holder), args)
         progress = Progress("[Extension CommitsLOC]", cursor.rowcount)
         write_cursor = cnn.cursor()
         rs = cursor.fetchmany()
@@ -317,17 +266,16 @@ class CommitsLOC(Extension):
                     rev = revision.split("|")[0]
                 else:
                     rev = revision
-                    
+
+                if counter is None:
+                    counter = create_line_counter_for_repository(repo, uri)
                 (added, removed) = counter.get_lines_for_revision(revision)
-                commit_list.append(DBCommitLines(None, commit_id, added, 
-                                                 removed))
+                commit_list.append((commit_id, added, removed))
                 progress.finished_one()
 
             if commit_list:
-                commits_lines = [(commit.id, commit.commit_id, commit.added, \
-                                  commit.removed) for commit in commit_list]
                 write_cursor.executemany(statement(DBCommitLines.__insert__, 
-                                        self.db.place_holder), commits_lines)
+                                        self.db.place_holder), commit_list)
 
             rs = cursor.fetchmany()
             
@@ -24,10 +24,11 @@ from pycvsanaly2.Database import SqliteDatabase, MysqlDatabase, statement, \
 from pycvsanaly2.Config import Config
 from pycvsanaly2.utils import printdbg, printerr, uri_to_filename, to_utf8
 from pycvsanaly2.profile import profiler_start, profiler_stop
-from FileRevs import FileRevs
+from FileRevs import FileRevs, PendingFileRevs
 from repositoryhandler.backends import RepositoryCommandError
-from repositoryhandler.backends.watchers import CAT, SIZE
+from repositoryhandler.backends.watchers import SIZE
 from Jobs import JobPool, Job
+from CatFile import cat_file, get_blob_id, blob_hash, close_git_cat_files
 from io import BytesIO
 import os
 
@@ -35,11 +36,13 @@ import os
 # This class holds a single repository retrieve task,
 # and keeps the source code until the object is garbage-collected
 class ContentJob(Job):
-    def __init__(self, commit_id, file_id, rev, path):
+    def __init__(self, commit_id, file_id, rev, path, blob=None):
         self.commit_id = commit_id
         self.file_id = file_id
         self.rev = rev
         self.path = path
+        # Id of the contents (the git blob id), when it's known in advance
+        self.blob = blob
         self._file_contents = ""
         self.file_size = None
 
@@ -66,8 +69,17 @@ class ContentJob(Job):
         if ext_ptr != -1:
             suffix = filename[ext_ptr:]
             
-        self._file_contents = self.listen_for_data(self.repo.cat, CAT)
-        
+        self._file_contents = self.cat_file()
+
+        if self.blob is None and self._file_contents is not None:
+            self.blob = blob_hash(self._file_contents)
+
+        if self.repo_type == 'git':
+            # The size of the blob, no need to ask for it again
+            if self._file_contents is not None:
+                self.file_size = len(self._file_contents)
+            return
+
         try:
             self.file_size = self.listen_for_data(self.repo.size, SIZE)
         except NotImplementedError:
@@ -75,7 +87,34 @@ class ContentJob(Job):
         
         if self.file_size:
             self.file_size = int(self.file_size)
-            
+
+    def cat_file(self):
+        # Git doesn't need retries because all of the revisions
+        # are already on disk
+        if self.repo_type == 'git':
+            retries = 0
+        else:
+            retries = 3
+
+        while True:
+            try:
+                return cat_file(self.repo, self.repo_uri, self.path, self.rev)
+            except RepositoryCommandError, e:
+                if retries > 0:
+                    printerr("Command %s returned %d(%s), try again",\
+                            (e.cmd, e.returncode, e.error))
+                    retries -= 1
+                else:
+                    printerr("Error obtaining %s@%s. " +
+                                "Command %s returned %d(%s)", \
+                                (self.path, self.rev, e.cmd, \
+                                e.returncode, e.error))
+                    return None
+            except Exception, e:
+                printerr("Error obtaining %s@%s. Exception: %s", \
+                        (self.path, self.rev, str(e)))
+                return None
+
     def listen_for_data(self, repo_func, watcher):
         def write_line(data, io):
             io.write(data)
@@ -271,6 +310,104 @@ class Content(Extension):
 
         connection.commit()
 
+    def __prepare_blobs_table(self, connection):
+        cursor = connection.cursor()
+
+        if isinstance(self.db, SqliteDatabase):
+            import sqlite3.dbapi2
+
+            try:
+                cursor.execute("""CREATE TABLE content_blobs(
+                    id INTEGER PRIMARY KEY,
+                    hash VARCHAR(40) NOT NULL,
+                    content CLOB,
+                    UNIQUE (hash))""")
+            except sqlite3.dbapi2.OperationalError:
+                # It's OK if the table already exists
+                pass
+            except:
+                raise
+
+            try:
+                cursor.execute("ALTER TABLE content ADD blob_id INTEGER")
+            except sqlite3.dbapi2.OperationalError:
+                # It's OK if the column already exists
+                pass
+            except:
+                raise
+            finally:
+                cursor.close()
+
+        elif isinstance(self.db, MysqlDatabase):
+            import MySQLdb
+
+            try:
+                cursor.execute("""CREATE TABLE content_blobs(
+                    id int(11) NOT NULL auto_increment,
+                    hash char(40) NOT NULL,
+                    content mediumtext,
+                    PRIMARY KEY(id),
+                    UNIQUE (hash)
+                    ) ENGINE=InnoDB CHARACTER SET=utf8""")
+            except MySQLdb.OperationalError, e:
+                if e.args[0] == 1050:
+                    # It's OK if the table already exists
+                    pass
+                else:
+                    raise
+            except:
+                raise
+
+            try:
+                cursor.execute("ALTER TABLE content ADD blob_id int(11)")
+            except MySQLdb.OperationalError, e:
+                if e.args[0] == 1060:
+                    # It's OK if the column already exists
+                    pass
+                else:
+                    raise
+            except:
+                raise
+            finally:
+                cursor.close()
+
+        connection.commit()
+
+    def __get_blob_id(self, write_cursor, db, blob, contents):
+        """Return the id of the row of content_blobs for the blob,
+           storing its contents if they aren't there yet"""
+        write_cursor.execute(statement("""select id from content_blobs
+            where hash = ?""", db.place_holder), (blob,))
+        rs = write_cursor.fetchone()
+        if rs is not None:
+            return rs[0]
+
+        write_cursor.execute(statement("""insert into content_blobs
+            (hash, content) values(?,?)""", db.place_holder),
+            (blob, contents))
+
+        return write_cursor.lastrowid
+
+    def __copy_content(self, write_cursor, db, stored, commit_id, file_id):
+        """Insert the content of a file revision with the same contents
+           of an already inserted one, stored is its (commit_id, file_id)
+        """
+        printdbg("Reusing content of %d@%d for %d@%d",
+                 (stored[1], stored[0], file_id, commit_id))
+
+        if Config().content_blobs:
+            columns = "content, loc, size, blob_id"
+        else:
+            columns = "content, loc, size"
+
+        query = """insert into content(commit_id, file_id, %s)
+            select ?, ?, %s from content
+            where commit_id = ? and file_id = ?""" % (columns, columns)
+        execute_statement(statement(query, db.place_holder),
+                          (commit_id, file_id) + stored, write_cursor, db,
+                          "Couldn't insert, duplicate record?",
+                          exception=ExtensionRunError)
+
     def __process_finished_jobs(self, job_pool, write_cursor, db):
 #        start = datetime.now()
         finished_job = job_pool.get_next_done(0)
@@ -285,19 +422,46 @@ class Content(Extension):
             if not Config().no_content:
                 file_contents = str(finished_job.file_contents)
             
-            query = """
-                insert into content(commit_id, file_id, content, loc, size) 
-                    values(?,?,?,?,?)"""
+            if Config().content_blobs:
+                # The contents are stored once in content_blobs
+                blob_id = None
+                if file_contents is not None and \
+                   finished_job.file_contents is not None:
+                    blob_id = self.__get_blob_id(write_cursor, db,
+                                                 finished_job.blob,
+                                                 file_contents)
+
+                query = """
+                    insert into content(commit_id, file_id, loc, size,
+                        blob_id) values(?,?,?,?,?)"""
+                parameters = (finished_job.commit_id,
+                              finished_job.file_id,
+                              finished_job.file_number_of_lines,
+                              finished_job.file_size,
+                              blob_id)
+            else:
+                query = """
+                    insert into content(commit_id, file_id, content, loc,
+                        size) values(?,?,?,?,?)"""
+                parameters = (finished_job.commit_id,
+                              finished_job.file_id,
+                              file_contents,
+                              finished_job.file_number_of_lines,
+                              finished_job.file_size)
             insert_statement = statement(query, db.place_holder)
-            parameters = (finished_job.commit_id,
-                          finished_job.file_id,
-                          file_contents,
-                          finished_job.file_number_of_lines,
-                          finished_job.file_size)
                                 
             execute_statement(insert_statement, parameters, write_cursor, db,
                        "Couldn't insert, duplicate record?", 
                        exception=ExtensionRunError)
+
+            # Revisions with the same blob were waiting for this job
+            blob = finished_job.blob
+            if blob in self.blobs:
+                stored = (finished_job.commit_id, finished_job.file_id)
+                self.blobs[blob] = stored
+                for commit_id, file_id in self.waiting.pop(blob, []):
+                    self.__copy_content(write_cursor, db, stored, commit_id,
+                                        file_id)
             
             processed_jobs += 1
             finished_job = job_pool.get_next_done(0)
@@ -340,6 +504,8 @@ class Content(Extension):
         # should ideally put that back again. Just all for now is fine.
         try:
             self.__prepare_table(connection)
+            if Config().content_blobs:
+                self.__prepare_blobs_table(connection)
         except Exception as e:
             raise ExtensionRunError("Couldn't prepare table because " + \
                                     str(e))
@@ -354,31 +520,31 @@ class Content(Extension):
         # I'm pretty sure "unknown" is returning binary files too, but
         # these are implicitly left out when trying to convert to utf-8
         # after download. However, ignore them for now to speed things up
-        query = "select f.id from file_types ft, files f " + \
-                "where f.id = ft.file_id and " + \
-                "ft.type in('code') and " + \
-                "f.repository_id = ?"
-                # "ft.type in('code', 'unknown') and " + \
-        read_cursor.execute(statement(query, db.place_holder), (repo_id,))
-        code_files = [item[0] for item in read_cursor.fetchall()]
+        pending = PendingFileRevs(db, read_cursor, repo_id)
+        pending.set_file_types(['code'])
         query = """select c.file_id, c.commit_id from content c, files f
             where c.file_id=f.id and f.repository_id=?
         """
-        read_cursor.execute(statement(query, db.place_holder), (repo_id,))
-        existing_content = [(item[0], item[1]) \
-                            for item in read_cursor.fetchall()]
+        pending.add_done(pending.fetch_revisions(query))
 
         fr = FileRevs(db, connection, read_cursor, repo_id)
 
+        # Identical contents (same git blob) are only got once:
+        # blob id -> (commit_id, file_id) of the first revision
+        # inserted with it, or None while its job is running
+        self.blobs = {}
+        # blob id -> revisions waiting for that job
+        self.waiting = {}
+
         i = 0
         # Loop through each file and its revision
         for revision, commit_id, file_id, action_type, composed in fr:
             if action_type == 'D':
                 continue
 #            loop_start = datetime.now()
-            if file_id not in code_files:
+            if not pending.is_wanted(file_id):
                 continue
-            if (file_id, commit_id) in existing_content:
+            if pending.is_done(file_id, commit_id):
                 continue
 
             try:
@@ -399,7 +565,28 @@ class Content(Extension):
                 printdbg("Skipping file %s", (relative_path,))
                 continue
 
-            job = ContentJob(commit_id, file_id, rev, relative_path)
+            try:
+                blob = get_blob_id(repo, path or repo.get_uri(),
+                                   relative_path, rev)
+            except Exception, e:
+                printdbg("Couldn't get the blob of %s@%s: %s",
+                         (relative_path, rev, str(e)))
+                blob = None
+
+            if blob is not None:
+                if blob in self.blobs:
+                    stored = self.blobs[blob]
+                    if stored is None:
+                        self.waiting[blob].append((commit_id, file_id))
+                    else:
+                        self.__copy_content(write_cursor, db, stored,
+                                            commit_id, file_id)
+                    continue
+
+                self.blobs[blob] = None
+                self.waiting[blob] = []
+
+            job = ContentJob(commit_id, file_id, rev, relative_path, blob)
             job_pool.push(job)
             i = i + 1
             if i >= queuesize:
@@ -415,6 +602,7 @@ class Content(Extension):
 
         job_pool.join()
         self.__process_finished_jobs(job_pool, write_cursor, db)
+        close_git_cat_files()
                 
         profiler_start("Inserting results in db")
         #self.__insert_many(write_cursor)
@@ -18,7 +18,7 @@
 #       Chris Lewis <cflewis@soe.ucsc.edu>
 
 from pycvsanaly2.extensions import Extension, register_extension, \
-        ExtensionRunError
+        ExtensionRunError, restrict_to_new_commits
 from pycvsanaly2.Database import SqliteDatabase, MysqlDatabase, \
         TableAlreadyExists, statement, execute_statement
 from pycvsanaly2.utils import printdbg, printerr, printout, \
@@ -209,9 +209,9 @@ class FileCount(Extension):
                            queuesize=queuesize)
             
         # Get the commits from this repository
-        query = """select s.id, s.rev from scmlog s
-            where s.repository_id = ?"""
-        read_cursor.execute(statement(query, db.place_holder), (repo_id,))
+        query, args = restrict_to_new_commits("""select s.id, s.rev
+            from scmlog s where s.repository_id = ?""", (repo_id,))
+        read_cursor.execute(statement(query, db.place_holder), args)
 
         self.__prepare_table(connection)
 
@@ -26,130 +26,158 @@ from pycvsanaly2.Database import statement
 from pycvsanaly2.utils import printdbg
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.Config import Config
-from copy import deepcopy
-import shelve
-import os
-from time import time
+from bisect import bisect_right
+import threading
 
 
 config = Config()
 
 
-class Adj(object):
-    def __init__(self):
-        self.files = {}
-        self.adj = {}
-
+class PathIndex(object):
+    """Versioned index of the file names and links of a repository.
 
-class FilePaths(object):
-    __shared_state = {'rev': None,
-                      'adj': None,
-                      'files': None,
-                      'cached_adj': {},
-                      'db': None}
+       For every file, the commits where it got a new name or a new
+       parent are kept sorted, so the name and the parent of a file
+       at any commit are found with a binary search. It's built with
+       one query over the files, the renames and the file links, and
+       it takes memory linear in the number of links and renames.
+       It's kept whole even with low_memory, which doesn't apply here.
+    """
 
-    def __init__(self, db):
-        self.__dict__ = self.__shared_state
-        self.__dict__['db'] = db
-  
-    def update_for_revision(self, cursor, commit_id, repo_id):
-        db = self.__dict__['db']
+    def __init__(self, repo_id):
+        self.repo_id = repo_id
+        # file_id -> name in the files table
+        self.files = {}
+        # file_id -> ([commit_id, ...], [new name, ...])
+        self.renames = {}
+        # file_id -> ([commit_id, ...], [parent_id, ...])
+        self.links = {}
 
-        if commit_id == self.__dict__['rev']:
+    def __add(self, versions, file_id, commit_id, value):
+        try:
+            commits, values = versions[file_id]
+        except KeyError:
+            versions[file_id] = ([commit_id], [value])
             return
-        prev_commit_id = self.__dict__['rev']
-        self.__dict__['rev'] = commit_id
 
-        profiler_start("Updating adjacency matrix for commit %d", (commit_id,))
-        if self.__dict__['adj'] is None:
-            adj = Adj()
-            self.__dict__['adj'] = adj
-        else:
-            adj = self.__dict__['adj']
-
-        rf = self.__dict__['files']
-        if rf is not None:
-            repo_files_id, repo_files = rf
-            if repo_files_id != repo_id:
-                del self.__dict__['files']
-                repo_files = {}
-        else:
-            repo_files = {}
-
-        if not repo_files:
-            # Get and cache all the files table
-            query = "select id, file_name from files where repository_id = ?"
-            # profiler_start("Getting files for repository %d", (repo_id,))
-            cursor.execute(statement(query, db.place_holder), (repo_id,))
-            # profiler_stop("Getting files for repository %d", (repo_id,), 
-            # True)
+        commits.append(commit_id)
+        values.append(value)
+
+    def build(self, cursor, db):
+        profiler_start("Building path index for repository %d",
+                       (self.repo_id,))
+
+        query = "select id, file_name from files where repository_id = ?"
+        cursor.execute(statement(query, db.place_holder), (self.repo_id,))
+        rs = cursor.fetchmany()
+        while rs:
+            for id, file_name in rs:
+                self.files[id] = file_name
             rs = cursor.fetchmany()
-            while rs:
-                for id, file_name in rs:
-                    repo_files[id] = file_name
-                rs = cursor.fetchmany()
-            self.__dict__['files'] = (repo_id, repo_files)
-            adj.files = repo_files
-
-        # Get the files that have been renamed
-        # with the new name for the given rev
-        query = "select af.file_id, af.new_file_name " + \
+
+        # Rows are sorted by commit, so the lists are sorted too
+        query = "select af.file_id, af.commit_id, af.new_file_name " + \
                 "from actions_file_names af, files f " + \
                 "where af.file_id = f.id " + \
-                "and af.commit_id = ? " + \
                 "and af.type = 'V' " + \
-                "and f.repository_id = ?"
-        # profiler_start("Getting new file names for commit %d", (commit_id,))
-        cursor.execute(statement(query, db.place_holder), (commit_id, repo_id))
-        # profiler_stop("Getting new file names for commit %d", (commit_id,), 
-        # True)
+                "and f.repository_id = ? " + \
+                "order by af.commit_id, af.id"
+        cursor.execute(statement(query, db.place_holder), (self.repo_id,))
         rs = cursor.fetchmany()
         while rs:
-            for id, file_name in rs:
-                adj.files[id] = file_name
+            for file_id, commit_id, file_name in rs:
+                self.__add(self.renames, file_id, commit_id, file_name)
             rs = cursor.fetchmany()
 
-        # Get the new file links since the last time
-        query = "select fl.parent_id, fl.file_id " + \
+        query = "select fl.file_id, fl.commit_id, fl.parent_id " + \
                 "from file_links fl, files f " + \
-                "where fl.file_id = f.id "
-        if prev_commit_id is None:
-            query += "and fl.commit_id = ? "
-            args = (commit_id, repo_id)
-        else:
-            query += "and fl.commit_id between ? and ? "
-            args = (prev_commit_id, commit_id, repo_id)
-        query += "and f.repository_id = ?"
-#        profiler_start("Getting file links for commit %d", (commit_id,))
-        cursor.execute(statement(query, db.place_holder), args)
-#        profiler_stop("Getting file links for commit %d", (commit_id,), True)
+                "where fl.file_id = f.id " + \
+                "and f.repository_id = ? " + \
+                "order by fl.commit_id, fl.id"
+        cursor.execute(statement(query, db.place_holder), (self.repo_id,))
         rs = cursor.fetchmany()
         while rs:
-            for f1, f2 in rs:
-                adj.adj[f2] = f1
+            for file_id, commit_id, parent_id in rs:
+                self.__add(self.links, file_id, commit_id, parent_id)
             rs = cursor.fetchmany()
 
-        profiler_stop("Updating adjacency matrix for commit %d",
-                       (commit_id,), True)
+        profiler_stop("Building path index for repository %d",
+                      (self.repo_id,), True)
 
-    def __build_path(self, file_id, adj):
-        if file_id not in adj.adj:
+    def __lookup(self, versions, file_id, commit_id):
+        try:
+            commits, values = versions[file_id]
+        except KeyError:
             return None
 
-        profiler_start("Building path for file %d", (file_id,))
-        
-        tokens = []
-        id = file_id
-        
-        while id is not None and id != -1:
-            tokens.insert(0, adj.files[id])
-            #use get instead of index to avoid key error
-            id = adj.adj.get(id) 
+        i = bisect_right(commits, commit_id)
+        if i == 0:
+            return None
+
+        return values[i - 1]
 
-        profiler_stop("Building path for file %d", (file_id,), True)
+    def get_parent(self, file_id, commit_id):
+        """Returns the parent of file_id at commit_id, -1 for the
+           files in the root directory, or None if the file didn't
+           exist yet"""
+        return self.__lookup(self.links, file_id, commit_id)
+
+    def get_filename(self, file_id, commit_id):
+        file_name = self.__lookup(self.renames, file_id, commit_id)
+        if file_name is None:
+            file_name = self.files.get(file_id)
+
+        return file_name
+
+    def get_path(self, file_id, commit_id):
+        parent_id = self.get_parent(file_id, commit_id)
+        if parent_id is None:
+            return None
+
+        tokens = [self.get_filename(file_id, commit_id)]
+        id = parent_id
+        while id is not None and id != -1:
+            tokens.append(self.get_filename(id, commit_id))
+            id = self.get_parent(id, commit_id)
+        tokens.reverse()
 
         return "/" + "/".join(tokens)
 
+
+class FilePaths(object):
+    __shared_state = {'rev': None,
+                      'index': None,
+                      'lock': threading.Lock(),
+                      'db': None}
+
+    def __init__(self, db):
+        self.__dict__ = self.__shared_state
+        self.__dict__['db'] = db
+
+    def __get_index(self, repo_id, cursor=None):
+        self.__dict__['lock'].acquire()
+        try:
+            index = self.__dict__['index']
+            if index is not None and index.repo_id == repo_id:
+                return index
+
+            index = PathIndex(repo_id)
+            if cursor is None:
+                cursor = self.__dict__['db'].get_connection().cursor()
+                index.build(cursor, self.__dict__['db'])
+                cursor.close()
+            else:
+                index.build(cursor, self.__dict__['db'])
+            self.__dict__['index'] = index
+
+            return index
+        finally:
+            self.__dict__['lock'].release()
+
+    def update_for_revision(self, cursor, commit_id, repo_id):
+        self.__get_index(repo_id, cursor)
+        self.__dict__['rev'] = commit_id
+
     def get_path_from_database(self, file_id, commit_id):
         """Returns the last valid path for a given file_id at commit_id
            (May have been removed afterwords!)"""
@@ -159,7 +187,7 @@ class FilePaths(object):
                             commit_id %d", (file_id, commit_id))
         
         db = self.__dict__['db']
-        cnn = db.connect()
+        cnn = db.get_connection()
         
         cursor = cnn.cursor()
         query = """SELECT current_file_path from actions
@@ -172,7 +200,6 @@ class FilePaths(object):
             file_path = None
         
         cursor.close()
-        cnn.close()
         
         printdbg("get_path_from_database:\
                   Path for file_id %d at commit_id %d: %s",
@@ -183,36 +210,18 @@ class FilePaths(object):
         return file_path
 
     def get_path(self, file_id, commit_id, repo_id):
+        """Returns the path of file_id at commit_id, or None if the
+           file didn't exist yet. Commits can be given in any order.
         """
-        Unless update_all is called up-front, commit_id 
-        passed into this method should be sequentially
-        from first commit to the last, though the same
-        commit_id can be passed several times.
-        """
-        adj = self.__dict__['cached_adj'].get(str(commit_id))
-        if adj is not None:
-            self.__dict__['adj'] = adj
-            self.__dict__['rev'] = commit_id
-        else:
-            cnn = self.__dict__['db'].connect()
-            cursor = cnn.cursor()
-            self.update_for_revision(cursor, commit_id, repo_id)
-            cursor.close()
-            cnn.commit()
-            cnn.close()
-            adj = self.__dict__['adj']
-            self.__dict__['cached_adj'][str(commit_id)] = deepcopy(adj)
-        path = self.__build_path(file_id, adj)
-
-        return path
+        index = self.__get_index(repo_id)
+        self.__dict__['rev'] = commit_id
+
+        return index.get_path(file_id, commit_id)
 
     def get_filename(self, file_id):
-        adj = self.__dict__['adj']
-        assert adj is not None, "Matrix no updated"
-        try:
-            return adj.files[file_id]
-        except KeyError:
-            return None
+        index = self.__dict__['index']
+        assert index is not None, "Index not built"
+        return index.get_filename(file_id, self.__dict__['rev'])
 
     def get_file_id(self, file_path, commit_id):
         """Ask for the file_id for a given file_path and commit_id"""
@@ -222,7 +231,7 @@ class FilePaths(object):
                             (file_path, commit_id))
         
         db = self.__dict__['db']
-        cnn = db.connect()
+        cnn = db.get_connection()
         cursor = cnn.cursor()
         query = """SELECT file_id from actions
                    WHERE binary current_file_path = ? AND commit_id = ?
@@ -235,7 +244,6 @@ class FilePaths(object):
             file_id = None
         
         cursor.close()
-        cnn.close()
         
         if config.debug:
             profiler_stop("Getting file id for file_path %s and commit_id %d",
@@ -247,71 +255,17 @@ class FilePaths(object):
         return self.__dict__['rev']
 
     def update_all(self, repo_id):
+        """Builds the path index of the repository up-front. It's
+           not required anymore, since get_path accepts the commits
+           in any order.
         """
-        update_all enable cache for adjacency matrices
-        Pros: File paths in different revisions can be
-        accessed randomly, i.e. after calling update_all,
-        get_path can be called with any revision in any
-        order.
-        Cons: It consumes significant memory to store
-        the adjacency matrices
-
-        If the config has low_memory set to true, shelve will
-        be used instead, to write the cache out to disk.
-        """
-        profiler_start("Update all file paths")
-        
-        if Config().low_memory:
-            self.shelve_file_name = str(time()) + "-shelve.db"
-            
-            # If there is an old file, shelf will complain viciously
-            if os.path.exists(self.shelve_file_name):
-                os.remove(self.shelve_file_name)
-            
-            self.__dict__['cached_adj'] = shelve.open(self.shelve_file_name, 
-                                                        writeback=False)
-        
-        db = self.__dict__['db']
-        cnn = db.connect()
+        self.__get_index(repo_id)
 
-        cursor = cnn.cursor()
-        query = """select distinct(s.id) from scmlog s, actions a
-                    where s.id = a.commit_id and repository_id=?
-                    order by s.commit_date"""
-        cursor.execute(statement(query, db.place_holder), (repo_id,))
-        
-        old_id = -1
-        all_commits = [i[0] for i in cursor.fetchall()]
-        for id in all_commits:
-            if old_id != id:
-                adj = self.__dict__['cached_adj'].get(str(id))
-
-                if adj is None:
-                    self.update_for_revision(cursor, id, repo_id)
-                    self.__dict__['cached_adj'][str(id)] = \
-                    deepcopy(self.__dict__['adj'])
-                old_id = id
-        cursor.close()
-        cnn.close()
-        profiler_stop("Update all file paths", delete=True)
-        
     def close(self):
-        """Closes FilePaths to ensure all caches are deleted"""
-        
-        if Config().low_memory:
-            # FIXME: This should be closed, but sometimes shelve
-            # just won't do it. The best way is to timeout the try,
-            # but not closing and just deleting will do the same
-            # think, just in a more yucky way
-            printdbg("Syncing shelf")
-            self.__dict__['cached_adj'].sync()
-            printdbg("Closing shelf")
-            self.__dict__['cached_adj'].close()
-            printdbg("Deleting shelve " + self.shelve_file_name)
-            os.remove(self.shelve_file_name)
-            # Clean up cached adj in case this gets called without
-            # update_all later
-            self.__dict__['cached_adj'] = {}
+        """Closes FilePaths to ensure the index and the connections
+           of all the threads that used it are released"""
+        self.__dict__['index'] = None
+        self.__dict__['db'].close_connections()
 
 if __name__ == '__main__':
     import sys
@@ -17,7 +17,8 @@
 # Authors :
 #       Carlos Garcia Campos  <carlosgc@libresoft.es>
 
-from pycvsanaly2.Database import statement, ICursor
+from pycvsanaly2.Database import statement, KeysetCursor
+from pycvsanaly2.extensions import restrict_to_new_commits
 from FilePaths import FilePaths
 
 if __name__ == '__main__':
@@ -27,22 +28,34 @@ if __name__ == '__main__':
 
 class FileRevs(object):
 
-    INTERVAL_SIZE = 1000
-    __query__ = """select s.rev rev, s.id commit_id, af.file_id,
-        af.action_type, s.composed_rev
-        from scmlog s, action_files af
-        where s.id = af.commit_id and s.repository_id = ?
-        order by s.commit_date"""
+    # Commits by page, their ids are given in an IN list
+    INTERVAL_SIZE = 400
+    # The commits are paged on the primary key of scmlog alone, in the
+    # order they were mined, and the files of every page are read from
+    # the tables of action_files, so a page costs the same wherever it
+    # is in the history
+    __keys__ = ["s.id"]
+    __query__ = """select s.id, s.rev, s.composed_rev
+        from scmlog s where s.repository_id = ?"""
+    __files_query__ = """select a.commit_id, a.id, a.file_id, a.type
+        from actions a
+        where a.type <> 'R' and a.commit_id in (%s)
+        union
+        select a.commit_id, a.id, fc.to_id, a.type
+        from actions a, file_copies fc
+        where fc.action_id = a.id and a.type = 'R' and a.commit_id in (%s)"""
 
     def __init__(self, db, cnn, cursor, repoid):
         self.db = db
         self.cnn = cnn
+        self.cursor = cursor
         self.repoid = repoid
 
-        self.icursor = ICursor(cursor, self.INTERVAL_SIZE)
-        self.icursor.execute(statement(self.__query__, db.place_holder), 
-                             (repoid,))
-        self.rs = iter(self.icursor.fetchmany())
+        self.icursor = KeysetCursor(cursor, self.__keys__, self.INTERVAL_SIZE,
+                                    db.place_holder)
+        query, args = restrict_to_new_commits(self.__query__, (repoid,))
+        self.icursor.execute(statement(query, db.place_holder), args)
+        self.rs = iter([])
         self.prev_commit = -1
         self.current = None
 
@@ -51,16 +64,37 @@ class FileRevs(object):
     def __iter__(self):
         return self
 
-    def __get_next(self):
-        try:
-            t = self.rs.next()
-        except StopIteration:
-            self.rs = iter(self.icursor.fetchmany())
-            if not self.rs:
-                raise StopIteration
-            t = self.rs.next()
+    def __fetch_page(self):
+        # KeysetCursor has read the whole page, the cursor is free
+        commits = self.icursor.fetchmany()
+        if not commits:
+            raise StopIteration
+
+        # Same order as the commits, then by action and file
+        order = {}
+        revs = {}
+        for i, (commit_id, rev, composed) in enumerate(commits):
+            order[commit_id] = i
+            revs[commit_id] = (rev, composed)
 
-        return t
+        ids = order.keys()
+        marks = ",".join(["?"] * len(ids))
+        self.cursor.execute(statement(self.__files_query__ % (marks, marks),
+                                      self.db.place_holder), ids + ids)
+        rows = self.cursor.fetchall()
+        rows.sort(key=lambda row: (order[row[0]], row[1], row[2]))
+
+        return [(revs[commit_id][0], commit_id, file_id, action_type,
+                 revs[commit_id][1])
+                for commit_id, action_id, file_id, action_type in rows]
+
+    def __get_next(self):
+        while True:
+            try:
+                return self.rs.next()
+            except StopIteration:
+                # Raises StopIteration after the last page
+                self.rs = iter(self.__fetch_page())
 
     def next(self):
         if not self.rs:
@@ -121,6 +155,64 @@ class FileRevs(object):
 
         return relative_path
 
+
+class PendingFileRevs(object):
+    """Plans the work of the extensions that process the file revisions
+       given by FileRevs: only the files of the given types and the
+       revisions not processed yet. Files and revisions are kept in
+       sets, so every revision is checked in constant time.
+    """
+
+    def __init__(self, db, cursor, repoid):
+        self.db = db
+        self.cursor = cursor
+        self.repoid = repoid
+
+        # None means every file
+        self.files = None
+        self.done = set()
+        self.failed = set()
+
+    def fetch_revisions(self, query):
+        """Returns the (file_id, commit_id) pairs of the given query,
+           whose only argument is the repository id"""
+        self.cursor.execute(statement(query, self.db.place_holder),
+                            (self.repoid,))
+        rs = self.cursor.fetchmany()
+        while rs:
+            for file_id, commit_id in rs:
+                yield (file_id, commit_id)
+            rs = self.cursor.fetchmany()
+
+    def set_file_types(self, types):
+        query = "select f.id from file_types ft, files f " + \
+                "where f.id = ft.file_id and " + \
+                "ft.type in (%s) and " % \
+                (", ".join(["'%s'" % (type,) for type in types]),) + \
+                "f.repository_id = ?"
+        self.cursor.execute(statement(query, self.db.place_holder),
+                            (self.repoid,))
+        self.files = set()
+        rs = self.cursor.fetchmany()
+        while rs:
+            self.files.update([item[0] for item in rs])
+            rs = self.cursor.fetchmany()
+
+    def add_done(self, revisions):
+        self.done.update(revisions)
+
+    def add_failed(self, revisions):
+        self.failed.update(revisions)
+
+    def is_wanted(self, file_id):
+        return self.files is None or file_id in self.files
+
+    def is_done(self, file_id, commit_id):
+        return (file_id, commit_id) in self.done
+
+    def is_failed(self, file_id, commit_id):
+        return (file_id, commit_id) in self.failed
+
 if __name__ == '__main__':
     import sys
     from pycvsanaly2.Database import create_database
@@ -18,11 +18,15 @@
 #       Zhongpeng Lin  <zlin5@ucsc.edu>
 
 from Blame import BlameJob, Blame
-from pycvsanaly2.extensions import register_extension, ExtensionRunError
+from pycvsanaly2.extensions import (register_extension, ExtensionRunError,
+                                    restrict_to_new_commits)
 from pycvsanaly2.extensions.line_types import get_line_types, line_is_code
+from pycvsanaly2.extensions.CatFile import close_git_cat_files
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.utils import printdbg, printerr, uri_to_filename
 from pycvsanaly2.Config import Config
+from pycvsanaly2.Command import Command, CommandError
+from pycvsanaly2.FindProgram import find_program
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase,
     TableAlreadyExists, statement)
 from repositoryhandler.backends import RepositoryCommandError
@@ -30,15 +34,26 @@ from repositoryhandler.backends.watchers import BLAME
 from guilty.parser import create_parser, ParserUnknownError
 from Jobs import JobPool, Job
 from FilePaths import FilePaths
+from CommitIds import CommitIds
 from Progress import Progress
+from itertools import groupby
 import os
-import sys
 
 
 class HunkBlameJob(Job):
+
+    # Hunks further apart than this number of lines are blamed
+    # in different ranges
+    MAX_BLAME_GAP = 200
+
     class BlameContentHandler(BlameJob.BlameContentHandler):
         def __init__(self, hunks, line_types):
             self.hunks = hunks
+            # Line number -> id of the first hunk containing it
+            self.line_hunks = {}
+            for hunk_id, start_line, end_line in hunks:
+                for line in xrange(start_line, end_line + 1):
+                    self.line_hunks.setdefault(line, hunk_id)
             if line_types:
                 self.line_types = line_types
             else:
@@ -47,14 +62,14 @@ class HunkBlameJob(Job):
             self.bug_revs = {}
 
         def line(self, blame_line):
+            hunk_id = self.line_hunks.get(blame_line.line)
+            if hunk_id is None:
+                return
+
             if (not Config().hb_ignore_comments) or line_is_code(self.line_types, blame_line.line):
-                for hunk_id, start_line, end_line in self.hunks:
-                    if blame_line.line >= start_line and \
-                    blame_line.line <= end_line:
-                        if self.bug_revs.get(hunk_id) is None:
-                            self.bug_revs[hunk_id] = set()
-                        self.bug_revs[hunk_id].add(blame_line.rev)
-                        break
+                if self.bug_revs.get(hunk_id) is None:
+                    self.bug_revs[hunk_id] = set()
+                self.bug_revs[hunk_id].add(blame_line.rev)
 
         def start_file(self, filename):
             self.filename = filename
@@ -89,15 +104,6 @@ class HunkBlameJob(Job):
         def blame_line(line, p):
             p.feed(line)
 
-        start = sys.maxint
-        end = 0
-
-        for hunk in self.hunks:
-            if hunk[1] < start:
-                start = hunk[1]
-            if hunk[2] > end:
-                end = hunk[2]
-
         repo_type = repo.get_type()
         if repo_type == 'cvs':
             # CVS paths contain the module stuff
@@ -111,28 +117,81 @@ class HunkBlameJob(Job):
         else:
             path = self.prev_path.strip('/')
 
+        out = self.get_content_handler()
+        ranges = self.get_blame_ranges()
+        if repo_type == 'git':
+            # git blame takes all the ranges at once, so the history
+            # is walked only once
+            p = self.__create_parser(repo)
+            p.set_output_device(out)
+            self.__git_blame(repo_uri, path, ranges, p)
+            p.end()
+        else:
+            for start, end in ranges:
+                p = self.__create_parser(repo)
+                p.set_output_device(out)
+                wid = repo.add_watch(BLAME, blame_line, p)
+                try:
+                    repo.blame(os.path.join(repo_uri, self.prev_path),
+                               self.prev_rev, start=start, end=end,
+                               ignore_whitespaces=True)
+                except RepositoryCommandError, e:
+                    printerr("Command %s returned %d (%s).",
+                             (e.cmd, e.returncode, e.error))
+                    self.failed = True
+                p.end()
+                repo.remove_watch(BLAME, wid)
+
+                if self.failed:
+                    break
+
+        if self.failed:
+            return
+
+        self.collect_results(out)
+
+    def __create_parser(self, repo):
         try:
             printdbg("Creating parser")
-            p = create_parser(repo.get_type(), self.prev_path)
+            return create_parser(repo.get_type(), self.prev_path)
         except ParserUnknownError:
             printdbg("Parser not found, getting one from the repo.")
             # The parser isn't part of guilty.
             # This method lets a repo that isn't part of the
             # ecosystem to specifiy it's own blame parser
-            p = repo.get_blame_parser(self.prev_path)
+            return repo.get_blame_parser(self.prev_path)
+
+    def __git_blame(self, repo_uri, path, ranges, p):
+        # Same output options used by the git backend for blame
+        cmd = [find_program('git') or 'git', 'blame', '--root', '-l', '-t',
+               '-f', '-w']
+        for start, end in ranges:
+            cmd.extend(['-L', '%d,%d' % (start, end)])
+        cmd.extend([self.prev_rev, '--', path])
 
-        out = self.get_content_handler()
-        p.set_output_device(out)
-        wid = repo.add_watch(BLAME, blame_line, p)
         try:
-            repo.blame(os.path.join(repo_uri, self.prev_path), self.prev_rev,
-                       start=start, end=end, ignore_whitespaces=True)
-            self.collect_results(out)
-        except RepositoryCommandError, e:
-            printerr("Command %s returned %d (%s).", (e.cmd, e.returncode, e.error))
+            Command(cmd, repo_uri, env={'PAGER': ''}).run(
+                parser_out_func=p.feed)
+        except CommandError, e:
+            printerr("Command %s returned %d (%s).",
+                     (" ".join(cmd), e.returncode, e.error))
             self.failed = True
-        p.end()
-        repo.remove_watch(BLAME, wid)
+
+    def get_blame_ranges(self):
+        """Return the (start, end) line ranges to blame to cover the
+           hunks. Ranges closer than MAX_BLAME_GAP lines are blamed
+           together. Other backends than git walk the history again
+           for every range"""
+        ranges = []
+        for hunk_id, start_line, end_line in sorted(self.hunks,
+                                                    key=lambda h: h[1]):
+            if ranges and start_line - ranges[-1][1] <= self.MAX_BLAME_GAP:
+                if end_line > ranges[-1][1]:
+                    ranges[-1][1] = end_line
+            else:
+                ranges.append([start_line, end_line])
+
+        return [tuple(r) for r in ranges]
 
     def run(self, repo, repo_uri):
         try:
@@ -320,23 +379,15 @@ class HunkBlame(Blame):
 
     def populate_insert_args(self, job):
         bug_revs = job.get_bug_revs()
-        cnn = self.db.connect()
-        cursor = cnn.cursor()
         args = []
         for hunk_id in bug_revs:
             for rev in bug_revs[hunk_id]:
                 printdbg("Find id for rev %s" % rev)
-                query = "select id from scmlog where rev = ?"
-                cursor.execute(statement(query, self.db.place_holder),
-                               (rev,))
-
-                fetched_row = cursor.fetchone()
+                commit_id = self.commit_ids.get_commit_id(rev, self.repoid)
 
-                if fetched_row is not None:
-                    args.append((hunk_id, fetched_row[0]))
+                if commit_id is not None:
+                    args.append((hunk_id, commit_id))
 
-        cursor.close()
-        cnn.close()
         return args
 
     def run(self, repo, uri, db):
@@ -345,6 +396,7 @@ class HunkBlame(Blame):
         self.db = db
         self.uri = uri
         self.fp = FilePaths(self.db)
+        self.commit_ids = CommitIds(self.db)
 
         cnn = self.db.connect()
         read_cursor = cnn.cursor()
@@ -359,6 +411,7 @@ class HunkBlame(Blame):
             read_cursor.execute(statement("SELECT id from repositories " + \
                     "where uri = ?", db.place_holder), (repo_uri,))
             repoid = read_cursor.fetchone()[0]
+            self.repoid = repoid
         except NotImplementedError:
             raise ExtensionRunError("HunkBlame extension is not supported " + \
                                     "for %s repositories" % (repo.get_type()))
@@ -384,23 +437,36 @@ class HunkBlame(Blame):
 
         job_pool = JobPool(repo, path or repo.get_uri(), queuesize=100)
 
-        outer_query = """select distinct h.file_id, h.commit_id
+        # Every pending hunk, grouped by file revision. Hunks already
+        # blamed are left out with an anti-join on hunk_blames
+        query = """select h.file_id, h.commit_id, s.rev, h.id,
+                h.old_start_line, h.old_end_line
             from hunks h, scmlog s
             where h.commit_id=s.id and s.repository_id=?
                 and h.old_start_line is not null
                 and h.old_end_line is not null
                 and h.file_id is not null
                 and h.commit_id is not null
-                and h.id NOT IN (SELECT DISTINCT hunk_id FROM hunk_blames)
+                and not exists (select hb.hunk_id from hunk_blames hb
+                                where hb.hunk_id = h.id)
         """
-        read_cursor.execute(statement(outer_query, db.place_holder), (repoid,))
+        query, args = restrict_to_new_commits(query, (repoid,))
+        query += " order by h.commit_id, h.file_id, h.id"
+        read_cursor.execute(statement(query, db.place_holder), args)
         progress = Progress("[Extension HunkBlame]", read_cursor.rowcount)
-        file_rev = read_cursor.fetchone()
+
+        def pending_hunks():
+            rs = read_cursor.fetchmany()
+            while rs:
+                for row in rs:
+                    yield row
+                rs = read_cursor.fetchmany()
+
         n_blames = 0
-        while file_rev is not None:
+        for (file_id, commit_id, current_rev), rows in \
+                groupby(pending_hunks(), lambda row: row[:3]):
+            hunks = [row[3:] for row in rows]
             try:
-                file_id, commit_id = file_rev
-
                 # get current file_path
                 current_path = self.fp.get_path_from_database(file_id, commit_id)
                 if current_path is None:
@@ -408,40 +474,6 @@ class HunkBlame(Blame):
                         """Couldn't find path for file ID %d at commit ID %d"""
                         % (file_id, commit_id))
 
-                # get current revision
-                rev_query = """SELECT rev FROM scmlog WHERE id = ?"""
-                try:
-                    write_cursor.execute(statement(rev_query, self.db.place_holder),
-                                   (commit_id,))
-                    current_rev = write_cursor.fetchone()[0]
-                except:
-                    raise NotValidHunkWarning(
-                        """Couldn't find revision for commit ID %d"""
-                        % (commit_id))
-
-                # get all hunks for file and revision
-                try:
-                    inner_cursor = cnn.cursor()
-                    inner_query = """select h.id, h.old_start_line,
-                            h.old_end_line from hunks h
-                            where h.file_id = ? and h.commit_id = ?
-                            and h.old_start_line is not null
-                            and h.old_end_line is not null
-                            and h.file_id is not null
-                            and h.commit_id is not null
-                            and h.id NOT IN (SELECT DISTINCT hunk_id FROM hunk_blames)
-                    """
-                    inner_cursor.execute(statement(inner_query,
-                                                   db.place_holder),
-                                                   (file_id, commit_id))
-                    hunks = inner_cursor.fetchall()
-                except:
-                    raise NotValidHunkWarning(
-                        """Couldn't find hunks for file ID %d at commit ID %d"""
-                        % (file_id, commit_id))
-                finally:
-                    inner_cursor.close()
-
                 # create the Job and run it
                 job = HunkBlameJob(hunks, current_path, current_rev)
                 job_pool.push(job)
@@ -459,8 +491,7 @@ class HunkBlame(Blame):
             except NotValidHunkWarning as e:
                 printerr("Not a valid hunk: " + str(e))
             finally:
-                file_rev = read_cursor.fetchone()
-                progress.finished_one()
+                progress.finished(len(hunks))
 
         job_pool.join()
         self.process_finished_jobs(job_pool, write_cursor, True)
@@ -471,6 +502,8 @@ class HunkBlame(Blame):
             printdbg("Couldn't drop cache because of " + str(e))
 
         self.fp.close()
+        close_git_cat_files()
+        self.commit_ids.clear()
         read_cursor.close()
         write_cursor.close()
         cnn.close()
@@ -18,15 +18,16 @@
 #       Chris Lewis <cflewis@soe.ucsc.edu>
 
 from pycvsanaly2.extensions import Extension, register_extension, \
-        ExtensionRunError
+        ExtensionRunError, restrict_to_new_commits
 from pycvsanaly2.extensions.FilePaths import FilePaths
+from pycvsanaly2.extensions.patch_format import decode_patch
 from pycvsanaly2.Database import SqliteDatabase, MysqlDatabase, statement, \
-    ICursor, execute_statement
+    KeysetCursor, execute_statement, BatchInsert, insert_ignore
 from pycvsanaly2.utils import printdbg, printerr, printout, uri_to_filename, \
     to_utf8
 from pycvsanaly2.profile import profiler_start, profiler_stop
-from pycvsanaly2.PatchParser import parse_patches, RemoveLine, InsertLine, \
-        ContextLine, Patch
+from pycvsanaly2.Config import Config
+from pycvsanaly2.PatchParser import iter_hunk_ranges
 from Progress import Progress
 import re
 
@@ -147,114 +148,30 @@ class Hunks(Extension):
         cursor.close()
 
     def get_commit_data(self, patch_content):
-        lines = [l + "\n" for l in patch_content.split("\n") if l]
-        hunks = []
-
-        for patch in [p for p in parse_patches(lines, allow_dirty=True, \
-                            allow_continue=True) if isinstance(p, Patch)]:
-            # This method matches that of parseLine in UnifiedDiffParser.java
-            # It's not necessarily intuitive, but this algorithm is much harder
-            # than it looks, I spent hours trying to get a simpler solution.
-            # It does, however, seem to work, which is pretty amazing when
-            # you think about how difficult it is for long enough.
-            # The trick that this method does is that each *part* of a hunk
-            # ie. added, deleted, changed are treated as *new entities*.
-            # The EntityDelta table does not store just diffs, it stores
-            # each part of a diff.
-            # I will need to copy the behavior of how Sep inserts a CommitData
-            # into the database to ensure things match
-            for hunk in patch.hunks:
-                old_start_line = hunk.orig_pos - 1
-                new_start_line = hunk.mod_pos - 1
-
-                old_end_line = 0
-                new_end_line = 0
-
-                added = False
-                deleted = False
-                in_change = False
-
-                for line in hunk.lines:
-                    if isinstance(line, RemoveLine):
-                        if not in_change or not deleted:
-                            in_change = True
-                            old_start_line += 1
-                            old_end_line = old_start_line
-                        else:
-                            old_end_line += 1
-
-                        deleted = True
-
-                    elif isinstance(line, InsertLine):
-                        if not in_change or not added:
-                            in_change = True
-                            new_start_line += 1
-                            new_end_line = new_start_line
-                        else:
-                            new_end_line += 1
-
-                        added = True
-
-                    elif isinstance(line, ContextLine):
-                        if in_change:
-                            in_change = False
-                            printdbg("Patch new name: " + patch.newname)
-                            file_name = patch.newname.strip()
-                            if file_name == "/dev/null":
-                                file_name = patch.oldname.strip()
-                            cd = CommitData(file_name)
-
-                            if deleted:
-                                cd.old_start_line = old_start_line
-                                cd.old_end_line = old_end_line
-                                old_start_line = old_end_line
-
-                            if added:
-                                cd.new_start_line = new_start_line
-                                cd.new_end_line = new_end_line
-                                new_start_line = new_end_line
-
-                            hunks.append(cd)
-                            added = deleted = False
-
-                        old_start_line += 1
-                        new_start_line += 1
-
-                # The diff ended without a new context line
-                if in_change:
-                    file_name = patch.newname.strip()
-                    if file_name == "/dev/null":
-                        file_name = patch.oldname.strip()
-                    cd = CommitData(file_name)
-
-                    if deleted:
-                        cd.old_start_line = old_start_line
-                        cd.old_end_line = old_end_line
-
-                    if added:
-                        cd.new_start_line = new_start_line
-                        cd.new_end_line = new_end_line
-
-                    hunks.append(cd)
-        return hunks
+        # Each run of removed and/or inserted lines of a hunk is a change
+        # on its own, see iter_hunk_ranges
+        return [CommitData(*change)
+                for change in iter_hunk_ranges(patch_content)]
 
     def get_patches(self, repo, repo_uri, repo_id, db, cursor):
         profiler_start("Hunks: fetch all patches")
-        icursor = ICursor(cursor, self.INTERVAL_SIZE)
+        icursor = KeysetCursor(cursor, ["p.id"], self.INTERVAL_SIZE,
+                               db.place_holder)
         # Get the patches from this repository
-        query = """select p.commit_id, p.file_id, p.patch, s.rev
+        query = """select p.id, p.commit_id, p.file_id, p.patch, s.rev
                     from patches p, scmlog s
                     where p.commit_id = s.id and
                     s.repository_id = ? and
                     p.patch is not NULL"""
-        icursor.execute(statement(query, db.place_holder), (repo_id,))
+        query, args = restrict_to_new_commits(query, (repo_id,))
+        icursor.execute(statement(query, db.place_holder), args)
         profiler_stop("Hunks: fetch all patches", delete=True)
 
         rs = icursor.fetchmany()
 
         while rs:
-            for commit_id, file_id, patch_content, rev in rs:
-                yield (commit_id, file_id, to_utf8(patch_content), rev)
+            for patch_id, commit_id, file_id, patch_content, rev in rs:
+                yield (commit_id, file_id, decode_patch(patch_content), rev)
             
             rs = icursor.fetchmany()
 
@@ -292,39 +209,41 @@ class Hunks(Extension):
         self.__prepare_table(connection)
         fp = FilePaths(db)
 
-        read_cursor.execute(statement("""select COUNT(*)
+        query, args = restrict_to_new_commits("""select COUNT(*)
                         from patches p, scmlog s
                         where p.commit_id = s.id and
                         s.repository_id = ? and
-                        p.patch is not NULL""",
-            db.place_holder), (repo_id,))
+                        p.patch is not NULL""", (repo_id,))
+        read_cursor.execute(statement(query, db.place_holder), args)
         nr_records = read_cursor.fetchone()[0]
         progress = Progress("[Extension Hunks]", nr_records)
 
         patches = self.get_patches(repo, path or repo.get_uri(), repo_id, db,
                                    read_cursor)
 
+        # The hunks of a patch are committed together
+        insert = BatchInsert(connection, write_cursor,
+                             statement(insert_ignore(db,
+                                 """insert into hunks(file_id,
+                                 commit_id, old_start_line, old_end_line,
+                                 new_start_line, new_end_line)
+                                 values(?,?,?,?,?,?)"""), db.place_holder),
+                             Config().insert_batch_size,
+                             Config().commit_interval,
+                             exception=ExtensionRunError)
+
         for commit_id, file_id, patch_content, rev in patches:
             for hunk in self.get_commit_data(patch_content):
-                insert = """insert into hunks(file_id, commit_id,
-                            old_start_line, old_end_line, new_start_line,
-                            new_end_line)
-                            values(?,?,?,?,?,?)"""
-
-                execute_statement(statement(insert, db.place_holder),
-                                  (file_id, commit_id,
-                                   hunk.old_start_line,
-                                   hunk.old_end_line,
-                                   hunk.new_start_line,
-                                   hunk.new_end_line),
-                                   write_cursor,
-                                   db,
-                                   "Couldn't insert hunk, dup record?",
-                                   exception=ExtensionRunError)
-
-            connection.commit()
+                insert.add((file_id, commit_id,
+                            hunk.old_start_line,
+                            hunk.old_end_line,
+                            hunk.new_start_line,
+                            hunk.new_end_line))
+            insert.end_group()
+
             progress.finished_one()
 
+        insert.flush()
         read_cursor.close()
         connection.commit()
         connection.close()
@@ -21,6 +21,7 @@ from Blame import BlameJob, Blame
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase,
     TableAlreadyExists, statement)
 from pycvsanaly2.extensions import register_extension
+from CommitIds import CommitIds
 
 class LineBlameJob(BlameJob):
     class ContentHandler(BlameJob.BlameContentHandler):
@@ -101,30 +102,30 @@ class LineBlame(Blame):
 
     def populate_insert_args(self, job):
         args = []
-        cnn = self.db.connect()
-        cursor = cnn.cursor()
+        commit_ids = CommitIds(self.db)
         for h in job.hunks:
-            query = "select id from scmlog where rev = ?"
-            cursor.execute(statement(query, self.db.place_holder),
-                           (h.rev,))
-
-            fetched_row = cursor.fetchone()
+            commit_id = commit_ids.get_commit_id(h.rev, self.repoid)
 
-            if fetched_row is not None:
-                args.append((job.file_id, job.commit_id, h.start, h.end, fetched_row[0]))
+            if commit_id is not None:
+                args.append((job.file_id, job.commit_id, h.start, h.end, commit_id))
             
-        cursor.close()
-        cnn.close()
         return args
 
     def get_max_id(self, db):
         return None
 
-    def get_blames(self, cursor, repoid):
+    def run(self, repo, uri, db):
+        try:
+            Blame.run(self, repo, uri, db)
+        finally:
+            # The rev -> commit id map is shared, it mustn't keep
+            # growing with the next repositories in batch mode
+            CommitIds(db).clear()
+
+    def get_blames(self, pending):
         query = "select distinct b.file_id, b.commit_id from line_blames b, files f " + \
                 "where b.file_id = f.id and repository_id = ?"
-        cursor.execute(statement(query, self.db.place_holder), (repoid,))
-        return [(res[0], res[1]) for res in cursor.fetchall()]
+        return pending.fetch_revisions(query)
 
     
     def backout(self, repo, uri, db):
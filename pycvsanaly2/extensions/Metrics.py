@@ -35,14 +35,16 @@ from pycvsanaly2.FindProgram import find_program
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.Command import Command, CommandError, CommandRunningError
 from repositoryhandler.backends import RepositoryCommandError
-from repositoryhandler.backends.watchers import CAT
 from tempfile import mkdtemp, NamedTemporaryFile
-from FileRevs import FileRevs
+from FileRevs import FileRevs, PendingFileRevs
 from Jobs import JobPool, Job
+from CatFile import cat_file, get_blob_id, blob_hash, close_git_cat_files
 from xml.sax import handler as xmlhandler, make_parser
 from signal import SIGTERM
 import os
 import re
+import threading
+from collections import OrderedDict
 
 
 class ProgramNotFound(Extension):
@@ -544,15 +546,56 @@ def create_file_metrics(path):
     return fm(path, lang, sloc)
 
 
+class MeasuresCache(object):
+    """Measures of the files already measured, by contents (blob id)
+       and file suffix, so that identical file revisions are measured
+       only once. It's shared by the job threads. Only the MAX_SIZE
+       most recently used measures are kept.
+    """
+
+    MAX_SIZE = 50000
+
+    def __init__(self, size=MAX_SIZE):
+        self.size = size
+        self.measures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            try:
+                measures = self.measures.pop(key)
+            except KeyError:
+                return None
+            self.measures[key] = measures
+
+            return measures
+        finally:
+            self.lock.release()
+
+    def add(self, key, measures):
+        self.lock.acquire()
+        try:
+            self.measures.pop(key, None)
+            if len(self.measures) >= self.size:
+                self.measures.popitem(last=False)
+            self.measures[key] = measures
+        finally:
+            self.lock.release()
+
+
 class MetricsJob(Job):
 
-    def __init__(self, id_counter, file_id, commit_id, path, rev, failed):
+    def __init__(self, id_counter, file_id, commit_id, path, rev, failed,
+                 cache=None):
         self.id_counter = id_counter
         self.file_id = file_id
         self.commit_id = commit_id
         self.path = path
         self.rev = rev
         self.failed = failed
+        # MeasuresCache shared by all the jobs
+        self.cache = cache
 
     def __measure_file(self, fm, measures, checkout_path, rev):
         printdbg("Measuring %s @ %s", (checkout_path, rev))
@@ -635,9 +678,6 @@ class MetricsJob(Job):
                       (checkout_path, rev), True)
 
     def run(self, repo, repo_uri):
-        def write_file(line, fd):
-            fd.write(line)
-            
         self.measures = Measures()
 
         repo_type = repo.get_type()
@@ -659,9 +699,25 @@ class MetricsJob(Job):
         if ext_ptr != -1:
             suffix = filename[ext_ptr:]
 
-        fd = NamedTemporaryFile('w', suffix=suffix)
-        wid = repo.add_watch(CAT, write_file, fd.file)
-            
+        # With Git, the blob id is known without getting the contents,
+        # which aren't needed if they have been measured already
+        blob = None
+        if self.cache is not None:
+            try:
+                blob = get_blob_id(repo, repo_uri, path, self.rev)
+            except Exception, e:
+                printdbg("Couldn't get the blob of %s@%s: %s",
+                         (self.path, self.rev, str(e)))
+
+        # The language depends on the file name too
+        if blob is not None:
+            measures = self.cache.get((blob, suffix))
+            if measures is not None:
+                printdbg("Reusing measures of %s for %s @ %s",
+                         (blob, self.path, self.rev))
+                self.measures = measures
+                return
+
         if repo_type == 'git':
             retries = 0
         else:
@@ -671,14 +727,13 @@ class MetricsJob(Job):
         failed = False
         while not done and not failed:
             try:
-                repo.cat(os.path.join(repo_uri, path), self.rev)
+                data = cat_file(repo, repo_uri, path, self.rev)
                 done = True
             except RepositoryCommandError, e:
                 if retries > 0:
                     printerr("Command %s returned %d (%s), try again", 
                              (e.cmd, e.returncode, e.error))
                     retries -= 1
-                    fd.file.seek(0)
                 elif retries == 0:
                     failed = True
                     printerr("Error obtaining %s@%s. " + \
@@ -690,19 +745,33 @@ class MetricsJob(Job):
                 printerr("Error obtaining %s@%s. Exception: %s", 
                          (self.path, self.rev, str(e)))
                 
-        repo.remove_watch(CAT, wid)
+        if failed:
+            self.measures.set_error()
+            return
+
+        # Other repositories only know it from the contents
+        key = (blob or blob_hash(data), suffix)
+        if self.cache is not None and blob is None:
+            measures = self.cache.get(key)
+            if measures is not None:
+                printdbg("Reusing measures of %s for %s @ %s",
+                         (key[0], self.path, self.rev))
+                self.measures = measures
+                return
+
+        fd = NamedTemporaryFile('w', suffix=suffix)
+        fd.file.write(data)
         fd.file.close()
 
-        if failed:
+        try:
+            fm = create_file_metrics(fd.name)
+            self.__measure_file(fm, self.measures, fd.name, self.rev)
+            if self.cache is not None:
+                self.cache.add(key, self.measures)
+        except Exception, e:
+            printerr("Error creating FileMetrics for %s@%s. Exception: %s", 
+                     (fd.name, self.rev, str(e)))
             self.measures.set_error()
-        else:
-            try:
-                fm = create_file_metrics(fd.name)
-                self.__measure_file(fm, self.measures, fd.name, self.rev)
-            except Exception, e:
-                printerr("Error creating FileMetrics for %s@%s. Exception: %s", 
-                         (fd.name, self.rev, str(e)))
-                self.measures.set_error()
 
         fd.close()
 
@@ -811,13 +880,12 @@ class Metrics(Extension):
         cnn.commit()
         cursor.close()
 
-    def __get_metrics(self, cursor, repoid):
+    def __get_metrics(self, pending):
         query = """select m.file_id, m.commit_id from metrics m, files f
                     where m.file_id = f.id and repository_id = ?"""
-        cursor.execute(statement(query, self.db.place_holder), (repoid,))
-        return [(res[0], res[1]) for res in cursor.fetchall()]
+        return pending.fetch_revisions(query)
 
-    def __get_metrics_failed(self, cursor, repoid):
+    def __get_metrics_failed(self, pending):
         query = """select m.file_id, m.commit_id from metrics m, files f
                 where m.file_id = f.id and repository_id = ? and
                 (sloc = -1 or loc = -1 or
@@ -827,9 +895,7 @@ class Metrics(Extension):
                 mccabe_mean = -1 or mccabe_median = -1 or
                 halstead_length = -1 or halstead_vol = -1 or
                 halstead_level = -1 or halstead_md = -1)"""
-
-        cursor.execute(statement(query, self.db.place_holder), (repoid,))
-        return [(res[0], res[1]) for res in cursor.fetchall()]
+        return pending.fetch_revisions(query)
 
     def __insert_many(self, cursor):
         if not self.metrics:
@@ -915,7 +981,6 @@ class Metrics(Extension):
         write_cursor = cnn.cursor()
         
         id_counter = 1
-        metrics = metrics_failed = []
 
         try:
             path = uri_to_filename(uri)
@@ -958,35 +1023,31 @@ class Metrics(Extension):
         except Exception, e:
             raise ExtensionRunError(str(e))
 
-        if id_counter > 1:
-            metrics = self.__get_metrics(read_cursor, repoid)
-            metrics_failed = self.__get_metrics_failed(read_cursor, repoid)
-
         job_pool = JobPool(repo, path or repo.get_uri(), 
                            queuesize=self.MAX_METRICS)
 
         # Get code files to discard all other files in case of metrics-all
-        query = "select f.id from file_types ft, files f " + \
-                "where f.id = ft.file_id and " + \
-                "ft.type in ('code', 'unknown') and " + \
-                "f.repository_id = ?"
-        read_cursor.execute(statement(query, db.place_holder), (repoid,))
-        code_files = [item[0] for item in read_cursor.fetchall()]
+        pending = PendingFileRevs(db, read_cursor, repoid)
+        pending.set_file_types(['code', 'unknown'])
+        if id_counter > 1:
+            pending.add_done(self.__get_metrics(pending))
+            pending.add_failed(self.__get_metrics_failed(pending))
 
         n_metrics = 0
         fr = FileRevs(db, cnn, read_cursor, repoid)
+        cache = MeasuresCache()
 
         for revision, commit_id, file_id, action_type, composed in fr:
-            if file_id not in code_files:
+            if not pending.is_wanted(file_id):
                 continue
 
             failed = False
 
-            if (file_id, commit_id) in metrics_failed:
+            if pending.is_failed(file_id, commit_id):
                 printdbg("%d@%d is already in the database, " + \
                          "but it failed, try again", (file_id, commit_id))
                 failed = True
-            elif(file_id, commit_id) in metrics:
+            elif pending.is_done(file_id, commit_id):
                 printdbg("%d@%d is already in the database, skip it", 
                          (file_id, commit_id))
                 continue
@@ -1012,7 +1073,7 @@ class Metrics(Extension):
                 continue
 
             job = MetricsJob(id_counter, file_id, commit_id, relative_path, 
-                             rev, failed)
+                             rev, failed, cache)
             job_pool.push(job)
             id_counter += 1
             n_metrics += 1
@@ -1027,6 +1088,7 @@ class Metrics(Extension):
 
         job_pool.join()
         self.__process_finished_jobs(job_pool, write_cursor, True)
+        close_git_cat_files()
                 
         profiler_start("Inserting results in db")
         self.__insert_many(write_cursor)
@@ -17,26 +17,22 @@
 # Authors :
 #       Alexander Pepper <pepper@inf.fu-berlin.de>
 
-from pycvsanaly2.Database import SqliteDatabase, MysqlDatabase, statement, \
-    ICursor, execute_statement, TableAlreadyExists
+from pycvsanaly2.Database import statement, KeysetCursor, \
+    execute_statement, TableAlreadyExists, BatchInsert, DBPatchLines, \
+    insert_ignore
 from pycvsanaly2.extensions import Extension, register_extension, \
-    ExtensionRunError
+    ExtensionRunError, restrict_to_new_commits
 from pycvsanaly2.utils import printdbg, printerr, printout, uri_to_filename, \
     to_utf8
 from pycvsanaly2.profile import profiler_start, profiler_stop
+from pycvsanaly2.Config import Config
+from pycvsanaly2.extensions.patch_format import decode_patch
+from pycvsanaly2.PatchParser import count_patch_lines
 from Progress import Progress
-import re
 
 class PatchLOC(Extension):
     deps = ['Patches']
     INTERVAL_SIZE = 100
-    patterns = {}
-    patterns['old_file'] = re.compile("^--- a\/")
-    patterns['no_old_file'] = re.compile("^--- \/dev\/null")
-    patterns['new_file'] = re.compile("^\+\+\+ b\/")
-    patterns['no_new_file'] = re.compile("^\+\+\+ \/dev\/null")
-    patterns['added'] = re.compile("^\+.?")#"^\+(?!\+)"
-    patterns['removed'] = re.compile("^-.?")#"^-(?!-)"
 
     def __init__(self):
         self.db = None
@@ -44,78 +40,35 @@ class PatchLOC(Extension):
     def __create_table(self, cnn):
         cursor = cnn.cursor()
 
-        if isinstance(self.db, SqliteDatabase):
-            import sqlite3.dbapi2
-
-            try:
-                cursor.execute("""CREATE TABLE patch_lines (
-                                id integer primary key AUTOINCREMENT,
-                                commit_id integer NOT NULL,
-                                file_id integer NOT NULL,
-                                added integer,
-                                removed integer,
-                                UNIQUE(commit_id, file_id)
-                                )""")
-            except sqlite3.dbapi2.OperationalError:
-                cursor.close()
-                raise TableAlreadyExists
-            except:
-                raise
-        elif isinstance(self.db, MysqlDatabase):
-            import MySQLdb
-
-            try:
-                cursor.execute("""CREATE TABLE patch_lines (
-                                id integer primary key auto_increment,
-                                commit_id integer NOT NULL,
-                                file_id integer NOT NULL,
-                                added int,
-                                removed int,
-                                UNIQUE(commit_id, file_id)
-                                ) CHARACTER SET=utf8""")
-            except MySQLdb.OperationalError, e:
-                if e.args[0] == 1050:
-                    cursor.close()
-                    raise TableAlreadyExists
-                raise
-            except:
-                raise
+        try:
+            self.db.create_patch_lines_table(cursor)
+        finally:
+            cursor.close()
 
         cnn.commit()
-        cursor.close()
 
     def get_patches(self, repo, repo_uri, repo_id, db, cursor):
-        icursor = ICursor(cursor, self.INTERVAL_SIZE)
+        icursor = KeysetCursor(cursor, ["p.id"], self.INTERVAL_SIZE,
+                               db.place_holder)
         # Get the patches from this repository
-        query = """select p.commit_id, p.file_id, p.patch, s.rev
+        query = """select p.id, p.commit_id, p.file_id, p.patch, s.rev
                     from patches p, scmlog s
                     where p.commit_id = s.id and
                     s.repository_id = ? and
-                    p.patch is not NULL"""
-        icursor.execute(statement(query, db.place_holder), (repo_id,))
+                    p.patch is not NULL and
+                    not exists (select pl.id from patch_lines pl
+                                where pl.commit_id = p.commit_id and
+                                pl.file_id = p.file_id)"""
+        query, args = restrict_to_new_commits(query, (repo_id,))
+        icursor.execute(statement(query, db.place_holder), args)
         rs = icursor.fetchmany()
         while rs:
-            for commit_id, file_id, patch_content, rev in rs:
-                yield (commit_id, file_id, to_utf8(patch_content), rev)
+            for patch_id, commit_id, file_id, patch_content, rev in rs:
+                yield (commit_id, file_id, decode_patch(patch_content), rev)
             rs = icursor.fetchmany()
 
     def count_lines(self, patch_content):
-        added = 0
-        removed = 0
-
-        for line in patch_content.split("\n"):
-            if self.patterns['old_file'].match(line) or self.patterns['no_old_file'].match(line):
-                # skip line
-                continue
-            elif self.patterns['new_file'].match(line) or self.patterns['no_new_file'].match(line):
-                # skip line
-                continue
-            elif self.patterns['added'].match(line):
-                added += 1
-            elif self.patterns['removed'].match(line):
-                removed += 1
-
-        return (added, removed)
+        return count_patch_lines(patch_content)
 
     def run(self, repo, uri, db):
         profiler_start("Running PatchLOC extension")
@@ -142,32 +95,38 @@ class PatchLOC(Extension):
         except Exception, e:
             raise ExtensionRunError(str(e))
 
-        cursor.execute(statement("""select COUNT(*)
+        query, args = restrict_to_new_commits("""select COUNT(*)
                         from patches p, scmlog s
                         where p.commit_id = s.id and
                         s.repository_id = ? and
-                        p.patch is not NULL""",
-            db.place_holder), (repo_id,))
+                        p.patch is not NULL and
+                        not exists (select pl.id from patch_lines pl
+                                    where pl.commit_id = p.commit_id and
+                                    pl.file_id = p.file_id)""", (repo_id,))
+        cursor.execute(statement(query, db.place_holder), args)
         nr_records = cursor.fetchone()[0]
         progress = Progress("[Extension PatchesLOC]", nr_records)
 
         patches = self.get_patches(repo, path or repo.get_uri(), repo_id, db,
                                    cursor)
 
+        write_cursor = connection.cursor()
+        insert = BatchInsert(connection, write_cursor,
+                             statement(insert_ignore(db,
+                                                     DBPatchLines.__insert__),
+                                       db.place_holder),
+                             Config().insert_batch_size,
+                             Config().commit_interval,
+                             exception=ExtensionRunError)
+
         for commit_id, file_id, patch_content, rev in patches:
             (added, removed) = self.count_lines(patch_content)
-            insert = """insert into patch_lines(file_id, commit_id,
-                        added, removed)
-                        values(?,?,?,?)"""
-            execute_statement(statement(insert, db.place_holder),
-                              (file_id, commit_id, added, removed),
-                               cursor,
-                               db,
-                               "Couldn't insert patch, dup record?",
-                               exception=ExtensionRunError)
-            connection.commit()
+            insert.add((file_id, commit_id, added, removed))
+            insert.end_group()
             progress.finished_one()
 
+        insert.flush()
+        write_cursor.close()
         cursor.close()
         connection.commit()
         connection.close()
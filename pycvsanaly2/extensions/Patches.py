@@ -21,17 +21,27 @@
 from repositoryhandler.backends.watchers import DIFF
 from repositoryhandler.Command import CommandError, CommandRunningError
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase,
-        TableAlreadyExists, statement, ICursor, execute_statement)
+        TableAlreadyExists, statement, KeysetCursor, execute_statement)
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.Config import Config
 from pycvsanaly2.extensions import (Extension, register_extension,
-    ExtensionRunError)
-from pycvsanaly2.utils import to_utf8, printerr, printdbg, uri_to_filename
+    ExtensionRunError, restrict_to_new_commits)
+from pycvsanaly2.utils import (to_utf8, printerr, printdbg, printout,
+                                uri_to_filename)
+from pycvsanaly2.Command import Command, CommandError as GitCommandError
+from pycvsanaly2.FindProgram import find_program
 from io import BytesIO
+import os
 from Jobs import JobPool, Job
 from pycvsanaly2.PatchParser import *
 from Progress import Progress
 from pycvsanaly2.extensions.FilePaths import FilePaths
+from pycvsanaly2.extensions.patch_format import (encode_patch,
+                                                 prepare_patches_table)
+
+
+def _decode_patch(data):
+    return to_utf8(unicode(to_utf8(data), "utf-8", errors='replace')).strip()
 
 
 class PatchJob(Job):
@@ -54,7 +64,7 @@ class PatchJob(Job):
         while not done and not failed:
             try:
                 self.repo.show(self.repo_uri, self.rev, ignore_whitespaces=True)
-                self.data = to_utf8(unicode(to_utf8(io.getvalue()), "utf-8", errors='replace')).strip()
+                self.data = _decode_patch(io.getvalue())
                 done = True
             except (CommandError, CommandRunningError) as e:
                 if retries > 0:
@@ -78,35 +88,114 @@ class PatchJob(Job):
         self.get_patch_for_commit()
 
 
+class GitPatchesReader(object):
+    """Reads the patches of the commits of a Git repository from a
+       single git log -p, instead of running git show for every
+       commit. The diff of every commit is given to patch_cb with
+       the rev, in the same format PatchJob gets them. With heads,
+       the commits reachable from them are not read.
+    """
+
+    # Starts the line with the rev of every commit,
+    # no diff line starts with it
+    MARKER = '\0'
+
+    def __init__(self, uri, branch=None, heads=None):
+        self.uri = uri
+        self.branch = branch
+        self.heads = heads or []
+        self.rev = None
+        self.lines = []
+
+    def __flush(self, patch_cb):
+        if self.rev is not None:
+            patch_cb(self.rev, _decode_patch(''.join(self.lines)))
+        self.rev = None
+        self.lines = []
+
+    def run(self, patch_cb):
+        def new_line(line):
+            if line.startswith(self.MARKER):
+                self.__flush(patch_cb)
+                self.rev = line[1:].strip()
+            else:
+                self.lines.append(line)
+
+        # Same whitespace options and merge diffs used by git show
+        cmd = [find_program('git') or 'git', 'log', '-p', '--cc', '-w',
+               '--reverse', '--pretty=format:%x00%H']
+        if self.branch is not None:
+            cmd.append(self.branch)
+        else:
+            cmd.append('--all')
+        cmd.extend(['^' + rev for rev in self.heads])
+
+        try:
+            Command(cmd, self.uri).run(parser_out_func=new_line)
+        except:
+            # The last commit might be incomplete
+            self.rev = None
+            self.lines = []
+            raise
+
+        self.__flush(patch_cb)
+
+
+def get_file_ids(cursor, db, commit_ids):
+    """Returns a dict with the path -> file id map of the files
+       changed by every one of the given commits"""
+    file_ids = dict([(commit_id, {}) for commit_id in commit_ids])
+    if not file_ids:
+        return file_ids
+
+    query = "SELECT commit_id, current_file_path, file_id from actions " + \
+            "where commit_id in (%s) order by id" % \
+            (",".join(["?"] * len(file_ids)),)
+    cursor.execute(statement(query, db.place_holder), file_ids.keys())
+    rs = cursor.fetchmany()
+    while rs:
+        for commit_id, file_path, file_id in rs:
+            file_ids[commit_id].setdefault(to_utf8(file_path), file_id)
+        rs = cursor.fetchmany()
+
+    return file_ids
+
+
 class DBPatch(object):
 
     __insert__ = """INSERT INTO patches (commit_id, file_id, patch)
                     values (?, ?, ?)"""
 
-    def __init__(self, db, commit_id, data):
+    def __init__(self, db, commit_id, data, file_ids=None):
+        """file_ids is the path -> file id map of the commit, as
+           returned by get_file_ids. Without it, every file id is
+           queried"""
         self.db = db;
         self.commit_id = commit_id
         self.data = data
-        self.fp = FilePaths(self.db)
+        self.file_ids = file_ids
+        if file_ids is None:
+            self.fp = FilePaths(self.db)
         
     def file_patches(self):
         lines = [l+"\n" for l in self.data.split("\n") if l]
         
-        cnn = self.db.connect()
         for f in iter_file_patch(lines, True):
             try:
                 patch = parse_patch(f.__iter__(), allow_dirty=True)
             except PatchSyntax, BinaryFiles:
                 continue
             file_name = patch.file_name()
-            file_id = self.fp.get_file_id(file_name, self.commit_id)
+            if self.file_ids is not None:
+                file_id = self.file_ids.get(file_name)
+            else:
+                file_id = self.fp.get_file_id(file_name, self.commit_id)
             
             if file_id is None:
                 printerr("\nFile id for %s @  %s not found" % (file_name, self.commit_id))
                 continue
             else:
                 yield file_id, patch
-        cnn.close()
 
     def __str__(self):
         return "<commit_id: %s, data: %s>" % \
@@ -162,31 +251,87 @@ class Patches(Extension):
         cnn.commit()
         cursor.close()
 
-    def __process_finished_jobs(self, job_pool, write_cursor, db):
-        finished_job = job_pool.get_next_done()
+    def __insert_patches(self, patches, write_cursor, db):
+        """Inserts the patches of a list of (commit_id, data),
+           getting the file ids of all the commits at once"""
+        file_ids = get_file_ids(write_cursor, db,
+                                [commit_id for commit_id, data in patches])
+
+        for commit_id, data in patches:
+            p = DBPatch(db, commit_id, data, file_ids[commit_id])
 
-        # scmlog_id is the commit ID. For some reason, the
-        # documentation advocates tablename_id as the reference,
-        # but in the source, these are referred to as commit IDs.
-        # Don't ask me why!
-        num_processed_jobs = 0
-        while finished_job is not None:
-            p = DBPatch(db, finished_job.commit_id, finished_job.data)
-            
             for file_id, patch in p.file_patches():
 #                printerr("Inserting patch for file %d at commit %d" % (file_id, p.commit_id))
                 execute_statement(statement(DBPatch.__insert__,
                                             self.db.place_holder),
-                                  (p.commit_id, file_id, str(patch)),
+                                  (p.commit_id, file_id,
+                                   encode_patch(db, str(patch))),
                                   write_cursor,
                                   db,
                                   "\nCouldn't insert, duplicate patch?",
                                   exception=ExtensionRunError)
-            num_processed_jobs += 1
+
+    def __process_finished_jobs(self, job_pool, write_cursor, db):
+        finished_job = job_pool.get_next_done()
+
+        # scmlog_id is the commit ID. For some reason, the
+        # documentation advocates tablename_id as the reference,
+        # but in the source, these are referred to as commit IDs.
+        # Don't ask me why!
+        patches = []
+        while finished_job is not None:
+            patches.append((finished_job.commit_id, finished_job.data))
             finished_job = job_pool.get_next_done(0)
-            self.progress.finished_one()
+
+        self.__insert_patches(patches, write_cursor, db)
+        self.progress.finished(len(patches))
             
-        return num_processed_jobs
+        return len(patches)
+
+    def __read_git_patches(self, commits, cnn, write_cursor, db):
+        """Inserts the patches of the given commits, a dict of rev ->
+           commit id, streaming them from git log. The commits
+           found are removed from the dict."""
+        def flush():
+            self.__insert_patches(patches, write_cursor, db)
+            self.progress.finished(len(patches))
+            cnn.commit()
+            del patches[:]
+
+        def patch_cb(rev, data):
+            commit_id = commits.pop(rev, None)
+            if commit_id is None:
+                # Not in scmlog, or already done
+                return
+
+            patches.append((commit_id, data))
+            if len(patches) >= self.INTERVAL_SIZE:
+                flush()
+
+        patches = []
+        # In incremental mode, only the commits that are not reachable
+        # from the heads mined in the previous run
+        heads = Config().known_heads
+        reader = GitPatchesReader(self.repo_uri, Config().branch, heads)
+        try:
+            reader.run(patch_cb)
+        except GitCommandError, e:
+            printerr("Error reading the patches from git log: %s", (e.error,))
+            if heads:
+                # Most likely a head that doesn't exist anymore
+                # (rewritten history), git fails before any output
+                flush()
+                reader = GitPatchesReader(self.repo_uri, Config().branch)
+                try:
+                    reader.run(patch_cb)
+                except GitCommandError, e:
+                    printerr("Error reading the patches from git log: %s",
+                             (e.error,))
+        flush()
+
+        if commits:
+            printout("Getting the patches of %d remaining commits",
+                     (len(commits),))
 
     def run(self, repo, uri, db):
         profiler_start("Running Patches extension")
@@ -218,23 +363,42 @@ class Patches(Extension):
         except Exception, e:
             raise ExtensionRunError(str(e))
 
+        if Config().compress_patches:
+            prepare_patches_table(db, cnn)
+
         queuesize = Config().max_threads
         job_pool = JobPool(repo, path or repo.get_uri(), queuesize=queuesize)
         i = 0
 
-        icursor = ICursor(cursor, self.INTERVAL_SIZE)
-        icursor.execute(statement("SELECT id, rev, composed_rev " + \
-                                  "from scmlog where repository_id = ?",
-                                    db.place_holder), (repo_id,))
+        icursor = KeysetCursor(cursor, ["id"], self.INTERVAL_SIZE,
+                               db.place_holder)
+        query, args = restrict_to_new_commits("SELECT id, rev, composed_rev " + \
+                                              "from scmlog " + \
+                                              "where repository_id = ?",
+                                              (repo_id,), "id")
+        icursor.execute(statement(query, db.place_holder), args)
         rs = icursor.fetchmany()
 
-        cursor.execute(statement("""select COUNT(*)
+        query, args = restrict_to_new_commits("""select COUNT(*)
                         from scmlog
-                        where repository_id = ?""",
-            db.place_holder), (repo_id,))
+                        where repository_id = ?""", (repo_id,), "id")
+        cursor.execute(statement(query, db.place_holder), args)
         nr_records = cursor.fetchone()[0]
         self.progress = Progress("[Extension Patches]", nr_records)
 
+        if repo.get_type() == 'git' and os.path.isdir(self.repo_uri) and \
+           nr_records > self.INTERVAL_SIZE:
+            # A single git log for all of them, the commits that
+            # aren't found there are done one by one
+            commits = {}
+            while rs:
+                commits.update([(rev, commit_id)
+                                for commit_id, rev, composed_rev in rs])
+                rs = icursor.fetchmany()
+            self.__read_git_patches(commits, cnn, write_cursor, db)
+            rs = [(commit_id, rev, False)
+                  for rev, commit_id in commits.iteritems()]
+
         while rs:
             for commit_id, revision, composed_rev in rs:
                 if composed_rev:
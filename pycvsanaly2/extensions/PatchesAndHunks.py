@@ -20,13 +20,13 @@
 from repositoryhandler.backends.watchers import DIFF
 from repositoryhandler.Command import CommandError, CommandRunningError
 from pycvsanaly2.Database import (SqliteDatabase, MysqlDatabase,
-        TableAlreadyExists, statement, ICursor, execute_statement)
+        TableAlreadyExists, statement, KeysetCursor, execute_statement)
 from pycvsanaly2.profile import profiler_start, profiler_stop
 from pycvsanaly2.Config import Config
 from pycvsanaly2.extensions import (Extension, register_extension,
-    ExtensionRunError)
+    ExtensionRunError, restrict_to_new_commits)
 from pycvsanaly2.extensions.Hunks import Hunks
-from pycvsanaly2.extensions.Patches import PatchJob, DBPatch
+from pycvsanaly2.extensions.Patches import PatchJob, DBPatch, get_file_ids
 from pycvsanaly2.utils import printerr, printdbg, uri_to_filename
 from io import BytesIO
 from Jobs import JobPool, Job
@@ -40,14 +40,18 @@ class PatchesAndHunks(Extension):
 
     def run(self, repo, uri, db):
         def patch_generator(repo, repo_uri, repo_id, db, cursor):
-            icursor = ICursor(cursor, self.INTERVAL_SIZE)
-            icursor.execute(statement("SELECT id, rev, composed_rev " + \
-                                      "from scmlog where repository_id = ?",
-                                      db.place_holder), (repo_id,))
+            icursor = KeysetCursor(cursor, ["id"], self.INTERVAL_SIZE,
+                                   db.place_holder)
+            query, args = restrict_to_new_commits(
+                "SELECT id, rev, composed_rev " + \
+                "from scmlog where repository_id = ?", (repo_id,), "id")
+            icursor.execute(statement(query, db.place_holder), args)
 
             rs = icursor.fetchmany()
 
             while rs:
+                file_ids = get_file_ids(cursor, db,
+                                        [row[0] for row in rs])
                 for commit_id, revision, composed_rev in rs:
                     # Get the patch
                     pj = PatchJob(revision, commit_id)
@@ -55,7 +59,7 @@ class PatchesAndHunks(Extension):
                     path = uri_to_filename(repo_uri)
                     pj.run(repo, path or repo.get_uri())
 
-                    p = DBPatch(db, commit_id, pj.data)
+                    p = DBPatch(db, commit_id, pj.data, file_ids[commit_id])
                     # Yield the patch to hunks
                     for file_id, patch in p.file_patches():
                         yield (pj.commit_id, file_id, patch, pj.rev)
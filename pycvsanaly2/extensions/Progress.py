@@ -33,5 +33,8 @@ class Progress(object):
         self.pbar.finish()
 
     def finished_one(self):
-        self.nr_done += 1
+        self.finished(1)
+
+    def finished(self, n):
+        self.nr_done += n
         self.pbar.update(self.nr_done)
@@ -24,8 +24,10 @@ from pycvsanaly2.utils import printdbg
 from pycvsanaly2.Database import (statement, execute_statement, get_repo_id,
                                   RepoNotFound)
 from pycvsanaly2.utils import get_repo_uri
+from pycvsanaly2.Config import Config
 
-__all__ = ['Extension', 'get_extension', 'register_extension']
+__all__ = ['Extension', 'get_extension', 'register_extension',
+           'restrict_to_new_commits']
 
 
 class ExtensionUnknownError(Exception):
@@ -80,6 +82,20 @@ class Extension(object):
 from pycvsanaly2.utils import printerr
 
 
+def restrict_to_new_commits(query, args, column="s.id"):
+    """Restrict a query to the commits mined in this run when running in
+       incremental mode. The query must end in its where clause, column
+       is the commit id it has to be restricted on.
+
+       Returns the new query and arguments.
+    """
+    first_commit = Config().first_new_commit
+    if first_commit is None:
+        return query, args
+
+    return query + " and %s >= ?" % (column,), args + (first_commit,)
+
+
 _extensions = {}
 _unavailable_extensions = {}
 
@@ -376,13 +376,75 @@ config_files = [('image', config_files_images),
     ('devel-doc', config_files_devel_doc)]
 
 
-def guess_file_type(filename):
+# Patterns that only match an extension, like \.c$
+_extension_re = re.compile(r'^\\\.((?:[A-Za-z0-9_~-]|\\\+)+)\$$')
+
+
+def _build_classifier():
+    """Returns a table with the type of every extension matched by
+       a single pattern, and the rest of patterns in order. Both keep
+       the position of every pattern in config_files, so that the
+       first matching one can be found."""
+    extensions = {}
+    others = []
+    pos = 0
     for type, patt_list in config_files:
         for patt in patt_list:
-            if patt.search(filename.lower()):
-                return type
-            
-    return 'unknown'
+            m = _extension_re.match(patt.pattern)
+            if m is not None:
+                extension = m.group(1).replace('\\+', '+')
+                extensions.setdefault(extension, (pos, type))
+            else:
+                others.append((pos, type, patt))
+            pos += 1
+
+    return extensions, others
+
+_extensions, _others = _build_classifier()
+# Matches when any of _others does, most file names don't
+_any_other = re.compile('|'.join(['(?:%s)' % (patt.pattern,) \
+                                  for pos, type, patt in _others]))
+
+# Type of the last classified file names
+MAX_CACHED_TYPES = 100000
+_types_cache = {}
+
+
+def guess_file_type(filename):
+    try:
+        return _types_cache[filename]
+    except KeyError:
+        pass
+
+    name = filename.lower()
+    type = None
+
+    dot = name.rfind('.')
+    if dot >= 0:
+        extension = name[dot + 1:]
+        if extension.endswith('\n'):
+            # $ also matches before a trailing line break
+            extension = extension[:-1]
+        type = _extensions.get(extension)
+
+    if _any_other.search(name):
+        for pos, other_type, patt in _others:
+            if type is not None and pos > type[0]:
+                break
+            if patt.search(name):
+                type = (pos, other_type)
+                break
+
+    if type is None:
+        type = 'unknown'
+    else:
+        type = type[1]
+
+    if len(_types_cache) >= MAX_CACHED_TYPES:
+        _types_cache.clear()
+    _types_cache[filename] = type
+
+    return type
 
 if __name__ == '__main__':
     import sys
@@ -18,14 +18,51 @@
 #       Alexander Pepper <pepper@inf.fu-berlin.de>
 
 from pygments.lexers import get_lexer_for_filename, guess_lexer, TextLexer
+from pygments.token import Token
 from pygments.util import ClassNotFound
-from repositoryhandler.backends.watchers import CAT
 from repositoryhandler.Command import CommandError, CommandRunningError
 from pycvsanaly2.utils import to_utf8, printerr, printdbg
-from io import BytesIO
+from pycvsanaly2.extensions.CatFile import cat_file, get_blob_id, blob_hash
+from collections import OrderedDict
+import threading
 import os
 from pygments.lexers import NemerleLexer
 
+# Line type codes
+LINE_EMPTY = 0
+LINE_COMMENT = 1
+LINE_CODE = 2
+
+# Line types of the last lexed file revisions, keyed by
+# (blob id, lexer name), most recently used last
+MAX_CACHED_LINE_TYPES = 256
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_get(key):
+    _cache_lock.acquire()
+    try:
+        line_types = _cache.pop(key)
+        _cache[key] = line_types
+        return line_types
+    except KeyError:
+        return None
+    finally:
+        _cache_lock.release()
+
+
+def _cache_put(key, line_types):
+    _cache_lock.acquire()
+    try:
+        _cache.pop(key, None)
+        if len(_cache) >= MAX_CACHED_LINE_TYPES:
+            _cache.popitem(last=False)
+        _cache[key] = line_types
+    finally:
+        _cache_lock.release()
+
+
 def _convert_linebreaks(input):
     """Converts all linebreaks (e.g. from windows) to one format"""
 
@@ -38,100 +75,143 @@ def _strip_lines(text):
     text_array = map(lambda s: s.strip(), text.split("\n"))
     return "\n".join(text_array)
 
-def _get_file_content(repo, uri, rev):
+def _get_file_content(repo, repo_uri, path, rev):
     """Reads the content of a file and revision from a given repository"""
 
-    def write_line(data, io):
-        io.write(data)
-
-    io = BytesIO()
-    wid = repo.add_watch(CAT, write_line, io)
     try:
-        repo.cat(uri, rev)
-        file_content = to_utf8(io.getvalue()).decode("utf-8")
+        file_content = to_utf8(cat_file(repo, repo_uri, path, rev)).decode("utf-8")
         file_content = _convert_linebreaks(file_content) #make shure we do have the same new lines.
     except Exception as e:
         printerr("[get_line_types] Error running show command: %s, FAILED", (str(e),))
         file_content = None
 
-    repo.remove_watch(CAT, wid)
     return file_content
 
-def _iterate_lexer_output(iterator):
-    """Iterate Lexer Output and build an array from it.
-       Each item in Array is another Array which represents a line"""
-
-    output_lines = []
-    output_line = []
-    for ttype, value in iterator:
-        input_lines = value.split("\n")
-        for i in range(len(input_lines)):
-            item = {}
-            item["token"] = str(ttype)
-            item["value"] = to_utf8(input_lines[i]).decode("utf-8")
-            if (item["value"] != '') or (i == 0):
-                output_line.append(item)
-            if (len(input_lines) > 1) and (i < len(input_lines)-1):
-                output_lines.append(output_line)
-                output_line = []
-    return output_lines
-
-def _comment_empty_or_code(lines_array):
-    """Decides what type a line is.
+_COMMENT_TOKENS = (Token.Comment.Single, Token.Comment.Multiline)
+
+def _line_type(n_tokens, first_token, first_empty):
+    """Decides what type a line is, given the number of tokens in it
+       and the type of the first one.
        Possible values:
-       * code - if excecutable code
-       * comment - a nonexecutable comment
-       * empty - an empty line (or only containing whitespaces)"""
-
-    output = ""
-    for line in lines_array:
-        if (len(line) < 1):
-            output += "empty\n"
+       * LINE_CODE - if excecutable code
+       * LINE_COMMENT - a nonexecutable comment
+       * LINE_EMPTY - an empty line (or only containing whitespaces)"""
+
+    if n_tokens == 0:
+        return LINE_EMPTY
+    if n_tokens == 1:
+        if first_token is Token.Text and first_empty:
+            return LINE_EMPTY
+        if first_token in _COMMENT_TOKENS:
+            return LINE_COMMENT
+    return LINE_CODE
+
+def _classify_lines(tokens):
+    """Consumes the lexer output and returns a bytearray with the
+       type of every line ended by a line break.
+       Only the number of tokens in the current line and the first
+       of them are kept, since that's all a line type depends on."""
+
+    output = bytearray()
+    n_tokens = 0
+    first_token = None
+    first_empty = False
+    for ttype, value in tokens:
+        nl = value.find("\n")
+        if n_tokens == 0:
+            first_token = ttype
+            first_empty = (nl == 0 or value == "")
+        n_tokens += 1
+        if nl < 0:
             continue
-        first_token = line[0]["token"]
-        first_value = line[0]["value"]
-        if (len(line) == 1) & (first_token == "Token.Text") & (first_value == ""):
-            output += "empty\n"
-        elif (len(line) == 1) & ((first_token == "Token.Comment.Single") | (first_token == "Token.Comment.Multiline")):
-            output += "comment\n"
+
+        output.append(_line_type(n_tokens, first_token, first_empty))
+
+        rest = value[nl + 1:]
+        if "\n" in rest:
+            # Lines entirely inside this token
+            pieces = rest.split("\n")
+            rest = pieces.pop()
+            for piece in pieces:
+                if piece:
+                    output.append(_line_type(1, ttype, False))
+                else:
+                    output.append(LINE_EMPTY)
+
+        if rest:
+            n_tokens = 1
+            first_token = ttype
+            first_empty = False
         else:
-            output += "code\n"
+            n_tokens = 0
 
     return output
 
+def _get_lexer(path, rev, file_content=None):
+    """Returns the lexer for path, or None if it has to be guessed
+       and no file_content is given"""
+
+    try:
+        lexer = get_lexer_for_filename(path)
+    except ClassNotFound:
+        if file_content is None:
+            return None
+        try:
+            printdbg("[get_line_types] Guessing lexer for" + str(rev) + ":" + str(path) + ".")
+            lexer = guess_lexer(file_content)
+        except ClassNotFound:
+            printdbg("[get_line_types] No guess or lexer found for " + str(rev) + ":" + str(path) + ". Using TextLexer instead.")
+            lexer = TextLexer()
+
+    if isinstance(lexer, NemerleLexer):
+        # this lexer is broken and yield an unstoppable process
+        # see https://bitbucket.org/birkenfeld/pygments-main/issue/706/nemerle-lexer-ends-in-an-infinite-loop
+        lexer = TextLexer()
+
+    return lexer
+
 def get_line_types(repo, repo_uri, rev, path):
-    """Returns an array, where each item means a line of code.
-       Each item is labled 'code', 'comment' or 'empty'"""
+    """Returns a bytearray, where each item means a line of code.
+       Each item is LINE_CODE, LINE_COMMENT or LINE_EMPTY.
+
+       The line types of the last MAX_CACHED_LINE_TYPES file revisions
+       are cached by blob id and lexer, so the same revision isn't
+       read and lexed again. The returned bytearray must not be
+       modified."""
 
     #profiler_start("Processing LineTypes for revision %s:%s", (self.rev, self.file_path))
-    uri = os.path.join(repo_uri, path) # concat repo_uri and file_path for full path
-    file_content = _get_file_content(repo, uri, rev)  # get file_content
+    try:
+        blob_id = get_blob_id(repo, repo_uri, path, rev)
+    except Exception:
+        blob_id = None
+
+    lexer = _get_lexer(path, rev)
+    if blob_id is not None and lexer is not None:
+        key = (blob_id, lexer.name)
+        line_types = _cache_get(key)
+        if line_types is not None:
+            return line_types
+
+    file_content = _get_file_content(repo, repo_uri, path, rev)  # get file_content
 
     if file_content is None or file_content == '':
         printerr("[get_line_types] Error: No file content for " + str(rev) + ":" + str(path) + " found! Skipping.")
-        line_types = None
-    else:
-        try:
-            lexer = get_lexer_for_filename(path)
-        except ClassNotFound:
-            try:
-                printdbg("[get_line_types] Guessing lexer for" + str(rev) + ":" + str(path) + ".")
-                lexer = guess_lexer(file_content)
-            except ClassNotFound:
-                printdbg("[get_line_types] No guess or lexer found for " + str(rev) + ":" + str(path) + ". Using TextLexer instead.")
-                lexer = TextLexer()
-
-        if isinstance(lexer, NemerleLexer):
-            # this lexer is broken and yield an unstoppable process
-            # see https://bitbucket.org/birkenfeld/pygments-main/issue/706/nemerle-lexer-ends-in-an-infinite-loop
-            lexer = TextLexer()
-
-        # Not shure if this should be skipped, when the language uses off-side rules (e.g. python,
-        # see http://en.wikipedia.org/wiki/Off-side_rule for list)
-        stripped_code = _strip_lines(file_content)
-        lexer_output = _iterate_lexer_output(lexer.get_tokens(stripped_code))
-        line_types_str = _comment_empty_or_code(lexer_output)
-        line_types = line_types_str.split("\n")
+        return None
+
+    if lexer is None:
+        lexer = _get_lexer(path, rev, file_content)
+    if blob_id is None:
+        blob_id = blob_hash(file_content.encode("utf-8"))
+    key = (blob_id, lexer.name)
+    line_types = _cache_get(key)
+    if line_types is not None:
+        return line_types
+
+    # Not shure if this should be skipped, when the language uses off-side rules (e.g. python,
+    # see http://en.wikipedia.org/wiki/Off-side_rule for list)
+    stripped_code = _strip_lines(file_content)
+    line_types = _classify_lines(lexer.get_tokens(stripped_code))
+    _cache_put(key, line_types)
 
     return line_types
     #profiler_stop("Processing LineTypes for revision %s:%s", (self.rev, self.file_path))
@@ -145,4 +225,30 @@ def line_is_code(line_types_array, line_nr):
         printdbg("Line lexer output. Must be an empty line!")
         line_type = None
 
-    return line_type == "code"
+    return line_type == LINE_CODE
+
+
+if __name__ == '__main__':
+    # Micro-benchmark of the line classifier:
+    # line_types.py file [iterations]
+    import sys
+    import time
+
+    path = sys.argv[1]
+    iterations = len(sys.argv) > 2 and int(sys.argv[2]) or 10
+
+    code = _strip_lines(_convert_linebreaks(
+        to_utf8(open(path).read()).decode("utf-8")))
+    lexer = _get_lexer(path, None, code)
+    tokens = list(lexer.get_tokens(code))
+
+    start = time.time()
+    for i in xrange(iterations):
+        line_types = _classify_lines(tokens)
+    elapsed = time.time() - start
+
+    print "%s: %d tokens, %d lines (%s)" % \
+          (path, len(tokens), len(line_types), lexer.name)
+    print "%.0f tokens/second, %.0f lines/second" % \
+          (len(tokens) * iterations / elapsed,
+           len(line_types) * iterations / elapsed)
@@ -0,0 +1,127 @@
+# Copyright (C) 2008 LibreSoft
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Storage format of the patches table. Patches are stored either as
+plain text or, with compress_patches, compressed with zlib and
+prefixed by ZLIB_MARKER. Readers use decode_patch, which accepts both,
+so a database can hold a mix of them.
+"""
+
+if __name__ == '__main__':
+    import sys
+    sys.path.insert(0, "../../")
+
+from pycvsanaly2.Database import MysqlDatabase, statement, KeysetCursor
+from pycvsanaly2.Config import Config
+from pycvsanaly2.utils import to_utf8, printdbg, printout
+import zlib
+
+# Compressed patches start with it, no patch in text does
+ZLIB_MARKER = '\0zlib\0'
+
+
+def encode_patch(db, patch):
+    """Returns the value to store in the database for the given
+       patch text, compressed if compress_patches is enabled"""
+    if not Config().compress_patches:
+        return patch
+
+    return db.to_binary(ZLIB_MARKER + zlib.compress(to_utf8(patch)))
+
+
+def decode_patch(value):
+    """Returns the patch text (in UTF-8) of a value stored in the
+       patches table, compressed or not"""
+    if value is None:
+        return None
+
+    if not isinstance(value, unicode):
+        value = str(value)
+        if value.startswith(ZLIB_MARKER):
+            return zlib.decompress(value[len(ZLIB_MARKER):])
+
+    return to_utf8(value)
+
+
+def prepare_patches_table(db, cnn):
+    """Makes sure the patch column of the patches table can store
+       compressed patches. It's a LONGTEXT in MySQL, that has to be
+       turned into a LONGBLOB. SQLite columns take both."""
+    if not isinstance(db, MysqlDatabase):
+        return
+
+    cursor = cnn.cursor()
+    cursor.execute("""SELECT data_type from information_schema.columns
+                      where table_schema = database() and
+                      table_name = 'patches' and column_name = 'patch'""")
+    row = cursor.fetchone()
+    if row is not None and row[0].lower() != 'longblob':
+        printdbg("Changing patches.patch from %s to LONGBLOB", (row[0],))
+        cursor.execute("ALTER TABLE patches MODIFY patch LONGBLOB")
+        cnn.commit()
+    cursor.close()
+
+
+def compress_patches(db, interval_size=100):
+    """Compresses the patches of the database stored as text.
+       Returns the number of patches compressed."""
+    cnn = db.connect()
+    prepare_patches_table(db, cnn)
+
+    cursor = cnn.cursor()
+    write_cursor = cnn.cursor()
+    icursor = KeysetCursor(cursor, ["id"], interval_size, db.place_holder)
+    icursor.execute("SELECT id, patch from patches where patch is not NULL")
+
+    update = statement("UPDATE patches set patch = ? where id = ?",
+                       db.place_holder)
+    n_patches = 0
+    old_size = new_size = 0
+    rs = icursor.fetchmany()
+    while rs:
+        updates = []
+        for patch_id, value in rs:
+            if not isinstance(value, unicode) and \
+               str(value).startswith(ZLIB_MARKER):
+                continue
+
+            patch = to_utf8(value)
+            compressed = ZLIB_MARKER + zlib.compress(patch)
+            updates.append((db.to_binary(compressed), patch_id))
+            old_size += len(patch)
+            new_size += len(compressed)
+
+        if updates:
+            write_cursor.executemany(update, updates)
+            cnn.commit()
+            n_patches += len(updates)
+        rs = icursor.fetchmany()
+
+    write_cursor.close()
+    cursor.close()
+    cnn.close()
+
+    printout("%d patches compressed, from %d to %d bytes",
+             (n_patches, old_size, new_size))
+
+    return n_patches
+
+
+if __name__ == '__main__':
+    from pycvsanaly2.Database import create_database
+
+    compress_patches(create_database('sqlite', sys.argv[1]))
@@ -31,13 +31,15 @@ Main funcion of cvsanaly. Fun starts here!
 import os
 import sys
 import getopt
+import multiprocessing
+from time import time
 from repositoryhandler.backends import (create_repository,
     create_repository_from_path, RepositoryUnknownError)
 from ParserFactory import (create_parser_from_logfile,
     create_parser_from_repository)
 from Database import (create_database, TableAlreadyExists, AccessDenied,
     DatabaseNotFound, DatabaseDriverNotSupported, DBRepository, statement,
-    initialize_ids, DatabaseException)
+    initialize_ids, DatabaseException, get_repo_id, get_branch_heads)
 from DBProxyContentHandler import DBProxyContentHandler
 from Log import LogReader, LogWriter
 from extensions import get_all_extensions, get_unavailable_extensions
@@ -47,6 +49,7 @@ from Config import Config, ErrorLoadingConfig
 from utils import printerr, printout, uri_to_filename, printdbg
 from _config import *
 from DBDeletionHandler import DBDeletionHandler
+from extensions.patch_format import compress_patches
 
 
 def usage():
@@ -87,6 +90,10 @@ Options:
   -s, --save-logfile[=path]      Save the repository log to the given path
   -n, --no-parse                 Skip the parsing process. It only makes sense
                                  in conjunction with --extensions
+      --incremental              Only parse the commits added since the last
+                                 run (only works for Git right now, other
+                                 repositories read the whole log) and run
+                                 the extensions on them
       --extensions=ext1,ext2,    List of extensions to run. Currently available 
                                  extensions are:
                                  \t"""+extensionhelp+"""
@@ -95,14 +102,14 @@ Options:
       --branch=[branch]          Specify local branch that should be monitored.
                                  For remote branches add "remote_name/branch_name".
                                  (only works for Git right now)
-      --low-memory               Changes cvsanaly to store certain caches on
-                                 the hard drive. This is not well-supported,
-                                 only use if you are having out-of-memory
-                                 problems (usually because your repo is very
-                                 large). This may also cause cvsanaly to run
-                                 slower, as it is not caching in memory, and
-                                 is somewhat paranoid about the integrity of
-                                 the on-disk cache, so will often empty it.
+      --low-memory               Keep only the most recently used revisions
+                                 in the revision to commit map of the blame
+                                 extensions, querying the database for the
+                                 rest. Slower, only use if you are having
+                                 out-of-memory problems. It doesn't apply to
+                                 FilePaths, whose path index is always in
+                                 memory (it grows with the files, renames
+                                 and moves, not with the commits)
       --analyze-merges           Tells cvsanaly to also parse merge commits.
                                  The default is to skip them.
       --hb-ignore-comments       Tells extension HunkBlame to ignore lines,
@@ -110,6 +117,19 @@ Options:
       --dot-dir[=path]           This is a hidden directory where the cache and other
                                  information is saved. By default, this is the user's
                                  home directory.
+      --batch=path               Mine all the repositories listed in the given
+                                 file (one URI per line, lines starting with #
+                                 are ignored) instead of URI
+      --batch-processes=n        Number of repositories mined at the same
+                                 time in batch mode (4)
+      --insert-batch-size=n      Number of rows written at a time by the
+                                 Hunks and PatchLOC extensions (1000)
+      --commit-interval=s        Maximum number of seconds between commits
+                                 of the Hunks and PatchLOC extensions
+      --git-numstat              Get the lines added and removed by every
+                                 commit and file while parsing the Git log
+                                 (tables of CommitsLOC and PatchLOC). Like
+                                 them, whitespace changes are ignored
 
 Database:
 
@@ -130,6 +150,15 @@ Content options:
       --no-content               When running the Content extension, don't
                                  insert the content (ie. you just want the
                                  lines of code count)
+      --content-blobs            Store every distinct file content once in
+                                 the content_blobs table, referenced from
+                                 the content table, instead of a copy for
+                                 every file revision
+
+Patches options:
+      --compress-patches         Store the patches compressed with zlib
+      --migrate-patches          Compress the patches already stored in
+                                 the database and exit
 File Count options:
       --count-types=type1,type2  When running the File Count extension, only
                                  count the types (based on regex in
@@ -143,9 +172,15 @@ is highly recommended that these are only specified in a config file.
                                  matched case-insensitively.
       --bugfixregexcase=re1,re2  A comma-separated list of regexes to be
                                  matched case-sensitively.
+      --bugfix-processes=n       Number of processes matching the commit
+                                 messages (4)
 """
 
-def _parse_log(uri, repo, parser, reader, config, db):
+class BatchError(Exception):
+    '''Error mining a repository in batch mode'''
+
+
+def _parse_log(uri, repo, parser, reader, config, db, lock=None):
     """Parse the log with the given parser, outputting to a database.
 
     Args:
@@ -155,6 +190,7 @@ def _parse_log(uri, repo, parser, reader, config, db):
       reader: The log reader
       config: The Config object that specifies the current config
       db: The database to add the data to
+      lock: Lock held while the parsed commits are inserted in the database
     """
     # Start the parsing process
     printout("Parsing log for %s (%s)", (uri, repo.get_type()))
@@ -169,11 +205,40 @@ def _parse_log(uri, repo, parser, reader, config, db):
     if config.save_logfile is not None:
         writer = LogWriter(config.save_logfile)
 
-    parser.set_content_handler(DBProxyContentHandler(db))
+    parser.set_content_handler(DBProxyContentHandler(db, lock))
     reader.start(new_line, (parser, writer))
     parser.end()
     writer and writer.close()
 
+def _prepare_incremental(uri, reader, config, db):
+    """Set up an incremental run for an already added repository.
+
+    The log is read from the branch heads mined in the previous run, and
+    the extensions only process the commits added in this one.
+
+    Args:
+      uri: The URI of the repository
+      reader: The log reader
+      config: The Config object that specifies the current config
+      db: The database the repository was mined to
+    """
+    cnn = db.connect()
+    cursor = cnn.cursor()
+    repo_id = get_repo_id(uri, cursor, db)
+    heads = get_branch_heads(cursor, db, repo_id)
+    cursor.execute(statement("SELECT max(id) from scmlog " + \
+                             "where repository_id = ?", db.place_holder),
+                   (repo_id,))
+    last_commit = cursor.fetchone()[0]
+    cursor.close()
+    cnn.close()
+
+    printdbg("Incremental run from commit %s, %d known heads",
+             (str(last_commit), len(heads)))
+    reader.set_known_heads(heads)
+    config.known_heads = heads
+    config.first_new_commit = (last_commit or 0) + 1
+
 def _get_uri_and_repo(path):
     """ Get a URI and repositoryhandler object for a path.
 
@@ -213,6 +278,88 @@ def _get_uri_and_repo(path):
 def _get_parser_from_repository(repo):
     return create_parser_from_repository(repo)
 
+def _get_parser_and_reader(repo, path, uri, config):
+    """Create the log reader and the parser for a repository.
+
+    The parser is None if it couldn't be created.
+
+    Args:
+      repo: The repositoryhandler repository object to query
+      path: The path to the repository, None if it's remote
+      uri: The URI of the repository
+      config: The Config object that specifies the current config
+    """
+    printdbg("Preparing logging")
+    # Create reader
+    reader = LogReader()
+    reader.set_repo(repo, path or uri)
+    reader.set_branch(config.branch)
+    reader.set_numstat(config.git_numstat)
+
+    # Create parser
+    if config.repo_logfile is not None:
+        parser = create_parser_from_logfile(config.repo_logfile)
+        reader.set_logfile(config.repo_logfile)
+    else:
+        parser = _get_parser_from_repository(repo)
+
+    if parser is not None:
+        parser.set_repository(repo, uri)
+        # Only when the reader really gives numstat lines, so that
+        # the commits read without them are counted by the extensions
+        if reader.reads_numstat():
+            parser.set_numstat(True)
+
+    # TODO: check parser type == logfile type
+
+    return (parser, reader)
+
+def _get_database(config):
+    """Create the database object for the current config.
+
+    Errors are printed and None is returned if the database can't be used.
+
+    Args:
+      config: The Config object that specifies the current config
+    """
+    try:
+        printdbg("Creating database")
+        return create_database(config.db_driver,
+                               config.db_database,
+                               config.db_user,
+                               config.db_password,
+                               config.db_hostname)
+    except AccessDenied, e:
+        printerr("Error creating database: %s", (e.message,))
+    except DatabaseNotFound:
+        printerr("Database %s doesn't exist. It must be created before " + \
+                 "running MininGit", (config.db_database,))
+    except DatabaseDriverNotSupported:
+        printerr("Database driver %s is not supported by MininGit",
+                 (config.db_driver,))
+
+    return None
+
+def _add_repository(cnn, db, uri, repo):
+    """Insert a new repository in the database.
+
+    Args:
+      cnn: The database connection to use
+      db: The database to add the repository to
+      uri: The URI of the repository
+      repo: The repositoryhandler repository object
+    """
+    # We consider the name of the repo as the last item of the root path
+    name = uri.rstrip("/").split("/")[-1].strip()
+    cursor = cnn.cursor()
+    rep = DBRepository(None, uri, name, repo.get_type())
+    cursor.execute(statement(DBRepository.__insert__, db.place_holder),
+                   (rep.id, rep.uri, rep.name, rep.type))
+    cursor.close()
+    cnn.commit()
+
+    return rep
+
 def _get_extensions_manager(extensions, hard_order=False):
     try:
         printdbg("Starting ExtensionsManager")
@@ -231,6 +378,183 @@ def _get_extensions_manager(extensions, hard_order=False):
         sys.exit(1)
 
 
+def _read_batch_file(filename):
+    """Return the list of repositories in a batch file.
+
+    There's one URI (or path) per line, empty lines and lines starting
+    with # are ignored.
+
+    Args:
+      filename: The path to the batch file
+    """
+    f = open(filename, 'r')
+    uris = [line.strip() for line in f
+            if line.strip() and not line.strip().startswith('#')]
+    f.close()
+
+    return uris
+
+# Locks shared by the batch worker processes, see _batch_main
+_batch_locks = None
+
+def _init_batch_worker(content_lock, extension_locks):
+    global _batch_locks
+
+    _batch_locks = (content_lock, extension_locks)
+
+def _mine_repository(uri, config, db, content_lock, extension_locks):
+    """Parse the log of a repository and run the extensions on it.
+
+    This is what main does for a single repository, but it raises
+    BatchError instead of exiting. The content lock is held while the
+    repository and its log are inserted in the database, and every
+    extension is run holding its own lock, so that the ids allocated from
+    the current max(id) of a table can't be used by other processes.
+
+    Args:
+      uri: The URI or path of the repository
+      config: The Config object that specifies the current config
+      db: The database to add the data to
+      content_lock: Lock for the tables filled when parsing the log
+      extension_locks: Dict of locks by extension name
+    """
+    path = uri_to_filename(uri)
+    (uri, repo) = _get_uri_and_repo(path)
+
+    if not config.no_parse:
+        (parser, reader) = _get_parser_and_reader(repo, path, uri, config)
+
+        if parser is None:
+            raise BatchError("Failed to create parser")
+
+    cnn = db.connect()
+    cursor = cnn.cursor()
+    content_lock.acquire()
+    try:
+        cursor.execute(statement("SELECT id from repositories where uri = ?",
+                                 db.place_holder), (uri,))
+        rep = cursor.fetchone()
+
+        if rep is None:
+            if config.no_parse:
+                raise BatchError("The option --no-parse must be used with " + \
+                                 "an already filled database")
+
+            initialize_ids(db, cursor)
+            _add_repository(cnn, db, uri, repo)
+    finally:
+        content_lock.release()
+        cursor.close()
+        cnn.close()
+
+    if not config.no_parse:
+        if config.incremental:
+            _prepare_incremental(uri, reader, config, db)
+        _parse_log(path or uri, repo, parser, reader, config, db,
+                   content_lock)
+
+    emg = ExtensionsManager(config.extensions, hard_order=config.hard_order,
+                            locks=extension_locks)
+    printout("Executing extensions for %s", (uri,))
+    emg.run_extensions(repo, path or uri, db)
+
+def _batch_worker(uri):
+    """Mine a repository in a worker process.
+
+    Returns the URI, the time it took and the error message or None,
+    since exceptions can't be raised back to the main process.
+
+    Args:
+      uri: The URI or path of the repository
+    """
+    content_lock, extension_locks = _batch_locks
+    config = Config()
+    start = time()
+
+    try:
+        db = _get_database(config)
+        if db is None:
+            raise BatchError("Couldn't connect to the database")
+
+        _mine_repository(uri, config, db, content_lock, extension_locks)
+        error = None
+    except SystemExit:
+        # Errors creating the repository are printed before exiting
+        error = "Couldn't create the repository"
+    except Exception, e:
+        error = str(e) or e.__class__.__name__
+
+    return (uri, time() - start, error)
+
+def _batch_main(filename, config):
+    """Mine all the repositories listed in a batch file.
+
+    Repositories are mined in a pool of config.batch_processes worker
+    processes, all of them writing to the same database. The timing of
+    every repository and the errors are reported as they finish.
+
+    Args:
+      filename: The path to the batch file
+      config: The Config object that specifies the current config
+    """
+    try:
+        uris = _read_batch_file(filename)
+    except IOError, e:
+        printerr("Error reading batch file %s: %s", (filename, str(e)))
+        return 1
+
+    db = _get_database(config)
+    if db is None:
+        return 1
+
+    # Tables are created before starting the workers,
+    # so that they don't race to do it
+    cnn = db.connect()
+    cursor = cnn.cursor()
+    try:
+        printdbg("Creating tables")
+        db.create_tables(cursor)
+        cnn.commit()
+    except TableAlreadyExists:
+        printdbg("Tables not created, database already exists")
+    except DatabaseException, e:
+        printerr("Database error: %s", (e.message,))
+        return 1
+    finally:
+        cursor.close()
+        cnn.close()
+
+    emg = _get_extensions_manager(config.extensions, config.hard_order)
+    extension_locks = dict([(name, multiprocessing.Lock())
+                            for name in emg.exts])
+
+    printout("Mining %d repositories with %d processes",
+             (len(uris), config.batch_processes))
+    start = time()
+    failed = []
+
+    pool = multiprocessing.Pool(config.batch_processes, _init_batch_worker,
+                                (multiprocessing.Lock(), extension_locks))
+    for uri, elapsed, error in pool.imap_unordered(_batch_worker, uris):
+        if error is None:
+            printout("Repository %s mined in %.2f s", (uri, elapsed))
+        else:
+            printerr("Error mining repository %s (%.2f s): %s",
+                     (uri, elapsed, error))
+            failed.append(uri)
+    pool.close()
+    pool.join()
+
+    printout("%d repositories mined in %.2f s, %d failed",
+             (len(uris) - len(failed), time() - start, len(failed)))
+    for uri in failed:
+        printout("  Failed: %s", (uri,))
+
+    if failed:
+        return 1
+
+    return 0
+
 def main(argv):
     # Short (one letter) options. Those requiring argument followed by :
     short_opts = "hVgqbnf:l:s:u:p:d:H:"
@@ -239,10 +563,14 @@ def main(argv):
                  "config-file=", "repo-logfile=", "save-logfile=",
                  "no-parse", "db-user=", "db-password=", "db-hostname=",
                  "db-database=", "db-driver=", "extensions=", "hard-order",
-                 "metrics-all", "metrics-noerr", "no-content", "branch=",
+                 "metrics-all", "metrics-noerr", "no-content",
+                 "content-blobs", "branch=",
                  "backout", "low-memory", "count-types=", "analyze-merges",
                  "hb-ignore-comments", "bugfixregexes=", "bugfixregexes-case=",
-                 "dot-dir="]
+                 "dot-dir=", "batch=", "batch-processes=", "incremental",
+                 "git-numstat", "bugfix-processes=", "compress-patches",
+                 "migrate-patches", "insert-batch-size=",
+                 "commit-interval="]
 
     # Default options
     debug = None
@@ -250,6 +578,7 @@ def main(argv):
     profile = None
     configfile = None
     no_parse = None
+    incremental = None
     user = None
     passwd = None
     hostname = None
@@ -263,6 +592,7 @@ def main(argv):
     hard_order = None
     low_memory = None
     no_content = None
+    content_blobs = None
     branch = None
     backout = None
     count_types = None
@@ -271,6 +601,14 @@ def main(argv):
     bug_fix_regexes = None
     bug_fix_regexes_case_sensitive = None
     dot_dir = None
+    batch = None
+    batch_processes = None
+    git_numstat = None
+    bug_fix_processes = None
+    compress_patches_opt = None
+    migrate_patches = None
+    insert_batch_size = None
+    commit_interval = None
 
     try:
         opts, args = getopt.getopt(argv, short_opts, long_opts)
@@ -293,6 +631,8 @@ def main(argv):
             profile = True
         elif opt in("--no-parse", "-n"):
             no_parse = True
+        elif opt in("--incremental", ):
+            incremental = True
         elif opt in("-f", "--config-file"):
             configfile = value
         elif opt in("-u", "--db-user"):
@@ -325,6 +665,14 @@ def main(argv):
             metrics_noerr = True
         elif opt in ("--no-content", ):
             no_content = True
+        elif opt in ("--content-blobs", ):
+            content_blobs = True
+        elif opt in ("--git-numstat", ):
+            git_numstat = True
+        elif opt in ("--compress-patches", ):
+            compress_patches_opt = True
+        elif opt in ("--migrate-patches", ):
+            migrate_patches = True
         elif opt in ("-b", "--backout"):
             backout = True
         elif opt in ("--analyze-merges"):
@@ -337,6 +685,32 @@ def main(argv):
             bug_fix_regexes_case_sensitive = value.split(',')
         elif opt in("--dot-dir"):
         	dot_dir = value
+        elif opt in("--batch", ):
+            batch = value
+        elif opt in("--batch-processes", ):
+            try:
+                batch_processes = int(value)
+            except ValueError:
+                printerr("Invalid number of batch processes: %s", (value,))
+                return 1
+        elif opt in("--insert-batch-size", ):
+            try:
+                insert_batch_size = int(value)
+            except ValueError:
+                printerr("Invalid insert batch size: %s", (value,))
+                return 1
+        elif opt in("--commit-interval", ):
+            try:
+                commit_interval = float(value)
+            except ValueError:
+                printerr("Invalid commit interval: %s", (value,))
+                return 1
+        elif opt in("--bugfix-processes", ):
+            try:
+                bug_fix_processes = int(value)
+            except ValueError:
+                printerr("Invalid number of bug fix processes: %s", (value,))
+                return 1
 
     if len(args) <= 0:
         uri = os.getcwd()
@@ -365,6 +739,8 @@ def main(argv):
         config.save_logfile = save_logfile
     if no_parse is not None:
         config.no_parse = no_parse
+    if incremental is not None:
+        config.incremental = incremental
     if dot_dir is not None:
     	config.dot_dir = dot_dir
     if driver is not None:
@@ -395,6 +771,10 @@ def main(argv):
         config.metrics_noerr = metrics_noerr
     if no_content is not None:
         config.no_content = no_content
+    if content_blobs is not None:
+        config.content_blobs = content_blobs
+    if git_numstat is not None:
+        config.git_numstat = git_numstat
     if backout is not None:
         config.extensions = get_all_extensions()
     if analyze_merges is not None:
@@ -414,6 +794,16 @@ def main(argv):
 
         config.bug_fix_regexes_case_sensitive = \
             bug_fix_regexes_case_sensitive
+    if bug_fix_processes is not None:
+        config.bug_fix_processes = bug_fix_processes
+    if compress_patches_opt is not None:
+        config.compress_patches = compress_patches_opt
+    if batch_processes is not None:
+        config.batch_processes = batch_processes
+    if insert_batch_size is not None:
+        config.insert_batch_size = insert_batch_size
+    if commit_interval is not None:
+        config.commit_interval = commit_interval
 
     if not config.extensions and config.no_parse:
         # Do nothing!!!
@@ -423,50 +813,30 @@ def main(argv):
         import repositoryhandler
         repositoryhandler.backends.DEBUG = True
 
+    if batch is not None:
+        return _batch_main(batch, config)
+
+    if migrate_patches:
+        db = _get_database(config)
+        if db is None:
+            return 1
+        compress_patches(db)
+        return 0
+
     path = uri_to_filename(uri)
     (uri, repo) = _get_uri_and_repo(path)
 
     if not config.no_parse:
-        printdbg("Preparing logging")
-        # Create reader
-        reader = LogReader()
-        reader.set_repo(repo, path or uri)
-        reader.set_branch(config.branch)
-
-        # Create parser
-        if config.repo_logfile is not None:
-            parser = create_parser_from_logfile(config.repo_logfile)
-            reader.set_logfile(config.repo_logfile)
-        else:
-            parser = _get_parser_from_repository(repo)
-
-        parser.set_repository(repo, uri)
+        (parser, reader) = _get_parser_and_reader(repo, path, uri, config)
 
         if parser is None:
             printerr("Failed to create parser")
             return 1
 
-        # TODO: check parser type == logfile type
-
     db_exists = False
 
-    try:
-        printdbg("Creating database")
-        db = create_database(config.db_driver,
-                             config.db_database,
-                             config.db_user,
-                             config.db_password,
-                             config.db_hostname)
-    except AccessDenied, e:
-        printerr("Error creating database: %s", (e.message,))
-        return 1
-    except DatabaseNotFound:
-        printerr("Database %s doesn't exist. It must be created before " + \
-                 "running MininGit", (config.db_database,))
-        return 1
-    except DatabaseDriverNotSupported:
-        printerr("Database driver %s is not supported by MininGit",
-                 (config.db_driver,))
+    db = _get_database(config)
+    if db is None:
         return 1
 
     emg = _get_extensions_manager(config.extensions, config.hard_order)
@@ -520,18 +890,13 @@ def main(argv):
         return 1
 
     if not db_exists or rep is None:
-        # We consider the name of the repo as the last item of the root path
-        name = uri.rstrip("/").split("/")[-1].strip()
-        cursor = cnn.cursor()
-        rep = DBRepository(None, uri, name, repo.get_type())
-        cursor.execute(statement(DBRepository.__insert__, db.place_holder),
-                       (rep.id, rep.uri, rep.name, rep.type))
-        cursor.close()
-        cnn.commit()
+        rep = _add_repository(cnn, db, uri, repo)
 
     cnn.close()
 
     if not config.no_parse:
+        if config.incremental:
+            _prepare_incremental(uri, reader, config, db)
         _parse_log(path or uri, repo, parser, reader, config, db)
 
     # Run extensions